@@ -0,0 +1,153 @@
+"""Benchmark of `<` inheritance resolution on synthetic stacks.
+
+Usage:
+  inheritance.py [options]
+
+Options:
+  --depths=<depths>     Comma separated lengths of the template chains [default: 1,5,20].
+  --widths=<widths>     Comma separated instance counts, each running CONTAINERS_PER_INSTANCE containers
+                        inheriting the deepest template [default: 10,100,1000].
+  --repeat=<repeat>     Runs per stack, the fastest one is reported [default: 3].
+"""
+import sys
+import time
+
+from docopt import docopt
+
+from deploy.stack import posprocess_dict
+
+
+CONTAINERS_PER_INSTANCE = 10
+
+
+def reference_posprocess_dict(d):
+    # posprocess_dict as it was before memoization, run on unshare(tree) the way the stack used it
+    if "<" in d:
+        new_d = {}
+        if type(d["<"]) is list:
+            for x in d["<"]:
+                new_d.update(x)
+        else:
+            new_d.update(d["<"])
+        del(d["<"])
+        new_d.update(d)
+        d = new_d
+
+    for k in list(d.keys()):
+        if type(k) is str and k != "<" and k.startswith("<"):
+            new_d = {}
+            if type(d[k]) is list:
+                for x in d[k]:
+                    new_d.update(x)
+            else:
+                new_d.update(d[k])
+            del (d[k])
+            new_d.update(d[k[1:]])
+            d[k[1:]] = new_d
+
+    for k in d:
+        if type(d[k]) == dict:
+            d[k] = reference_posprocess_dict(d[k])
+
+    return d
+
+
+def unshare(value):
+    # Copy of value in which every YAML alias is a separate copy
+    if isinstance(value, dict):
+        return {k: unshare(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [unshare(x) for x in value]
+    return value
+
+
+def make_stack(depth, width):
+    # One domain of `width` instances. Every container inherits the last of a chain of `depth` templates, each one
+    # inheriting the one before it through `<` for itself, its env and its healthcheck and through `<labels`. The
+    # dicts are shared the way YAML aliases share them.
+    base = {
+        "docker_file": "Dockerfile",
+        "network": "overlay",
+        "env": {"LOG_LEVEL": "info", "WORKERS": 4},
+        "labels": {"tier": "app"},
+        "healthcheck": {"path": "/health", "interval": 10, "retries": {"count": 3, "delay": 1}}
+    }
+    templates = [base]
+    for level in range(depth):
+        parent = templates[-1]
+        templates.append({
+            "<": parent,
+            "env": {"<": parent["env"], "LEVEL_%s" % level: level},
+            "<labels": [parent["labels"], {"level": str(level)}],
+            "labels": {"template": "t%s" % level},
+            "healthcheck": {"<": parent["healthcheck"], "timeout": level + 1}
+        })
+    template = templates[-1]
+    instances = {}
+    for i in range(width):
+        instances["node%s" % i] = {
+            "public_ip": "10.0.%s.%s" % (i // 256, i % 256),
+            "root": i == 0,
+            "containers": {
+                "app%s" % j: {
+                    "<": template,
+                    "run": "image%s:latest" % j,
+                    "env": {"<": template["env"], "INDEX": j}
+                } for j in range(CONTAINERS_PER_INSTANCE)
+            }
+        }
+    return {"bench": {"instances": instances, "services": {}}}
+
+
+def count_dicts(value, seen=None):
+    # Distinct dicts reachable from value
+    seen = set() if seen is None else seen
+    if isinstance(value, dict):
+        if id(value) in seen:
+            return len(seen)
+        seen.add(id(value))
+        for x in value.values():
+            count_dicts(x, seen)
+    elif isinstance(value, list):
+        for x in value:
+            count_dicts(x, seen)
+    return len(seen)
+
+
+def measure(func, stack, repeat):
+    best = None
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = func(stack)
+        wall = time.perf_counter() - started_at
+        best = wall if best is None else min(best, wall)
+    return result, best
+
+
+def main():
+    arguments = docopt(__doc__)
+    depths = [int(x) for x in arguments["--depths"].split(",")]
+    widths = [int(x) for x in arguments["--widths"].split(",")]
+    repeat = int(arguments["--repeat"])
+    print("\033[1;37;40m%-8s %8s %10s %12s %12s %14s %14s\033[0m" % (
+        "Depth", "Width", "Containers", "Reference", "Memoized", "Reference dicts", "Memoized dicts"
+    ))
+    mismatches = []
+    for depth in depths:
+        for width in widths:
+            stack = make_stack(depth, width)
+            reference, reference_wall = measure(lambda x: reference_posprocess_dict(unshare(x)), stack, repeat)
+            memoized, memoized_wall = measure(posprocess_dict, stack, repeat)
+            if memoized != reference:
+                mismatches.append("%s/%s" % (depth, width))
+            print("%-8s %8s %10s %11.3fs %11.3fs %15s %14s" % (
+                depth, width, width * CONTAINERS_PER_INSTANCE, reference_wall, memoized_wall,
+                count_dicts(reference), count_dicts(memoized)
+            ))
+    if mismatches:
+        print("\033[31mResults differ from the reference on %s\033[0m" % ", ".join(mismatches))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
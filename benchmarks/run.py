@@ -0,0 +1,187 @@
+"""Deploy benchmarks against a simulated cluster.
+
+Usage:
+  run.py [options]
+
+Options:
+  --sizes=<sizes>           Comma separated container counts [default: 1,10,100,1000].
+  --scenarios=<scenarios>   Comma separated scenarios to run (default: all).
+  --latency=<seconds>       Simulated duration of one remote round trip [default: 0.002].
+  --bandwidth=<bytes>       Simulated bytes per second of every remote connection [default: 12500000].
+  --output-lines=<lines>    Lines of output printed by every simulated docker build or pull [default: 20].
+  --jobs=<jobs>             Deploy steps run in parallel [default: 4].
+  --baseline=<file>         Baseline to compare with [default: benchmarks/baseline.json].
+  --tolerance=<ratio>       Allowed growth of round trips and bytes over the baseline [default: 0.1].
+  --update-baseline         Write the results as the new baseline instead of comparing.
+"""
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+from docopt import docopt
+
+from benchmarks.simulation import simulated
+from benchmarks.stacks import make_project, make_stack
+from deploy.tasks.deploy import deploy_dev, deploy_prod
+from deploy.tasks.migrate import migrate_dev, migrate_prod
+from deploy.tasks.plan import plan, apply
+from deploy.tasks.stop import stop_dev, stop_prod
+
+
+def _targets(stack):
+    return [str(domain) for domain in stack.get_domains()]
+
+
+def _first_built(stack):
+    for instance in stack.get_instances():
+        for container in instance.containers.values():
+            if container.build and not str(container).startswith("gateway."):
+                return str(container)
+
+
+def _first_instance_containers(stack):
+    return [str(container) for container in stack.get_instances()[0].containers.values()]
+
+
+# name: (mode, setup or None, measured step). Setup runs unmeasured against the same simulated cluster first.
+SCENARIOS = {
+    "deploy_dev": ("dev", None, lambda stack, jobs: deploy_dev(stack, _targets(stack), jobs)),
+    "deploy_prod": ("prod", None, lambda stack, jobs: deploy_prod(stack, _targets(stack), jobs=jobs)),
+    "redeploy_prod": (
+        "prod",
+        lambda stack, jobs: deploy_prod(stack, _targets(stack), jobs=jobs),
+        lambda stack, jobs: deploy_prod(stack, _targets(stack), jobs=jobs)
+    ),
+    "plan_apply_prod": (
+        "prod",
+        None,
+        lambda stack, jobs: (plan("prod", stack, _targets(stack), jobs=jobs), apply("prod", stack, jobs=jobs))
+    ),
+    "plan_prod": (
+        "prod",
+        lambda stack, jobs: deploy_prod(stack, _targets(stack), jobs=jobs),
+        lambda stack, jobs: plan("prod", stack, _targets(stack), jobs=jobs)
+    ),
+    "plan_dev": (
+        "dev",
+        lambda stack, jobs: deploy_dev(stack, _targets(stack), jobs),
+        lambda stack, jobs: plan("dev", stack, _targets(stack))
+    ),
+    "migrate_dev": (
+        "dev",
+        lambda stack, jobs: deploy_dev(stack, _targets(stack), jobs),
+        lambda stack, jobs: migrate_dev(stack, _first_built(stack), False, None)
+    ),
+    "migrate_prod": (
+        "prod",
+        lambda stack, jobs: deploy_prod(stack, _targets(stack), jobs=jobs),
+        lambda stack, jobs: migrate_prod(stack, _first_built(stack), False, None)
+    ),
+    "stop_dev": (
+        "dev",
+        lambda stack, jobs: deploy_dev(stack, _targets(stack), jobs),
+        lambda stack, jobs: [stop_dev(stack, x) for x in _first_instance_containers(stack)]
+    ),
+    "stop_prod": (
+        "prod",
+        lambda stack, jobs: deploy_prod(stack, _targets(stack), jobs=jobs),
+        lambda stack, jobs: [stop_prod(stack, x) for x in _first_instance_containers(stack)]
+    )
+}
+
+
+def run_scenario(name, size, project_dir, latency, bandwidth, output_lines, jobs):
+    mode, setup, step = SCENARIOS[name]
+    stack = make_stack(size, mode, project_dir)
+    stack.vars["rollout_timeout"] = 10
+    # Host facts and file hashes are cached under .deploy, every scenario starts without them
+    shutil.rmtree(os.path.join(project_dir, ".deploy"), ignore_errors=True)
+    with simulated(stack, latency, bandwidth, output_lines) as (cluster, stats):
+        with redirect_stdout(io.StringIO()):
+            if setup:
+                setup(stack, jobs)
+            stats.reset()
+            started_at = time.time()
+            step(stack, jobs)
+            wall = time.time() - started_at
+    return {
+        "containers": sum(len(x.containers) for x in stack.get_instances()),
+        "round_trips": stats.round_trips,
+        "local_calls": stats.local_calls,
+        "bytes": stats.bytes_sent + stats.bytes_received,
+        "wall": round(wall, 3)
+    }
+
+
+def compare(results, baseline, tolerance):
+    # Round trips and bytes are deterministic and must not grow beyond tolerance; wall time is only reported
+    regressions = []
+    for key, result in sorted(results.items()):
+        expected = baseline.get(key)
+        if not expected:
+            print(" - %-24s no baseline" % key)
+            continue
+        changes = []
+        for metric in ("round_trips", "local_calls", "bytes", "wall"):
+            if expected.get(metric):
+                ratio = float(result[metric]) / expected[metric] - 1
+                changes.append("%s %+.0f%%" % (metric, ratio * 100))
+                if metric != "wall" and ratio > tolerance:
+                    regressions.append("%s %s" % (key, metric))
+        print(" - %-24s %s" % (key, ", ".join(changes)))
+    return regressions
+
+
+def main():
+    arguments = docopt(__doc__)
+    sizes = [int(x) for x in arguments["--sizes"].split(",")]
+    scenarios = arguments["--scenarios"].split(",") if arguments["--scenarios"] else list(SCENARIOS)
+    project_dir = tempfile.mkdtemp(prefix="deploy-bench-")
+    cwd = os.getcwd()
+    baseline_file = os.path.abspath(arguments["--baseline"])
+    results = {}
+    try:
+        make_project(project_dir)
+        os.chdir(project_dir)
+        print("\033[1;37;40m%-24s %10s %12s %12s %14s %10s\033[0m" % (
+            "Scenario", "Containers", "Round trips", "Local calls", "Bytes", "Wall"
+        ))
+        for name in scenarios:
+            for size in sizes:
+                result = run_scenario(
+                    name, size, project_dir, float(arguments["--latency"]), float(arguments["--bandwidth"]),
+                    int(arguments["--output-lines"]), int(arguments["--jobs"])
+                )
+                results["%s/%s" % (name, size)] = result
+                print("%-24s %10s %12s %12s %14s %9.2fs" % (
+                    "%s/%s" % (name, size), result["containers"], result["round_trips"], result["local_calls"],
+                    result["bytes"], result["wall"]
+                ))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(project_dir, ignore_errors=True)
+
+    if arguments["--update-baseline"]:
+        with open(baseline_file, "w") as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+        print("Baseline written to %s" % baseline_file)
+        return
+    if not os.path.exists(baseline_file):
+        print("No baseline at %s, run with --update-baseline to create it" % baseline_file)
+        return
+    with open(baseline_file) as fd:
+        baseline = json.load(fd)
+    print("\033[1;37;40mCompared to %s\033[0m" % baseline_file)
+    regressions = compare(results, baseline, float(arguments["--tolerance"]))
+    if regressions:
+        print("\033[31mRegressions: %s\033[0m" % ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import os
+
+from deploy.stack import Stack, Domain, Instance, Container, Service
+
+
+CONTAINERS_PER_INSTANCE = 10
+INSTANCES_PER_DOMAIN = 10
+CONTAINERS_PER_SERVICE = 5
+BUILD_CONTEXTS = 5
+FILES_PER_CONTEXT = 20
+
+VARS = {
+    "stack_id": "bench",
+    "gateway_port": 4020,
+    "migrate_host_field": "DB_HOST",
+    "migrate_port_field": "DB_PORT",
+    "migrate_db_field": "DB_NAME",
+    "migrate_user_field": "DB_USER",
+    "migrate_password_field": "DB_PASSWORD"
+}
+
+
+def make_project(project_dir):
+    # Build contexts the synthetic containers point at: apps/app<n> and the gateway every instance runs
+    for path in ["apps/app%s" % i for i in range(BUILD_CONTEXTS)] + ["3rdparty/gateway"]:
+        os.makedirs(os.path.join(project_dir, path), exist_ok=True)
+        with open(os.path.join(project_dir, path, "Dockerfile"), "w") as fd:
+            fd.write("FROM python:3\nCOPY . /app\n")
+        for i in range(FILES_PER_CONTEXT):
+            with open(os.path.join(project_dir, path, "module%s.py" % i), "w") as fd:
+                fd.write("# %s\n%s" % (path, ("VALUE = %s\n" % i) * 50))
+
+
+def make_stack(containers, mode="prod", project_dir="."):
+    # A stack of `containers` application containers (plus one gateway per instance) spread over instances of
+    # CONTAINERS_PER_INSTANCE and domains of INSTANCES_PER_DOMAIN. Every other container is built from one of
+    # BUILD_CONTEXTS shared build directories, the rest run a public image. The model is assembled directly,
+    # the state a loaded Stack holds, so the benchmark does not depend on template rendering.
+    stack = Stack.__new__(Stack)
+    stack.vault = {}
+    stack.vars = dict(VARS, vault={}, mode=mode, project_dir=os.path.abspath(project_dir))
+    stack.domains = {}
+    instance_count = max(1, (containers + CONTAINERS_PER_INSTANCE - 1) // CONTAINERS_PER_INSTANCE)
+    index = 0
+    for instance_index in range(instance_count):
+        domain_name = "bench%s" % (instance_index // INSTANCES_PER_DOMAIN)
+        if domain_name not in stack.domains:
+            stack.domains[domain_name] = Domain(domain_name)
+        domain = stack.domains[domain_name]
+        instance_name = "node%s.%s" % (instance_index, domain_name)
+        instance = Instance(
+            instance_name,
+            public_ip="10.%s.%s.%s" % (instance_index // 65536, instance_index // 256 % 256, instance_index % 256),
+            is_root=instance_index % INSTANCES_PER_DOMAIN == 0,
+            volumes=["data.%s" % instance_name]
+        )
+        instance_containers = {
+            "gateway.%s" % instance_name: Container(
+                "gateway.%s" % instance_name, build="3rdparty/gateway", expose={4020: VARS["gateway_port"]},
+                is_privileged=True
+            )
+        }
+        while index < containers and len(instance_containers) <= CONTAINERS_PER_INSTANCE:
+            name = "c%s.%s" % (index, instance_name)
+            instance_containers[name] = Container(
+                name,
+                build="apps/app%s" % (index % BUILD_CONTEXTS) if index % 2 == 0 else None,
+                run="image%s:latest" % (index % 7) if index % 2 else None,
+                volumes={"/data": "data.%s" % instance_name},
+                env={
+                    "DB_HOST": "db", "DB_PORT": 5432, "DB_NAME": "bench", "DB_USER": "bench", "DB_PASSWORD": "bench"
+                },
+                expose={8000 + index % 100: 18000 + index % 100} if index % 3 == 0 else None
+            )
+            index += 1
+        instance.set_containers(instance_containers)
+        domain.instances[instance_name] = instance
+        instance.domain = domain
+    stack.domain_names = list(stack.domains)
+
+    for domain in stack.domains.values():
+        names = sorted(
+            (name for instance in domain.instances.values() for name in instance.containers if name.startswith("c")),
+            key=lambda x: int(x.split(".")[0][1:])
+        )
+        services = {}
+        for i in range(0, len(names), CONTAINERS_PER_SERVICE):
+            service_name = "svc%s.%s" % (i // CONTAINERS_PER_SERVICE, domain)
+            services[service_name] = Service(
+                service_name, containers=names[i:i + CONTAINERS_PER_SERVICE], ports={80: 8080}
+            )
+        domain.set_services(services)
+    return stack
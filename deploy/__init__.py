@@ -1,41 +1,83 @@
 """Deployment tool.
 
 Usage:
-  d [dev] deploy <service>
-  d [dev] stop <service>
-  d [dev] (log|logs) <service> [--tail=<lines>]
-  d [dev] migrate [rollback] <service> [--rev=<rev>]{extend}
+  d [dev] deploy <target>... [--refresh-facts] [--jobs=<jobs>] [--profile]
+  d [dev] plan <target>... [--out=<file>] [--jobs=<jobs>] [--profile]
+  d [dev] apply [<plan>] [--jobs=<jobs>] [--profile]
+  d [dev] stop <service> [--profile]
+  d [dev] (log|logs) <target>... [--tail=<lines>] [--cache] [--since=<time>] [--until=<time>] [--grep=<regex>]
+  d [dev] migrate [rollback] <service> [--rev=<rev>] [--profile]{extend}
 
 Options:
   -h --help     Show this screen.
   --version     Show version.
+  --refresh-facts  Re-check every instance during bootstrap instead of trusting cached host facts.
+  --jobs=<jobs>    Number of deploy steps to run in parallel (default: deploy_jobs stack var or 4).
+  --out=<file>     Where plan saves the actions to run (default: .deploy/plan.json).
+  --cache          Also append followed log lines to .deploy/logs, resuming from the last cached line.
+  --since=<time>   Read cached logs from this time on, e.g. 2024-05-01T10:00 or 30m (UTC).
+  --until=<time>   Read cached logs up to this time.
+  --grep=<regex>   Only print log lines matching regex.
+  --profile        Record how long every step takes, write a Chrome trace to .deploy/ and print the slowest steps.
+
+Targets are full names (domain, instance.domain, service.domain or container.instance.domain) or selectors of
+containers: globs of names of any kind ("web.*.prod") or of one kind ("instance:*.prod", "service:web.prod",
+"container:db.*").
 """
+import time
+
 from docopt import docopt
 
+from deploy import tracing
 from deploy.stack import Stack
 from deploy.tasks.deploy import deploy
 from deploy.tasks.log import log
 from deploy.tasks.stop import stop
 from deploy.tasks.migrate import migrate
+from deploy.tasks.plan import plan, apply
 
 
 def main():
     arguments = docopt(__doc__.format(extend=""), version="1.0")
     mode = "dev" if arguments["dev"] else "prod"
+    if arguments["--profile"]:
+        tracing.enable()
+    try:
+        run(mode, arguments)
+    finally:
+        if arguments["--profile"]:
+            trace_file = ".deploy/trace-%s.json" % time.strftime("%Y%m%d-%H%M%S")
+            tracing.write_chrome_trace(trace_file)
+            tracing.print_summary()
+            print("Trace written to %s" % trace_file)
+
 
-    stack = Stack(
-        mode,
-        vault_file="_stack/vault.yml",
-        stack_vars_file="_stack/vars.yml",
-        stack_file="_stack/stack.yml",
-        instance_common_file="templates/instance_common.yml"
-    )
+def run(mode, arguments):
+    with tracing.span("load stack", "stack"):
+        stack = Stack(
+            mode,
+            vault_file="_stack/vault.yml",
+            stack_vars_file="_stack/vars.yml",
+            stack_file="_stack/stack.yml",
+            instance_common_file="templates/instance_common.yml"
+        )
 
     if arguments["deploy"]:
-        deploy(mode, stack, arguments["<service>"])
+        deploy(
+            mode, stack, arguments["<target>"],
+            refresh_facts=arguments["--refresh-facts"],
+            jobs=arguments["--jobs"]
+        )
+    elif arguments["plan"]:
+        plan(mode, stack, arguments["<target>"], plan_file=arguments["--out"], jobs=arguments["--jobs"])
+    elif arguments["apply"]:
+        apply(mode, stack, plan_file=arguments["<plan>"], jobs=arguments["--jobs"])
     elif arguments["stop"]:
         stop(mode, stack, arguments["<service>"])
     elif arguments["log"] or arguments["logs"]:
-        log(mode, stack, arguments["<service>"], arguments["--tail"])
+        log(
+            mode, stack, arguments["<target>"], arguments["--tail"],
+            since=arguments["--since"], until=arguments["--until"], grep=arguments["--grep"], cache=arguments["--cache"]
+        )
     elif arguments["migrate"]:
         migrate(mode, stack, arguments["<service>"], arguments["rollback"], arguments["--rev"])
@@ -0,0 +1,390 @@
+import asyncio
+import functools
+import os
+import shlex
+from copy import copy
+from uuid import uuid4
+
+from deploy.environment import (
+    EnvironmentFactory, LocalEnvironment, SSHEnvironment, BatchOutput, annotate_rsync, _batch_command, _batch_script,
+    _batch_unfinished, _batch_results
+)
+from deploy.stream import LineSplitter, OutputBuffer, CHUNK_SIZE
+from deploy.tracing import traced
+
+
+# Commands run_parallel_async keeps in flight at once by default
+JOBS = 32
+
+
+async def run_parallel_async(func, items, jobs=JOBS):
+    # Coroutine counterpart of run_parallel: awaits func(item) for every item with at most `jobs` in flight and
+    # returns ({item: result}, {item: exception})
+    results = {}
+    errors = {}
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def run(item):
+        async with semaphore:
+            try:
+                results[item] = await func(item)
+            except Exception as e:
+                errors[item] = e
+
+    await asyncio.gather(*[run(item) for item in items])
+    return results, errors
+
+
+class AsyncEnvironment:
+    # Coroutine counterpart of Environment: run, run_batch, sync and put are awaited, stream is an async iterator
+    # of lines. Results have the same form as the blocking environment's.
+    async def run(self, cmd, hide=False, max_lines=None, max_bytes=None, stdin=None):
+        raise NotImplementedError()
+
+    @traced("env")
+    async def run_batch(self, commands, hide=False, stop_on_error=True):
+        # Fallback for environments without pipelining: one run per command
+        results = []
+        failed = None
+        for command in commands:
+            cmd, ignore_errors, cmd_hide = _batch_command(command)
+            if failed and stop_on_error:
+                results.append({"stdout": "", "stderr": "", "return_code": None})
+                continue
+            result = await self.run(cmd, hide=hide if cmd_hide is None else cmd_hide)
+            results.append(result)
+            if result["return_code"] and not ignore_errors and not failed:
+                failed = (cmd, result["return_code"])
+        if failed:
+            raise RuntimeError("Command %s failed with return code %s" % failed)
+        return results
+
+    def stream(self, cmd):
+        raise NotImplementedError()
+
+    async def sync(self, local_dir, remote_dir, exclude, delete, relative=False):
+        raise NotImplementedError()
+
+    async def put(self, data, path):
+        raise NotImplementedError()
+
+    def cd(self, path):
+        if not path.startswith("/"):
+            self.cwd = os.path.join(self.cwd, path)
+        else:
+            self.cwd = path
+
+
+async def _read_lines(reader, on_line):
+    splitter = LineSplitter()
+    while True:
+        chunk = await reader.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        for line in splitter.feed(chunk):
+            on_line(line)
+    for line in splitter.flush():
+        on_line(line)
+
+
+class AsyncLocalEnvironment(AsyncEnvironment):
+    # Subprocesses driven by the event loop: output is drained by the loop instead of a thread per pipe
+    def __init__(self, env=None):
+        env = env or LocalEnvironment()
+        self.hostname = "local"
+        self.cwd = env.cwd
+        self._env = dict(env._env)
+
+    def add_env(self, key, value):
+        self._env[key] = value
+
+    def _process_env(self):
+        _env = copy(os.environ)
+        for key, value in self._env.items():
+            _env[key] = str(value)
+        return _env
+
+    def _output(self, buffer, hide):
+        def on_line(line):
+            if not hide:
+                print("\033[36m        - [Local] %s\033[0m" % line)
+            buffer.append(line)
+        return on_line
+
+    @traced("local")
+    async def run(self, cmd, hide=False, max_lines=None, max_bytes=None, stdin=None):
+        if not hide:
+            print("\033[36m    - [Local] Executing %s\033[0m" % cmd)
+        p = await asyncio.create_subprocess_exec(
+            *shlex.split(cmd), stdin=asyncio.subprocess.PIPE if stdin is not None else None,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=self.cwd, env=self._process_env()
+        )
+        stdout_lines = OutputBuffer(max_lines, max_bytes)
+        stderr_lines = OutputBuffer(max_lines, max_bytes)
+
+        async def write():
+            if stdin is not None:
+                p.stdin.write(stdin.encode("utf8"))
+                await p.stdin.drain()
+                p.stdin.close()
+
+        await asyncio.gather(
+            write(),
+            _read_lines(p.stdout, self._output(stdout_lines, hide)),
+            _read_lines(p.stderr, self._output(stderr_lines, hide))
+        )
+        await p.wait()
+        return {
+            "stdout": stdout_lines.text(),
+            "stderr": stderr_lines.text(),
+            "return_code": p.returncode
+        }
+
+    async def stream(self, cmd):
+        p = await asyncio.create_subprocess_exec(*shlex.split(cmd), stdout=asyncio.subprocess.PIPE, cwd=self.cwd)
+        splitter = LineSplitter()
+        done = False
+        try:
+            while True:
+                chunk = await p.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                for line in splitter.feed(chunk):
+                    yield line
+            for line in splitter.flush():
+                yield line
+            done = True
+        finally:
+            # Stopped early by the consumer: the command would otherwise block on a full pipe
+            if not done and p.returncode is None:
+                p.kill()
+            await p.wait()
+
+
+async def _wait_readable(channel):
+    # Paramiko signals data or EOF on either stream of a channel through the pipe behind fileno()
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    fd = channel.fileno()
+    loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+    try:
+        await ready
+    finally:
+        loop.remove_reader(fd)
+
+
+async def _drain_channel(channel, on_stdout, on_stderr=None):
+    # Feeds stdout and stderr lines of an exec channel to the callbacks until the command's EOF
+    stdout, stderr = LineSplitter(), LineSplitter()
+    while True:
+        if channel.recv_ready():
+            for line in stdout.feed(channel.recv(CHUNK_SIZE)):
+                on_stdout(line)
+        elif channel.recv_stderr_ready():
+            for line in stderr.feed(channel.recv_stderr(CHUNK_SIZE)):
+                if on_stderr:
+                    on_stderr(line)
+        elif channel.eof_received or channel.closed:
+            break
+        else:
+            await _wait_readable(channel)
+    for line in stdout.flush():
+        on_stdout(line)
+    for line in stderr.flush():
+        if on_stderr:
+            on_stderr(line)
+
+
+class AsyncSSHEnvironment(AsyncEnvironment):
+    # Runs commands over the connection of a SSHEnvironment with the event loop reading every channel. Only opening
+    # channels and connecting, which paramiko offers blocking only, go through the loop's default executor.
+    def __init__(self, env):
+        self.env = env
+        self.hostname = env.hostname
+        self.port = env.port
+        self.cwd = env.cwd
+
+    async def _blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args))
+
+    def _exec(self, cmd):
+        channel = self.env.get_client().get_transport().open_session()
+        channel.exec_command(cmd)
+        return channel
+
+    async def _send(self, channel, stdin):
+        if stdin is not None:
+            await self._blocking(channel.sendall, stdin.encode("utf8"))
+            channel.shutdown_write()
+
+    def _output(self, buffer, hide):
+        def on_line(line):
+            if not hide:
+                print("\033[32m        - [%s:%s] %s\033[0m" % (self.hostname, self.port, line))
+            buffer.append(line)
+        return on_line
+
+    @traced("ssh")
+    async def run(self, cmd, hide=False, ignore_errors=False, max_lines=None, max_bytes=None, stdin=None):
+        if not hide:
+            print("\033[32m    - [%s:%s] Executing %s\033[0m" % (self.hostname, self.port, cmd))
+        while True:
+            try:
+                channel = await self._blocking(self._exec, "cd %s; %s; echo $?" % (self.cwd, cmd))
+                try:
+                    # Keep one extra line so the trailing exit status survives the capture limit
+                    stdout_lines = OutputBuffer(max_lines + 1 if max_lines is not None else None, max_bytes)
+                    stderr_lines = OutputBuffer(max_lines, max_bytes)
+                    await asyncio.gather(
+                        self._send(channel, stdin),
+                        _drain_channel(channel, self._output(stdout_lines, hide), self._output(stderr_lines, hide))
+                    )
+                finally:
+                    channel.close()
+                try:
+                    return_code = int(stdout_lines.pop())
+                except Exception:
+                    return_code = -1
+                if not ignore_errors and return_code:
+                    raise RuntimeError("Return code is %s" % return_code)
+                return {
+                    "stdout": stdout_lines.text(),
+                    "stderr": stderr_lines.text(),
+                    "return_code": return_code
+                }
+            except RuntimeError:
+                raise
+            except Exception as e:
+                await self._blocking(self.env.reset_client, e)
+
+    @traced("ssh")
+    async def run_batch(self, commands, hide=False, stop_on_error=True):
+        commands = [_batch_command(command) for command in commands]
+        if not commands:
+            return []
+        cmds = [cmd for cmd, _, _ in commands]
+        hides = [hide if cmd_hide is None else cmd_hide for _, _, cmd_hide in commands]
+        marker = "__DEPLOY_BATCH_%s__" % uuid4().hex
+        stdout_lines = [[] for _ in commands]
+        stderr_lines = [[] for _ in commands]
+        return_codes = [None for _ in commands]
+        start = 0
+        while True:
+            # Resumes from the first unfinished command after a dropped connection, as SSHEnvironment.run_batch
+            try:
+                channel = await self._blocking(
+                    self._exec, _batch_script(commands[start:], self.cwd, marker, stop_on_error)
+                )
+                for i in range(start, len(commands)):
+                    stdout_lines[i], stderr_lines[i] = [], []
+                codes = [None for _ in commands[start:]]
+                try:
+                    await _drain_channel(
+                        channel,
+                        BatchOutput(self, marker, stdout_lines[start:], hides[start:], codes, cmds[start:]).feed,
+                        BatchOutput(self, marker, stderr_lines[start:], hides[start:]).feed
+                    )
+                    ended = channel.exit_status_ready()
+                finally:
+                    channel.close()
+            except Exception as e:
+                await self._blocking(self.env.reset_client, e)
+                continue
+            return_codes[start:] = codes
+            start = _batch_unfinished(commands, return_codes, stop_on_error)
+            if start is None:
+                break
+            if ended:
+                raise RuntimeError("Batch ended before command %s" % cmds[start])
+            await self._blocking(self.env.reset_client, "Connection lost, resuming the batch from %s" % cmds[start])
+        return _batch_results(commands, stdout_lines, stderr_lines, return_codes)
+
+    async def stream(self, cmd):
+        channel = await self._blocking(self._exec, "cd %s; %s" % (self.cwd, cmd))
+        splitter = LineSplitter()
+        try:
+            while True:
+                if channel.recv_ready():
+                    for line in splitter.feed(channel.recv(CHUNK_SIZE)):
+                        yield line
+                elif channel.eof_received or channel.closed:
+                    break
+                elif channel.recv_stderr_ready():
+                    # stderr is not streamed, drop it so it does not keep the channel readable
+                    channel.recv_stderr(CHUNK_SIZE)
+                else:
+                    await _wait_readable(channel)
+            for line in splitter.flush():
+                yield line
+        finally:
+            channel.close()
+
+    @traced("rsync")
+    async def sync(self, local_dir, remote_dir, exclude, delete, relative=False):
+        result = await AsyncLocalEnvironment().run(self.env.rsync_command(local_dir, remote_dir, exclude, delete, relative))
+        annotate_rsync(result)
+
+    async def put(self, data, path):
+        await self._blocking(self.env.put, data, path)
+
+
+class ThreadedAsyncEnvironment(AsyncEnvironment):
+    # Any blocking Environment behind the async interface, each call running on the loop's default executor. Used
+    # for environments without a native async implementation.
+    def __init__(self, env):
+        self.env = env
+        self.hostname = getattr(env, "hostname", "local")
+
+    @property
+    def cwd(self):
+        return self.env.cwd
+
+    def cd(self, path):
+        self.env.cd(path)
+
+    def add_env(self, key, value):
+        self.env.add_env(key, value)
+
+    async def _blocking(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def run(self, cmd, **kwargs):
+        return await self._blocking(self.env.run, cmd, **kwargs)
+
+    async def run_batch(self, commands, hide=False, stop_on_error=True):
+        return await self._blocking(self.env.run_batch, commands, hide=hide, stop_on_error=stop_on_error)
+
+    async def stream(self, cmd):
+        lines = self.env.stream(cmd)
+        done = object()
+        try:
+            while True:
+                line = await self._blocking(next, lines, done)
+                if line is done:
+                    break
+                yield line
+        finally:
+            lines.close()
+
+    async def sync(self, local_dir, remote_dir, exclude, delete, relative=False):
+        await self._blocking(self.env.sync, local_dir, remote_dir, exclude, delete, relative)
+
+    async def put(self, data, path):
+        await self._blocking(self.env.put, data, path)
+
+
+class AsyncEnvironmentFactory:
+    # Async views of the environments EnvironmentFactory hands out, sharing their connections
+    @staticmethod
+    def get_remote(hostname, port=22):
+        env = EnvironmentFactory.get_remote(hostname, port)
+        if isinstance(env, SSHEnvironment):
+            return AsyncSSHEnvironment(env)
+        return ThreadedAsyncEnvironment(env)
+
+    @staticmethod
+    def get_local():
+        env = EnvironmentFactory.get_local()
+        if isinstance(env, LocalEnvironment):
+            return AsyncLocalEnvironment(env)
+        return ThreadedAsyncEnvironment(env)
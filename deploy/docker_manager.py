@@ -1,5 +1,9 @@
 import json
 
+from deploy.logs import follow_resumable, follow_resumable_async
+from deploy.spec import DOCKER_HASH_LABEL, spec_hash
+from deploy.tracing import trace_methods
+
 
 def _parse_docker_list(data, fields=None, key=None):
     result = [
@@ -21,96 +25,201 @@ def _parse_docker_list(data, fields=None, key=None):
     return result
 
 
+def container_hash(image, name, privileged=False, network=None, expose=None, restart="always", volumes=None, envs=None,
+                   cmd=None, oneshot=False, image_id=None):
+    # Spec hash of a container as DockerManager.add_container creates it, image_id being the image it runs
+    return spec_hash("container", image, name, privileged, network, expose, restart, volumes, envs, cmd, oneshot, image_id)
+
+
+# Name and spec hash of every container, network and volume of the stack, one listing per kind
+LEDGER_COMMANDS = (
+    ("container", "docker ps -a --format \"{{.Names}},{{.Label \\\"%s\\\"}}\"" % DOCKER_HASH_LABEL),
+    ("network", "docker network ls --format \"{{.Name}},{{.Label \\\"%s\\\"}}\"" % DOCKER_HASH_LABEL),
+    ("volume", "docker volume ls --format \"{{.Name}},{{.Label \\\"%s\\\"}}\"" % DOCKER_HASH_LABEL)
+)
+
+
+@trace_methods("docker")
 class DockerManager:
+    # Query results are cached for the lifetime of the manager (one task); every mutation invalidates
+    # the affected kind, so callers can query freely without spawning extra docker processes.
     def __init__(self, stack, env):
         self.env = env
         self.stack = stack
+        self._cache = {}
+
+    def _cached(self, key, fetch):
+        if key not in self._cache:
+            self._cache[key] = fetch()
+        return self._cache[key]
+
+    def invalidate(self, *keys):
+        if not keys:
+            self._cache.clear()
+        for key in keys:
+            self._cache.pop(key, None)
+
+    def get_snapshot(self):
+        return {
+            "containers": self.get_containers(),
+            "networks": self.get_networks(),
+            "volumes": self.get_volumes(),
+            "images": self.get_images(get_all=True)
+        }
+
+    def get_ledger(self):
+        # {(kind, name): spec hash} of every container, network and volume of the stack, in one round trip
+        return self._cached("ledger", self._get_ledger)
+
+    def _get_ledger(self):
+        return self.parse_ledger(self.env.run_batch(self.ledger_commands(), hide=True))
+
+    def ledger_commands(self):
+        return ["%s --filter Label=\"STACK_ID=%s\"" % (cmd, self.stack.vars["stack_id"]) for _, cmd in LEDGER_COMMANDS]
+
+    def parse_ledger(self, results):
+        ledger = {}
+        for (kind, _), result in zip(LEDGER_COMMANDS, results):
+            for item in _parse_docker_list(result["stdout"], fields=("Name", "Hash")):
+                ledger[(kind, item["Name"])] = item.get("Hash") or None
+        return ledger
 
     def get_networks(self):
-        return _parse_docker_list(
-            self.env.run(
-                "docker network ls --format \"{{.Name}}\" --filter Label=\"STACK_ID=%s\"" % self.stack.vars["stack_id"],
-                hide=True
-            )["stdout"]
-        )
+        return self._cached("networks", lambda: _parse_docker_list(
+            self.env.run(self.list_command("network"), hide=True)["stdout"]
+        ))
+
+    def list_command(self, kind):
+        return "docker %s ls --format \"{{.Name}}\" --filter Label=\"STACK_ID=%s\"" % (kind, self.stack.vars["stack_id"])
 
     def add_network(self, name, subnet=None, gateway=None, driver=None):
-        cmd = "docker network create %s --label \"STACK_ID=%s\" " % (name, self.stack.vars["stack_id"])
+        self.env.run(self.network_command(name, subnet, gateway, driver))
+        self.invalidate("networks", "ledger")
+
+    def network_command(self, name, subnet=None, gateway=None, driver=None):
+        cmd = "docker network create %s --label \"STACK_ID=%s\" --label \"%s=%s\" " % (
+            name, self.stack.vars["stack_id"], DOCKER_HASH_LABEL, spec_hash("network", name, subnet, gateway, driver)
+        )
         if driver:
             cmd += "--driver %s " % driver
         if subnet:
             cmd += "--subnet %s " % subnet
         if gateway:
             cmd += "--gateway %s " % gateway
-
-        self.env.run(cmd)
+        return cmd
 
     def remove_network(self, name):
         self.env.run("docker network rm %s" % name)
+        self.invalidate("networks", "ledger")
 
     def get_volumes(self):
-        return _parse_docker_list(
-            self.env.run(
-                "docker volume ls --format \"{{.Name}}\" --filter Label=\"STACK_ID=%s\"" % self.stack.vars["stack_id"],
-                hide=True
-            )["stdout"]
-        )
+        return self._cached("volumes", lambda: _parse_docker_list(
+            self.env.run(self.list_command("volume"), hide=True)["stdout"]
+        ))
 
     def add_volume(self, name):
-        self.env.run("docker volume create %s --label \"STACK_ID=%s\"" % (name, self.stack.vars["stack_id"]))
+        self.env.run(self.volume_command(name))
+        self.invalidate("volumes", "ledger")
+
+    def volume_command(self, name):
+        return "docker volume create %s --label \"STACK_ID=%s\" --label \"%s=%s\"" % (
+            name, self.stack.vars["stack_id"], DOCKER_HASH_LABEL, spec_hash("volume", name)
+        )
 
     def remove_volume(self, name):
         self.env.run("docker volume rm %s" % name)
+        self.invalidate("volumes", "ledger")
 
     def get_images(self, get_all=False):
+        return self._cached(("images", get_all), lambda: self._get_images(get_all))
+
+    def images_command(self, get_all=False, label=None, value=None):
+        # `docker images` listing in the form parse_images reads, of stack images or of all images, optionally only
+        # those carrying label=value
+        cmd = "docker images --format \"{{ .Repository }},{{ .ID }},{{ .Digest }}\""
+        if not get_all or label:
+            cmd += " --filter Label=\"STACK_ID=%s\"" % self.stack.vars["stack_id"]
+        if label:
+            cmd += " --filter Label=\"%s=%s\"" % (label, value)
+        return cmd
+
+    def parse_images(self, data):
+        return [x for x in _parse_docker_list(data, fields=("Name", "Id", "Digest")) if x["Name"] != "<none>"]
+
+    def _get_images(self, get_all):
+        return {
+            image["Name"]: image
+            for image in self.parse_images(self.env.run(self.images_command(get_all), hide=True)["stdout"])
+        }
+
+    def find_images(self, label, values):
+        # One batched lookup of images carrying label=value for each value; returns {value: image or None}
+        results = self.env.run_batch([
+            {"cmd": self.images_command(label=label, value=value), "hide": True}
+            for value in values
+        ])
         return {
-            image: x
-            for image, x in _parse_docker_list(
-                self.env.run(
-                    "docker images --format \"{{ .Repository }},{{ .ID }},{{ .Digest }}\" %s" % (
-                        ("--filter Label=\"STACK_ID=%s\"" % self.stack.vars["stack_id"]) if not get_all else ""
-                    ),
-                    hide=True
-                )["stdout"],
-                fields=("Name", "Id", "Digest"),
-                key="Name"
-            ).items()
-            if image != "<none>"
+            value: (_parse_docker_list(result["stdout"], fields=("Name", "Id", "Digest")) or [None])[0]
+            for value, result in zip(values, results)
         }
 
+    def tag_image(self, image, name):
+        # Points `name` at an already built image and returns it in get_images() form
+        if image["Name"] != name:
+            self.env.run("docker tag %s %s" % (image["Id"], name))
+            self.invalidate(("images", True), ("images", False))
+        return dict(image, Name=name)
+
     def pull_image(self, name):
         self.env.run("docker pull %s" % name)
+        self.invalidate(("images", True), ("images", False))
         return self.get_images(True)[name.split(':')[0]]
 
-    def build_image(self, path, name, docker_file="Dockerfile"):
-        self.env.run(
-            "docker build --label \"STACK_ID=%s\" -t %s -f %s/%s %s" % (self.stack.vars["stack_id"], name, path, docker_file, path)
-        )
+    def build_image(self, path, name, docker_file="Dockerfile", labels=None):
+        self.env.run(self.build_command(path, name, docker_file, labels))
+        self.invalidate(("images", True), ("images", False))
         return self.get_images(True)[name]
 
+    def build_command(self, path, name, docker_file="Dockerfile", labels=None):
+        label_string = "".join("--label \"%s=%s\" " % (key, value) for key, value in (labels or {}).items())
+        return "docker build --label \"STACK_ID=%s\" %s-t %s -f %s/%s %s" % (
+            self.stack.vars["stack_id"], label_string, name, path, docker_file, path
+        )
+
     def remove_image(self, name):
         self.env.run("docker rmi %s" % name)
-
+        self.invalidate(("images", True), ("images", False))
 
     def get_containers(self):
-        container_list = _parse_docker_list(
-            self.env.run(
-                "docker ps -a --format \"{{ .Names }}\" --filter Label=\"STACK_ID=%s\"" % self.stack.vars["stack_id"],
-                hide=True
-            )["stdout"]
-        )
+        return self._cached("containers", self._get_containers)
 
-        return {
-            container: json.loads(self.env.run("docker inspect %s" % container, hide=True)["stdout"])[0]
-            for container in container_list
-        }
+    def _get_containers(self):
+        container_ids = _parse_docker_list(self.env.run(self.containers_command(), hide=True)["stdout"])
+        if not container_ids:
+            return {}
+        return self.parse_containers(self.env.run("docker inspect %s" % " ".join(container_ids), hide=True)["stdout"])
+
+    def containers_command(self):
+        return "docker ps -a -q --no-trunc --filter Label=\"STACK_ID=%s\"" % self.stack.vars["stack_id"]
+
+    def parse_containers(self, data):
+        return {container["Name"].lstrip("/"): container for container in json.loads(data)}
 
     def add_container(self, image, name, privileged=False, network=None, expose=None, restart="always", volumes=None,
-                      envs=None, nonce=None, cmd=None, oneshot=False):
-        env_string = ""
+                      envs=None, image_id=None, cmd=None, oneshot=False):
         for env_name, env_value in (envs or {}).items():
-            env_string += "-e %s " % env_name
             self.env.add_env(env_name, env_value)
+        self.env.run(self.container_command(
+            image, name, privileged=privileged, network=network, expose=expose, restart=restart, volumes=volumes,
+            envs=envs, image_id=image_id, cmd=cmd, oneshot=oneshot
+        ))
+        self.invalidate("containers", "ledger")
+
+    def container_command(self, image, name, privileged=False, network=None, expose=None, restart="always", volumes=None,
+                          envs=None, image_id=None, cmd=None, oneshot=False):
+        # `docker run` of the container; env values are not on the command line, add_container passes them through
+        # the environment
+        env_string = "".join("-e %s " % env_name for env_name in envs or {})
         volume_string = ""
         for volume_in_container, volume_on_instance in (volumes or {}).items():
             volume_string += "--volume \"%s:%s\" " % (volume_on_instance, volume_in_container)
@@ -119,8 +228,10 @@ class DockerManager:
             expose_string += "-p %s:%s " % (port_on_instance, port_in_container)
 
         _cmd = "docker run -d --label \"STACK_ID=%s\" " % self.stack.vars["stack_id"]
-        if nonce:
-            _cmd += "--label \"NONCE=%s\" " % nonce
+        _cmd += "--label \"%s=%s\" " % (DOCKER_HASH_LABEL, container_hash(
+            image, name, privileged=privileged, network=network, expose=expose, restart=restart, volumes=volumes,
+            envs=envs, cmd=cmd, oneshot=oneshot, image_id=image_id
+        ))
         _cmd += "--name %s " % name
         if network:
             _cmd += "--network %s " % network
@@ -136,40 +247,195 @@ class DockerManager:
         _cmd += image
         if cmd:
             _cmd += " " + cmd
-
-        self.env.run(_cmd)
+        return _cmd
 
     def remove_container(self, name):
         self.stop_container(name)
         self.env.run("docker rm %s" % name)
+        self.invalidate("containers", "ledger")
 
     def stop_container(self, name):
         self.env.run("docker stop %s" % name)
+        self.invalidate("containers")
 
     def start_container(self, name):
         self.env.run("docker start %s" % name)
+        self.invalidate("containers")
 
     def restart_container(self, name):
         self.stop_container(name)
         self.start_container(name)
 
     def logs(self, name, tail=None):
-        while True:
-            try:
-                self.env.run("docker logs --tail %d -t %s -f" % (int(tail) if tail else 100, name))
-                break
-            except Exception:
-                sleep(1)
+        for line in follow_resumable(lambda **kwargs: self.follow_logs(name, **kwargs), tail):
+            print("\033[32m        - [%s] %s\033[0m" % (name, line))
+
+    def follow_logs(self, name, tail=None, since_time=None):
+        # Yields timestamped log lines of the container as they arrive, the last `tail` ones or those since since_time
+        return self.env.stream(self.logs_command(name, tail, since_time))
+
+    def logs_command(self, name, tail=None, since_time=None):
+        return "docker logs %s -t -f %s" % (
+            "--since %s" % since_time if since_time else "--tail %d" % (int(tail) if tail else 100), name
+        )
 
     def inspect(self, name):
         self.env.run("docker inspect %s" % name)
 
     def wipe(self):
-        for container in self.get_containers():
+        snapshot = self.get_snapshot()
+        for container in snapshot["containers"]:
             self.remove_container(container)
         for image in self.get_images():
             self.remove_image(image)
-        for volume in self.get_volumes():
+        for volume in snapshot["volumes"]:
             self.remove_volume(volume)
-        for network in self.get_networks():
+        for network in snapshot["networks"]:
             self.remove_network(network)
+
+
+@trace_methods("docker")
+class AsyncDockerManager(DockerManager):
+    # DockerManager over an AsyncEnvironment: the same commands and cache, every query and mutation is a coroutine
+    async def _cached_async(self, key, fetch):
+        if key not in self._cache:
+            self._cache[key] = await fetch()
+        return self._cache[key]
+
+    async def get_snapshot(self):
+        return {
+            "containers": await self.get_containers(),
+            "networks": await self.get_networks(),
+            "volumes": await self.get_volumes(),
+            "images": await self.get_images(get_all=True)
+        }
+
+    async def get_ledger(self):
+        return await self._cached_async("ledger", self._get_ledger)
+
+    async def _get_ledger(self):
+        return self.parse_ledger(await self.env.run_batch(self.ledger_commands(), hide=True))
+
+    async def get_networks(self):
+        return await self._cached_async("networks", lambda: self._get_list("network"))
+
+    async def _get_list(self, kind):
+        return _parse_docker_list((await self.env.run(self.list_command(kind), hide=True))["stdout"])
+
+    async def add_network(self, name, subnet=None, gateway=None, driver=None):
+        await self.env.run(self.network_command(name, subnet, gateway, driver))
+        self.invalidate("networks", "ledger")
+
+    async def remove_network(self, name):
+        await self.env.run("docker network rm %s" % name)
+        self.invalidate("networks", "ledger")
+
+    async def get_volumes(self):
+        return await self._cached_async("volumes", lambda: self._get_list("volume"))
+
+    async def add_volume(self, name):
+        await self.env.run(self.volume_command(name))
+        self.invalidate("volumes", "ledger")
+
+    async def remove_volume(self, name):
+        await self.env.run("docker volume rm %s" % name)
+        self.invalidate("volumes", "ledger")
+
+    async def get_images(self, get_all=False):
+        return await self._cached_async(("images", get_all), lambda: self._get_images(get_all))
+
+    async def _get_images(self, get_all):
+        return {
+            image["Name"]: image
+            for image in self.parse_images((await self.env.run(self.images_command(get_all), hide=True))["stdout"])
+        }
+
+    async def find_images(self, label, values):
+        results = await self.env.run_batch([
+            {"cmd": self.images_command(label=label, value=value), "hide": True}
+            for value in values
+        ])
+        return {
+            value: (_parse_docker_list(result["stdout"], fields=("Name", "Id", "Digest")) or [None])[0]
+            for value, result in zip(values, results)
+        }
+
+    async def tag_image(self, image, name):
+        if image["Name"] != name:
+            await self.env.run("docker tag %s %s" % (image["Id"], name))
+            self.invalidate(("images", True), ("images", False))
+        return dict(image, Name=name)
+
+    async def pull_image(self, name):
+        await self.env.run("docker pull %s" % name)
+        self.invalidate(("images", True), ("images", False))
+        return (await self.get_images(True))[name.split(':')[0]]
+
+    async def build_image(self, path, name, docker_file="Dockerfile", labels=None):
+        await self.env.run(self.build_command(path, name, docker_file, labels))
+        self.invalidate(("images", True), ("images", False))
+        return (await self.get_images(True))[name]
+
+    async def remove_image(self, name):
+        await self.env.run("docker rmi %s" % name)
+        self.invalidate(("images", True), ("images", False))
+
+    async def get_containers(self):
+        return await self._cached_async("containers", self._get_containers)
+
+    async def _get_containers(self):
+        container_ids = _parse_docker_list((await self.env.run(self.containers_command(), hide=True))["stdout"])
+        if not container_ids:
+            return {}
+        return self.parse_containers(
+            (await self.env.run("docker inspect %s" % " ".join(container_ids), hide=True))["stdout"]
+        )
+
+    async def add_container(self, image, name, privileged=False, network=None, expose=None, restart="always",
+                            volumes=None, envs=None, image_id=None, cmd=None, oneshot=False):
+        for env_name, env_value in (envs or {}).items():
+            self.env.add_env(env_name, env_value)
+        await self.env.run(self.container_command(
+            image, name, privileged=privileged, network=network, expose=expose, restart=restart, volumes=volumes,
+            envs=envs, image_id=image_id, cmd=cmd, oneshot=oneshot
+        ))
+        self.invalidate("containers", "ledger")
+
+    async def remove_container(self, name):
+        await self.stop_container(name)
+        await self.env.run("docker rm %s" % name)
+        self.invalidate("containers", "ledger")
+
+    async def stop_container(self, name):
+        await self.env.run("docker stop %s" % name)
+        self.invalidate("containers")
+
+    async def start_container(self, name):
+        await self.env.run("docker start %s" % name)
+        self.invalidate("containers")
+
+    async def restart_container(self, name):
+        await self.stop_container(name)
+        await self.start_container(name)
+
+    async def logs(self, name, tail=None):
+        async for line in follow_resumable_async(lambda **kwargs: self.follow_logs(name, **kwargs), tail):
+            print("\033[32m        - [%s] %s\033[0m" % (name, line))
+
+    async def follow_logs(self, name, tail=None, since_time=None):
+        async for line in self.env.stream(self.logs_command(name, tail, since_time)):
+            yield line
+
+    async def inspect(self, name):
+        await self.env.run("docker inspect %s" % name)
+
+    async def wipe(self):
+        snapshot = await self.get_snapshot()
+        for container in snapshot["containers"]:
+            await self.remove_container(container)
+        for image in await self.get_images():
+            await self.remove_image(image)
+        for volume in snapshot["volumes"]:
+            await self.remove_volume(volume)
+        for network in snapshot["networks"]:
+            await self.remove_network(network)
@@ -1,55 +1,255 @@
 import os
+import re
 import shlex
+import socket
+import tempfile
 from copy import copy
 from os import getcwd
+from select import select
 from subprocess import Popen, PIPE
-from threading import Thread
+from threading import Thread, Lock
+from uuid import uuid4
 
 from time import sleep
 
 from paramiko import SSHClient, AutoAddPolicy, RSAKey
 
+from deploy.stream import iter_lines, OutputBuffer, CHUNK_SIZE
+from deploy.tracing import span, traced, annotate
+from deploy.utils import run_parallel
+
+KEY_FILE = "root.pem"
+CONNECT_TIMEOUT = 10
+# Seconds between keepalives on idle connections, so NAT and firewalls do not drop them between tasks
+KEEPALIVE_INTERVAL = 30
+# Seconds the control master of external ssh commands (rsync) stays up after its last client
+CONTROL_PERSIST = 300
+CONTROL_PATH = os.path.join(tempfile.gettempdir(), "deploy-ssh-%C")
+
+_keys = {}
+_keys_lock = Lock()
+
+
+def load_key(path=KEY_FILE):
+    # Private keys are parsed once per process, not on every (re)connect
+    with _keys_lock:
+        if path not in _keys:
+            _keys[path] = RSAKey.from_private_key_file(path)
+        return _keys[path]
+
+
+def _pump(sock, channel):
+    # Copies data both ways between a local socket and an SSH channel until either side closes
+    try:
+        while True:
+            readable, _, _ = select([sock, channel], [], [])
+            if sock in readable:
+                data = sock.recv(CHUNK_SIZE)
+                if not data:
+                    break
+                channel.sendall(data)
+            if channel in readable:
+                data = channel.recv(CHUNK_SIZE)
+                if not data:
+                    break
+                sock.sendall(data)
+    finally:
+        channel.close()
+        sock.close()
+
+
+def _batch_command(command):
+    if isinstance(command, dict):
+        return command["cmd"], command.get("ignore_errors", False), command.get("hide")
+    return command, False, None
+
+
+def _batch_script(commands, cwd, marker, stop_on_error):
+    # Runs each command in a subshell from cwd, followed by a marker carrying its exit status on stdout and a bare
+    # marker on stderr, so output and status can be split back per command
+    script = []
+    for cmd, ignore_errors, _ in commands:
+        script.append("(cd %s; %s\n)" % (cwd, cmd))
+        script.append("__rc=$?; echo \"%s$__rc\"; echo \"%s\" >&2" % (marker, marker))
+        if stop_on_error and not ignore_errors:
+            script.append("[ $__rc -eq 0 ] || exit 0")
+    return "\n".join(script)
+
+
+def _batch_unfinished(commands, return_codes, stop_on_error):
+    # Index of the first command the batch did not report an exit status for, None when the batch ran to its end
+    # or stopped at a failed command
+    for i, return_code in enumerate(return_codes):
+        if return_code is None:
+            if i and stop_on_error and return_codes[i - 1] and not commands[i - 1][1]:
+                return None
+            return i
+    return None
+
+
+def _batch_results(commands, stdout_lines, stderr_lines, return_codes):
+    results = []
+    failed = None
+    for (cmd, ignore_errors, _), out, err, return_code in zip(commands, stdout_lines, stderr_lines, return_codes):
+        results.append({
+            "stdout": "\n".join(out),
+            "stderr": "\n".join(err),
+            "return_code": return_code
+        })
+        if return_code and not ignore_errors and not failed:
+            failed = (cmd, return_code)
+    if failed:
+        raise RuntimeError("Command %s failed with return code %s" % failed)
+    return results
+
+
+class BatchOutput:
+    # Splits one stream of a batch back into per command outputs at the markers, printing lines of commands that
+    # are not hidden. Only the stdout side gets return_codes and cmds, it announces each command as it starts.
+    def __init__(self, env, marker, outputs, hides, return_codes=None, cmds=None):
+        self.env = env
+        self.marker = marker
+        self.outputs = outputs
+        self.hides = hides
+        self.return_codes = return_codes
+        self.cmds = cmds
+        self.index = 0
+        self.announced = -1
+
+    def feed(self, line):
+        if self.cmds and self.announced < self.index < len(self.cmds):
+            self.announced = self.index
+            if not self.hides[self.index]:
+                print("\033[32m    - [%s:%s] Executing %s\033[0m" % (self.env.hostname, self.env.port, self.cmds[self.index]))
+        if self.marker in line:
+            head, tail = line.split(self.marker, 1)
+            if head and self.index < len(self.outputs):
+                self.outputs[self.index].append(head)
+            if self.return_codes is not None:
+                self.return_codes[self.index] = int(tail)
+            self.index += 1
+            return
+        if self.index >= len(self.outputs):
+            return
+        if not self.hides[self.index]:
+            print("\033[32m        - [%s:%s] %s\033[0m" % (self.env.hostname, self.env.port, line))
+        self.outputs[self.index].append(line)
+
+
+def annotate_rsync(result):
+    # Records the bytes rsync reports having sent on the current span
+    sent = re.search(r"sent ([\d,.]+) bytes", result["stdout"])
+    if sent:
+        annotate(bytes=int(re.sub(r"[,.]", "", sent.group(1))))
+
 
 class Environment:
-    def run(self, cmd, hide=False):
+    def run(self, cmd, hide=False, max_lines=None, max_bytes=None, stdin=None):
         raise NotImplementedError()
 
+    @traced("env")
+    def run_batch(self, commands, hide=False, stop_on_error=True):
+        # Fallback for environments without pipelining: one run per command.
+        # Commands are strings or dicts {"cmd": ..., "ignore_errors": bool, "hide": bool}
+        results = []
+        failed = None
+        for command in commands:
+            cmd, ignore_errors, cmd_hide = _batch_command(command)
+            if failed and stop_on_error:
+                results.append({"stdout": "", "stderr": "", "return_code": None})
+                continue
+            result = self.run(cmd, hide=hide if cmd_hide is None else cmd_hide)
+            results.append(result)
+            if result["return_code"] and not ignore_errors and not failed:
+                failed = (cmd, result["return_code"])
+        if failed:
+            raise RuntimeError("Command %s failed with return code %s" % failed)
+        return results
+
+    def connect(self):
+        # Opens the connection ahead of the first command, for environments that have one
+        pass
+
     def reboot(self):
         raise NotImplementedError()
 
     def cd(self, path):
         raise NotImplementedError()
 
+    def stream(self, cmd):
+        # Yields stdout lines of a long running cmd as they arrive; closing the generator terminates cmd
+        raise NotImplementedError()
+
+    def forward(self, remote_port, remote_host="127.0.0.1"):
+        # Returns a local port connected to remote_host:remote_port as seen from this environment
+        raise NotImplementedError()
+
+    def open_reader(self, cmd):
+        # Starts cmd and returns (read(size), wait() -> return code) for its stdout
+        raise NotImplementedError()
+
+    def open_writer(self, cmd):
+        # Starts cmd and returns (write(data), close() -> return code) for its stdin
+        raise NotImplementedError()
+
+    @traced("transfer")
+    def pipe_to(self, cmd, target, target_cmd, chunk_size=CHUNK_SIZE):
+        # Streams stdout of cmd here into stdin of target_cmd on target without buffering it anywhere
+        read, wait = self.open_reader(cmd)
+        write, close = target.open_writer(target_cmd)
+        transferred = 0
+        while True:
+            chunk = read(chunk_size)
+            if not chunk:
+                break
+            write(chunk)
+            transferred += len(chunk)
+        return_code, target_return_code = wait(), close()
+        if return_code or target_return_code:
+            raise RuntimeError("Piping %s into %s failed with return codes %s/%s" % (
+                cmd, target_cmd, return_code, target_return_code
+            ))
+        return transferred
+
 
 class LocalEnvironment(Environment):
     def __init__(self):
         self.cwd = getcwd()
         self._env = {}
 
-    def process_stream(self, stream, lines, hide=False):
-        for line in line_buffered(stream):
+    def process_stream(self, read, lines, hide=False):
+        for line in iter_lines(read):
             if not hide:
                 print("\033[36m        - [Local] %s\033[0m" % line)
             lines.append(line)
 
-    def run(self, cmd, hide=False):
+    @traced("local")
+    def run(self, cmd, hide=False, max_lines=None, max_bytes=None, stdin=None):
         if not hide:
             print("\033[36m    - [Local] Executing %s\033[0m" % cmd)
         _env = copy(os.environ)
         for key, value in self._env.items():
             _env[key] = str(value)
-        p = Popen(shlex.split(cmd), stdout=PIPE, stderr=PIPE, cwd=self.cwd, env=_env)
-        stdout_lines = []
-        stderr_lines = []
-        stdout_thread = Thread(target=self.process_stream, args=(p.stdout, stdout_lines, hide), daemon=True)
-        stderr_thread = Thread(target=self.process_stream, args=(p.stderr, stderr_lines, hide), daemon=True)
+        p = Popen(
+            shlex.split(cmd), stdin=PIPE if stdin is not None else None, stdout=PIPE, stderr=PIPE, cwd=self.cwd,
+            env=_env
+        )
+        stdout_lines = OutputBuffer(max_lines, max_bytes)
+        stderr_lines = OutputBuffer(max_lines, max_bytes)
+        stdout_thread = Thread(target=self.process_stream, args=(p.stdout.read1, stdout_lines, hide), daemon=True)
+        stderr_thread = Thread(target=self.process_stream, args=(p.stderr.read1, stderr_lines, hide), daemon=True)
         stdout_thread.start()
         stderr_thread.start()
+        if stdin is not None:
+            p.stdin.write(stdin.encode("utf8"))
+            p.stdin.close()
         stdout_thread.join()
         stderr_thread.join()
+        p.wait()
         return {
-            "stdout": "\n".join(stdout_lines),
-            "stderr": "\n".join(stderr_lines)
+            "stdout": stdout_lines.text(),
+            "stderr": stderr_lines.text(),
+            "return_code": p.returncode
         }
 
     def cd(self, path):
@@ -61,17 +261,33 @@ class LocalEnvironment(Environment):
     def add_env(self, key, value):
         self._env[key] = value
 
+    def stream(self, cmd):
+        p = Popen(shlex.split(cmd), stdout=PIPE, cwd=self.cwd)
+        try:
+            for line in iter_lines(p.stdout.read1):
+                yield line
+        finally:
+            if p.poll() is None:
+                p.kill()
+            p.wait()
+
+    def forward(self, remote_port, remote_host="127.0.0.1"):
+        return remote_port
+
+    def open_reader(self, cmd):
+        print("\033[36m    - [Local] Streaming from %s\033[0m" % cmd)
+        p = Popen(shlex.split(cmd), stdout=PIPE, cwd=self.cwd)
+        return p.stdout.read1, p.wait
+
+    def open_writer(self, cmd):
+        print("\033[36m    - [Local] Streaming into %s\033[0m" % cmd)
+        p = Popen(shlex.split(cmd), stdin=PIPE, cwd=self.cwd)
 
-def line_buffered(f):
-    line_buf = b""
-    while True:
-        chunk = f.read(1)
-        if not chunk:
-            break
-        line_buf += chunk
-        if line_buf.endswith(b"\n"):
-            yield line_buf.decode("utf8").strip()
-            line_buf = b""
+        def close():
+            p.stdin.close()
+            return p.wait()
+
+        return p.stdin.write, close
 
 
 class SSHEnvironment(Environment):
@@ -79,50 +295,137 @@ class SSHEnvironment(Environment):
         self.hostname = hostname
         self.port = port
         self._client = None
+        self._client_lock = Lock()
+        self._forwards = {}
+        self._forwards_lock = Lock()
         self.cwd = "/"
 
-    def process_stream(self, stream, lines, hide=False):
-        for line in line_buffered(stream):
+    def process_stream(self, read, lines, hide=False):
+        for line in iter_lines(read):
             if not hide:
                 print("\033[32m        - [%s:%s] %s\033[0m" % (self.hostname, self.port, line))
             lines.append(line)
 
-    def run(self, cmd, hide=False, ignore_errors=False):
+    @traced("ssh")
+    def run(self, cmd, hide=False, ignore_errors=False, max_lines=None, max_bytes=None, stdin=None):
         if not hide:
             print("\033[32m    - [%s:%s] Executing %s\033[0m" % (self.hostname, self.port, cmd))
         while True:
             try:
-                if not self._client:
-                    self._client = SSHClient()
-                    self._client.set_missing_host_key_policy(AutoAddPolicy())
-                    key = RSAKey.from_private_key_file("root.pem")
-                    self._client.connect(self.hostname, port=self.port, username="root", pkey=key)
-                stdin, stdout, stderr = self._client.exec_command("cd %s; %s; echo $?" % (self.cwd, cmd))
-                stdout_lines = []
-                stderr_lines = []
-                stdout_thread = Thread(target=self.process_stream, args=(stdout, stdout_lines, hide), daemon=True)
-                stderr_thread = Thread(target=self.process_stream, args=(stderr, stderr_lines, hide), daemon=True)
+                channel_stdin, stdout, stderr = self.get_client().exec_command(
+                    "cd %s; %s; echo $?" % (self.cwd, cmd)
+                )
+                # Keep one extra line so the trailing exit status survives the capture limit
+                stdout_lines = OutputBuffer(max_lines + 1 if max_lines is not None else None, max_bytes)
+                stderr_lines = OutputBuffer(max_lines, max_bytes)
+                stdout_thread = Thread(
+                    target=self.process_stream, args=(stdout.channel.recv, stdout_lines, hide), daemon=True
+                )
+                stderr_thread = Thread(
+                    target=self.process_stream, args=(stderr.channel.recv_stderr, stderr_lines, hide), daemon=True
+                )
                 stdout_thread.start()
                 stderr_thread.start()
+                if stdin is not None:
+                    channel_stdin.channel.sendall(stdin.encode("utf8"))
+                    channel_stdin.channel.shutdown_write()
                 stdout_thread.join()
                 stderr_thread.join()
                 try:
-                    return_code = int(stdout_lines[-1])
+                    return_code = int(stdout_lines.pop())
                 except Exception:
                     return_code = -1
                 if not ignore_errors and return_code:
                     raise RuntimeError("Return code is %s" % return_code)
                 return {
-                    "stdout": "\n".join(stdout_lines[:-1]),
-                    "stderr": "\n".join(stderr_lines)
+                    "stdout": stdout_lines.text(),
+                    "stderr": stderr_lines.text(),
+                    "return_code": return_code
                 }
             except RuntimeError:
                 raise
             except Exception as e:
-                print("\033[31m%s\033[0m" % e)
+                self.reset_client(e)
+
+    def get_client(self):
+        # Threads of a task share the connection, only the first one to need it connects
+        with self._client_lock:
+            if not self._client:
+                client = SSHClient()
+                client.set_missing_host_key_policy(AutoAddPolicy())
+                with span("connect", "ssh", host=self.hostname):
+                    client.connect(
+                        self.hostname, port=self.port, username="root", pkey=load_key(), timeout=CONNECT_TIMEOUT
+                    )
+                client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+                self._client = client
+            return self._client
+
+    def connect(self):
+        self.get_client()
+
+    def reset_client(self, error):
+        print("\033[31m%s\033[0m" % error)
+        with self._client_lock:
+            if self._client:
                 self._client.close()
-                self._client = None
-                sleep(1)
+            self._client = None
+        sleep(1)
+
+    def process_batch_stream(self, read, marker, outputs, hides, return_codes=None, cmds=None):
+        output = BatchOutput(self, marker, outputs, hides, return_codes, cmds)
+        for line in iter_lines(read):
+            output.feed(line)
+
+    @traced("ssh")
+    def run_batch(self, commands, hide=False, stop_on_error=True):
+        # Runs every command over a single exec channel, see _batch_script
+        commands = [_batch_command(command) for command in commands]
+        if not commands:
+            return []
+        cmds = [cmd for cmd, _, _ in commands]
+        hides = [hide if cmd_hide is None else cmd_hide for _, _, cmd_hide in commands]
+        marker = "__DEPLOY_BATCH_%s__" % uuid4().hex
+        stdout_lines = [[] for _ in commands]
+        stderr_lines = [[] for _ in commands]
+        return_codes = [None for _ in commands]
+        start = 0
+
+        while True:
+            # After a dropped connection the batch resumes from the first command without an exit status, the
+            # commands that finished are not run again
+            try:
+                stdin, stdout, stderr = self.get_client().exec_command(
+                    _batch_script(commands[start:], self.cwd, marker, stop_on_error)
+                )
+                for i in range(start, len(commands)):
+                    stdout_lines[i], stderr_lines[i] = [], []
+                codes = [None for _ in commands[start:]]
+                stdout_thread = Thread(
+                    target=self.process_batch_stream,
+                    args=(stdout.channel.recv, marker, stdout_lines[start:], hides[start:], codes, cmds[start:]),
+                    daemon=True
+                )
+                stderr_thread = Thread(
+                    target=self.process_batch_stream,
+                    args=(stderr.channel.recv_stderr, marker, stderr_lines[start:], hides[start:]),
+                    daemon=True
+                )
+                stdout_thread.start()
+                stderr_thread.start()
+                stdout_thread.join()
+                stderr_thread.join()
+            except Exception as e:
+                self.reset_client(e)
+                continue
+            return_codes[start:] = codes
+            start = _batch_unfinished(commands, return_codes, stop_on_error)
+            if start is None:
+                break
+            if stdout.channel.exit_status_ready():
+                raise RuntimeError("Batch ended before command %s" % cmds[start])
+            self.reset_client("Connection lost, resuming the batch from %s" % cmds[start])
+        return _batch_results(commands, stdout_lines, stderr_lines, return_codes)
 
     def reboot(self):
         up_since = self.run("uptime -s", hide=True)["stdout"]
@@ -137,35 +440,114 @@ class SSHEnvironment(Environment):
         else:
             self.cwd = path
 
-    def sync(self, local_dir, remote_dir, exclude, delete):
+    @traced("rsync")
+    def sync(self, local_dir, remote_dir, exclude, delete, relative=False):
+        # local_dir may be a list of paths; with relative=True they keep their relative path under remote_dir
         local_env = LocalEnvironment()
-        local_env.run(
-            "rsync -v -a -r -e \"ssh -iroot.pem -oStrictHostKeyChecking=no -p%s\" %s%s%s root@%s:%s" % (
-                self.port,
-                "--delete " if delete else "",
-                " ".join(["--exclude=%s" % x for x in exclude]) + " ",
-                local_dir,
-                self.hostname,
-                remote_dir
-            )
+        result = local_env.run(self.rsync_command(local_dir, remote_dir, exclude, delete, relative))
+        annotate_rsync(result)
+
+    def ssh_command(self):
+        # ssh command line for external tools. Their sessions to this host share one authenticated master
+        # connection through a control socket, so only the first one pays for a handshake.
+        return "ssh -i%s -oStrictHostKeyChecking=no -oControlMaster=auto -oControlPath=%s -oControlPersist=%s " \
+               "-oServerAliveInterval=%s -p%s" % (KEY_FILE, CONTROL_PATH, CONTROL_PERSIST, KEEPALIVE_INTERVAL, self.port)
+
+    def rsync_command(self, local_dir, remote_dir, exclude, delete, relative=False):
+        return "rsync -v -a -r -e \"%s\" %s%s%s%s root@%s:%s" % (
+            self.ssh_command(),
+            "--delete " if delete else "",
+            "--relative " if relative else "",
+            " ".join(["--exclude=%s" % x for x in exclude]) + " ",
+            local_dir if isinstance(local_dir, str) else " ".join(local_dir),
+            self.hostname,
+            remote_dir
         )
 
+    def stream(self, cmd):
+        channel = self.get_client().get_transport().open_session()
+        channel.exec_command("cd %s; %s" % (self.cwd, cmd))
+        try:
+            for line in iter_lines(channel.recv):
+                yield line
+        finally:
+            channel.close()
+
+    def forward(self, remote_port, remote_host="127.0.0.1"):
+        # Listens on a local port and tunnels every accepted connection through a direct-tcpip channel of this
+        # connection. The listener lives as long as the process, one per remote address.
+        with self._forwards_lock:
+            if (remote_host, remote_port) not in self._forwards:
+                server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                server.bind(("127.0.0.1", 0))
+                server.listen(16)
+                Thread(target=self._accept_forwarded, args=(server, remote_host, remote_port), daemon=True).start()
+                self._forwards[remote_host, remote_port] = server.getsockname()[1]
+            return self._forwards[remote_host, remote_port]
+
+    def _accept_forwarded(self, server, remote_host, remote_port):
+        while True:
+            sock, address = server.accept()
+            try:
+                channel = self.get_client().get_transport().open_channel(
+                    "direct-tcpip", (remote_host, remote_port), address
+                )
+            except Exception as e:
+                print("\033[31mForwarding to %s:%s failed: %s\033[0m" % (remote_host, remote_port, e))
+                sock.close()
+                continue
+            Thread(target=_pump, args=(sock, channel), daemon=True).start()
+
+    def open_reader(self, cmd):
+        print("\033[32m    - [%s:%s] Streaming from %s\033[0m" % (self.hostname, self.port, cmd))
+        channel = self.get_client().get_transport().open_session()
+        channel.exec_command("cd %s; %s" % (self.cwd, cmd))
+        # stderr is drained on the side, a full stderr window would otherwise stall the command and the pipe
+        Thread(target=self.process_stream, args=(channel.recv_stderr, []), daemon=True).start()
+        return channel.recv, channel.recv_exit_status
+
+    def open_writer(self, cmd):
+        print("\033[32m    - [%s:%s] Streaming into %s\033[0m" % (self.hostname, self.port, cmd))
+        channel = self.get_client().get_transport().open_session()
+        channel.exec_command("cd %s; %s" % (self.cwd, cmd))
+        Thread(target=self.process_stream, args=(channel.recv, []), daemon=True).start()
+        Thread(target=self.process_stream, args=(channel.recv_stderr, []), daemon=True).start()
+
+        def close():
+            channel.shutdown_write()
+            return channel.recv_exit_status()
+
+        return channel.sendall, close
+
     def put(self, data, path):
-        sftp = self._client.open_sftp()
-        fd = sftp.file(path, "wb")
-        fd.write(data)
-        fd.close()
+        with span("put", "sftp", host=self.hostname, detail=path, bytes=len(data)):
+            sftp = self.get_client().open_sftp()
+            fd = sftp.file(path, "wb")
+            fd.write(data)
+            fd.close()
 
 
 class EnvironmentFactory:
     _remotes = {}
+    _remotes_lock = Lock()
 
     @classmethod
     def get_remote(cls, hostname, port=22):
-        if (hostname, port) not in cls._remotes.keys():
-            cls._remotes[hostname, port] = SSHEnvironment(hostname, port)
-        return cls._remotes[hostname, port]
+        # Locked, warm() asks for every host from its own thread and each host must get a single connection
+        with cls._remotes_lock:
+            if (hostname, port) not in cls._remotes.keys():
+                cls._remotes[hostname, port] = SSHEnvironment(hostname, port)
+            return cls._remotes[hostname, port]
 
     @staticmethod
     def get_local():
         return LocalEnvironment()
+
+    @classmethod
+    def warm(cls, hosts, jobs=None):
+        # Connects to every (hostname, port) at once at the start of a task instead of one by one on first use.
+        # Hosts that cannot be reached yet (e.g. still booting) are left to connect when first used.
+        hosts = list(dict.fromkeys(hosts))
+        _, errors = run_parallel(lambda host: cls.get_remote(*host).connect(), hosts, jobs)
+        for (hostname, port), error in errors.items():
+            print("\033[33mConnecting to %s:%s failed, retrying on first use: %s\033[0m" % (hostname, port, error))
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import time
+from threading import Lock
+
+
+FACTS_FILE = ".deploy/facts.json"
+
+
+def _flag(test):
+    return "%s >/dev/null 2>&1 && echo true || echo false" % test
+
+
+# Everything bootstrapping needs to know about a host, collected by a single command as key=value lines
+FACTS = (
+    ("hostname", "hostname"),
+    ("cloud_init", _flag("test ! -d /var/lib/cloud/instance -o -e /var/lib/cloud/instance/boot-finished")),
+    ("software_properties", _flag("dpkg -s software-properties-common")),
+    ("curl", _flag("command -v curl")),
+    ("docker", _flag("command -v docker")),
+    ("kubeadm", _flag("command -v kubeadm")),
+    ("kube", _flag("stat ~/.kube")),
+    ("kube_slave", _flag("stat ~/.kube_slave"))
+)
+GATHER_FACTS_CMD = "; ".join("echo \"%s=$(%s)\"" % (key, cmd) for key, cmd in FACTS)
+
+
+def gather_facts(env):
+    while True:
+        facts = {}
+        for line in env.run(GATHER_FACTS_CMD, hide=True)["stdout"].split("\n"):
+            if "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            facts[key] = {"true": True, "false": False}.get(value, value)
+        if facts["cloud_init"]:
+            return facts
+        print("Still waiting for cloud-init on %s" % env.hostname)
+        time.sleep(5)
+
+
+def recipe_hash(*parts):
+    return hashlib.md5(json.dumps(parts, sort_keys=True).encode("utf8")).hexdigest()
+
+
+class HostFacts:
+    def __init__(self, path=FACTS_FILE, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self._lock = Lock()
+        try:
+            with open(path) as fd:
+                self._hosts = json.load(fd)
+        except (IOError, ValueError):
+            self._hosts = {}
+
+    def get(self, instance, recipe):
+        entry = self._hosts.get(str(instance))
+        if (
+            not entry or
+            entry["public_ip"] != instance.public_ip or
+            entry["recipe"] != recipe or
+            time.time() - entry["updated_at"] > self.ttl
+        ):
+            return None
+        return entry["facts"]
+
+    def set(self, instance, recipe, facts):
+        with self._lock:
+            self._hosts[str(instance)] = {
+                "public_ip": instance.public_ip,
+                "recipe": recipe,
+                "updated_at": time.time(),
+                "facts": facts
+            }
+            self._save()
+
+    def invalidate(self, instance):
+        with self._lock:
+            if self._hosts.pop(str(instance), None) is not None:
+                self._save()
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + ".tmp", "w") as fd:
+            json.dump(self._hosts, fd, indent=2, sort_keys=True)
+        os.rename(self.path + ".tmp", self.path)
@@ -0,0 +1,327 @@
+import json
+import http.client
+from queue import LifoQueue, Empty
+from threading import Lock
+from time import sleep
+from urllib.parse import urlencode
+
+from deploy.kube_manager import KubeManager, _pod_entry, _pod_state, _ledger_entry
+from deploy.spec import HASH_LABEL, stamp
+from deploy.stream import iter_lines
+from deploy.tracing import trace_methods, span
+
+
+KUBE_PROXY_PORT = 8001
+# Stands for the client's timeout, None is a valid timeout of its own
+_DEFAULT_TIMEOUT = object()
+KINDS = {
+    "Pod": "pods",
+    "Service": "services",
+    "Namespace": "namespaces",
+    "Event": "events"
+}
+
+
+class KubeApiError(Exception):
+    def __init__(self, method, path, status, body):
+        super().__init__("%s %s returned %s: %s" % (method, path, status, body))
+        self.status = status
+        self.body = body
+
+
+class KubeApiClient:
+    # Minimal JSON client for the kubernetes API. Keep-alive connections are pooled and reused across requests and
+    # threads; watches and log streams take a connection of their own since they hold it until the stream ends.
+    def __init__(self, host, port, pool_size=8, timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._pool = LifoQueue(maxsize=pool_size)
+
+    def _connect(self, timeout=_DEFAULT_TIMEOUT):
+        # timeout=None leaves the socket blocking, a quiet watch or log follow may go on for as long as it needs
+        if timeout is _DEFAULT_TIMEOUT:
+            timeout = self.timeout
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _release(self, connection, response):
+        if response.will_close:
+            connection.close()
+            return
+        try:
+            self._pool.put_nowait(connection)
+        except Exception:
+            connection.close()
+
+    def _url(self, path, params=None):
+        params = {key: value for key, value in (params or {}).items() if value is not None}
+        return path + ("?" + urlencode(params) if params else "")
+
+    def request(self, method, path, params=None, body=None, content_type="application/json"):
+        url = self._url(path, params)
+        data = json.dumps(body) if body is not None else None
+        headers = {"Accept": "application/json"}
+        if data is not None:
+            headers["Content-Type"] = content_type
+        with span(method, "http", host=self.host, detail=url) as current:
+            for attempt in range(2):
+                try:
+                    connection = self._pool.get_nowait()
+                except Empty:
+                    connection = self._connect()
+                try:
+                    connection.request(method, url, body=data, headers=headers)
+                    response = connection.getresponse()
+                    payload = response.read()
+                except (http.client.HTTPException, OSError):
+                    connection.close()
+                    # A pooled connection may have been dropped by the server while idle, retry once on a fresh one
+                    if attempt:
+                        raise
+                    continue
+                self._release(connection, response)
+                current["status"] = response.status
+                current["bytes"] = len(payload)
+                if response.status >= 400:
+                    raise KubeApiError(method, url, response.status, payload.decode("utf8", errors="replace"))
+                return json.loads(payload.decode("utf8")) if payload else None
+
+    def get(self, path, **params):
+        return self.request("GET", path, params)
+
+    def create(self, path, body):
+        return self.request("POST", path, body=body)
+
+    def patch(self, path, body, content_type="application/merge-patch+json", **params):
+        return self.request("PATCH", path, params, body=body, content_type=content_type)
+
+    def delete(self, path, **params):
+        return self.request("DELETE", path, params)
+
+    def stream(self, path, **params):
+        # Yields the response body line by line as it arrives
+        connection = self._connect(timeout=None)
+        url = self._url(path, params)
+        try:
+            connection.request("GET", url)
+            response = connection.getresponse()
+            if response.status >= 400:
+                raise KubeApiError("GET", url, response.status, response.read().decode("utf8", errors="replace"))
+            for line in iter_lines(response.read1):
+                yield line
+        finally:
+            connection.close()
+
+    def watch(self, path, **params):
+        # Yields (event type, object) for every change of the listed objects
+        params["watch"] = "true"
+        for line in self.stream(path, **params):
+            if line:
+                event = json.loads(line)
+                yield event["type"], event["object"]
+
+
+def get_object_path(kind, namespace=None, name=None):
+    path = "/api/v1"
+    if namespace and kind != "Namespace":
+        path += "/namespaces/%s" % namespace
+    path += "/%s" % KINDS[kind]
+    if name:
+        path += "/%s" % name
+    return path
+
+
+_clients = {}
+_clients_lock = Lock()
+
+
+def get_api_client(env):
+    # One client per root instance: `kubectl proxy` is started there if it is not running yet and reached through
+    # a port forward over the instance's SSH connection
+    key = (getattr(env, "hostname", "local"), getattr(env, "port", None))
+    with _clients_lock:
+        if key not in _clients:
+            env.run(
+                "pgrep -f \"kubectl proxy --port=%s\" >/dev/null || "
+                "(nohup kubectl proxy --port=%s >/dev/null 2>&1 &)" % (KUBE_PROXY_PORT, KUBE_PROXY_PORT),
+                hide=True
+            )
+            client = KubeApiClient("127.0.0.1", env.forward(KUBE_PROXY_PORT))
+            for attempt in range(30):
+                try:
+                    client.get("/version")
+                    break
+                except (KubeApiError, OSError, http.client.HTTPException):
+                    if attempt == 29:
+                        raise
+                    sleep(1)
+            _clients[key] = client
+        return _clients[key]
+
+
+@trace_methods("kube")
+class KubeApiManager(KubeManager):
+    # KubeManager that talks to the API server instead of running kubectl. Manifests are shared with KubeManager,
+    # only the calls reaching the cluster differ.
+    def __init__(self, stack, env):
+        super().__init__(stack, env)
+        self.api = get_api_client(env)
+
+    def _query_pods(self, namespace=None, selector=None):
+        items = self.api.get(
+            get_object_path("Pod", namespace), labelSelector=selector
+        )["items"]
+        res = {}
+        for item in items:
+            metadata = item["metadata"]
+            spec_containers = item["spec"]["containers"]
+            statuses = (item.get("status") or {}).get("containerStatuses") or [{}]
+            res["%s.%s" % (metadata["name"], metadata["namespace"])] = _pod_entry(
+                metadata["namespace"],
+                metadata["name"],
+                metadata["resourceVersion"],
+                (metadata.get("labels") or {}).get(HASH_LABEL, ""),
+                spec_containers[0]["image"] if spec_containers else "",
+                (item.get("status") or {}).get("phase", ""),
+                statuses[0].get("imageID", ""),
+                statuses[0].get("ready", False)
+            )
+        return res
+
+    def watch_pods(self, namespace, names, timeout):
+        selector = "name in (%s)" % ",".join(sorted(name.rsplit(".", 1)[0] for name in names))
+        for _, item in self.api.watch(get_object_path("Pod", namespace), labelSelector=selector, timeoutSeconds=timeout):
+            metadata = item["metadata"]
+            status = item.get("status") or {}
+            conditions = {condition["type"]: condition for condition in status.get("conditions") or []}
+            container_status = (status.get("containerStatuses") or [{}])[0]
+            state = container_status.get("state") or {}
+            yield _pod_state(
+                metadata["namespace"],
+                metadata["name"],
+                metadata.get("creationTimestamp", ""),
+                metadata.get("deletionTimestamp", ""),
+                status.get("phase", ""),
+                conditions.get("PodScheduled", {}).get("status", ""),
+                conditions.get("PodScheduled", {}).get("lastTransitionTime", ""),
+                conditions.get("Ready", {}).get("status", ""),
+                conditions.get("Ready", {}).get("lastTransitionTime", ""),
+                (state.get("running") or {}).get("startedAt", ""),
+                (state.get("waiting") or {}).get("reason", ""),
+                (state.get("terminated") or {}).get("reason", ""),
+                str(container_status.get("restartCount", 0))
+            )
+
+    def get_events(self, namespace, name=None):
+        try:
+            items = self.api.get(
+                get_object_path("Event", namespace),
+                fieldSelector=("involvedObject.name=%s" % name.rsplit(".", 1)[0]) if name else None
+            )["items"]
+        except KubeApiError as e:
+            print("\033[31m%s\033[0m" % e)
+            return []
+        return [
+            {
+                "name": "%s.%s" % (item["involvedObject"]["name"], namespace),
+                "first": item.get("firstTimestamp") or "",
+                "last": item.get("lastTimestamp") or "",
+                "type": item.get("type", ""),
+                "reason": item.get("reason", ""),
+                "message": item.get("message", "")
+            }
+            for item in items
+        ]
+
+    def get_ledger(self, namespace, selector=None):
+        ledger = {}
+        for kind in ("Pod", "Service"):
+            for item in self.api.get(get_object_path(kind, namespace), labelSelector=selector)["items"]:
+                metadata = item["metadata"]
+                ledger[(kind, "%s.%s" % (metadata["name"], namespace))] = _ledger_entry(
+                    (metadata.get("labels") or {}).get(HASH_LABEL),
+                    (metadata.get("annotations") or {}).get("services")
+                )
+        return ledger
+
+    def get_snapshot(self, namespace):
+        try:
+            self.api.get(get_object_path("Namespace", None, namespace))
+        except KubeApiError as e:
+            if e.status == 404:
+                return {"namespace": False, "ledger": {}}
+            raise
+        return {"namespace": True, "ledger": self.get_ledger(namespace)}
+
+    def apply(self, objects, replace=None):
+        # Server-side apply of every object; objects in `replace` are deleted first, as with KubeManager.apply
+        for kind, name, namespace in replace or []:
+            self.delete(kind, name, namespace)
+        for item in objects:
+            stamp(item)
+            print("\033[32m    - [%s] Applying %s %s/%s\033[0m" % (
+                getattr(self.env, "hostname", "Local"), item["kind"], item["metadata"].get("namespace"), item["metadata"]["name"]
+            ))
+            self.api.patch(
+                get_object_path(item["kind"], item["metadata"].get("namespace"), item["metadata"]["name"]),
+                item,
+                content_type="application/apply-patch+yaml",
+                fieldManager="deploy",
+                force="true"
+            )
+
+    def delete(self, kind, name, namespace=None, wait=False):
+        # Returns once the object is gone if wait is set, like `kubectl delete` does
+        try:
+            item = self.api.delete(get_object_path(kind, namespace, name))
+        except KubeApiError as e:
+            if e.status == 404:
+                return
+            raise
+        if not wait:
+            return
+        resource_version = ((item or {}).get("metadata") or {}).get("resourceVersion")
+        if not resource_version:
+            # A Status comes back instead of the object when it was removed right away, check whether it is gone
+            try:
+                resource_version = self.api.get(get_object_path(kind, namespace, name))["metadata"]["resourceVersion"]
+            except KubeApiError as e:
+                if e.status == 404:
+                    return
+                raise
+        for event_type, _ in self.api.watch(
+            get_object_path(kind, namespace),
+            fieldSelector="metadata.name=%s" % name,
+            resourceVersion=resource_version
+        ):
+            if event_type == "DELETED":
+                return
+
+    def label_container(self, container, key, value):
+        try:
+            self.api.patch(
+                get_object_path("Pod", container.rsplit(".", 1)[1], container.rsplit(".", 1)[0]),
+                {"metadata": {"labels": {key: value}}}
+            )
+        except KubeApiError as e:
+            print("\033[31m%s\033[0m" % e)
+
+    def set_services(self, container, services, previous=None):
+        labels = {"service-%s" % x.rsplit(".", 1)[0]: "true" for x in services}
+        labels.update({"service-%s" % x.rsplit(".", 1)[0]: None for x in previous or [] if x not in services})
+        self.api.patch(
+            get_object_path("Pod", container.rsplit(".", 1)[1], container.rsplit(".", 1)[0]),
+            {"metadata": {"labels": labels, "annotations": {"services": ",".join(sorted(services))}}}
+        )
+
+    def follow_logs(self, service, tail=100, since_time=None):
+        params = {"sinceTime": since_time} if since_time else {"tailLines": tail}
+        return self.api.stream(
+            get_object_path("Pod", service.rsplit(".", 1)[1], service.rsplit(".", 1)[0]) + "/log",
+            follow="true",
+            timestamps="true",
+            **params
+        )
+
+    def stop(self, service):
+        self.delete("Pod", service.rsplit(".", 1)[0], service.rsplit(".", 1)[1], wait=True)
@@ -2,34 +2,240 @@ import json
 import shlex
 import hashlib
 
-from time import sleep
+from deploy.logs import follow_resumable, follow_resumable_async
+from deploy.spec import HASH_LABEL, object_hash, stamp
+from deploy.tracing import trace_methods
 
-from copy import copy
 
+POD_FIELDS = (
+    "{.metadata.namespace}",
+    "{.metadata.name}",
+    "{.metadata.resourceVersion}",
+    "{.metadata.labels.spec-hash}",
+    "{.spec.containers[0].image}",
+    "{.status.phase}",
+    "{.status.containerStatuses[*].imageID}",
+    "{.status.containerStatuses[*].ready}"
+)
+POD_JSONPATH = "{range .items[*]}%s{\"\\n\"}{end}" % "{\"\\t\"}".join(POD_FIELDS)
+ROLLOUT_FIELDS = (
+    "{.metadata.namespace}",
+    "{.metadata.name}",
+    "{.metadata.creationTimestamp}",
+    "{.metadata.deletionTimestamp}",
+    "{.status.phase}",
+    "{.status.conditions[?(@.type==\"PodScheduled\")].status}",
+    "{.status.conditions[?(@.type==\"PodScheduled\")].lastTransitionTime}",
+    "{.status.conditions[?(@.type==\"Ready\")].status}",
+    "{.status.conditions[?(@.type==\"Ready\")].lastTransitionTime}",
+    "{.status.containerStatuses[*].state.running.startedAt}",
+    "{.status.containerStatuses[*].state.waiting.reason}",
+    "{.status.containerStatuses[*].state.terminated.reason}",
+    "{.status.containerStatuses[*].restartCount}"
+)
+ROLLOUT_JSONPATH = "%s{\"\\n\"}" % "{\"\\t\"}".join(ROLLOUT_FIELDS)
+EVENT_JSONPATH = (
+    "{range .items[*]}{.involvedObject.name}{\"\\t\"}{.firstTimestamp}{\"\\t\"}{.lastTimestamp}{\"\\t\"}{.type}{\"\\t\"}"
+    "{.reason}{\"\\t\"}{.message}{\"\\n\"}{end}"
+)
+LEDGER_FIELDS = (
+    "{.kind}",
+    "{.metadata.name}",
+    "{.metadata.labels.spec-hash}",
+    "{.metadata.annotations.services}"
+)
+LEDGER_JSONPATH = "{range .items[*]}%s{\"\\n\"}{end}" % "{\"\\t\"}".join(LEDGER_FIELDS)
 
+
+def _first(value):
+    # containerStatuses[*] fields hold one space separated value per container, none while the pod is pending
+    return value.split(" ")[0] or None
+
+
+def _pod_entry(namespace, name, resource_version, spec_hash, image, phase, image_id, ready):
+    # The subset of a pod deploy looks at, in the layout of the kubernetes pod object
+    return {
+        "image": image,
+        "metadata": {
+            "name": name,
+            "namespace": namespace,
+            "resourceVersion": resource_version,
+            "labels": {HASH_LABEL: spec_hash} if spec_hash else {}
+        },
+        "status": {
+            "phase": phase,
+            "imageID": image_id,
+            "ready": ready
+        } if image_id else None
+    }
+
+
+def _pod_state(namespace, name, created, deleted, phase, scheduled, scheduled_at, ready, ready_at, started_at, waiting,
+               terminated, restarts):
+    # What the rollout watcher follows of a pod, timestamps as returned by the API server
+    return {
+        "name": "%s.%s" % (name, namespace),
+        "created": created,
+        "deleted": deleted,
+        "phase": phase,
+        "scheduled": scheduled_at if scheduled == "True" else None,
+        "ready": ready_at if ready == "True" else None,
+        "started": _first(started_at),
+        "waiting": _first(waiting),
+        "terminated": _first(terminated),
+        "restarts": sum(int(x) for x in restarts.split())
+    }
+
+
+def _ledger_entry(spec_hash, services):
+    # The hash an object was last applied with and, for pods, the stack services it is labelled for
+    return {
+        "hash": spec_hash or None,
+        "services": sorted(x for x in (services or "").split(",") if x)
+    }
+
+
+def _parse_pods(data):
+    res = {}
+    for line in data.split("\n"):
+        if not line.strip():
+            continue
+        namespace, name, resource_version, spec_hash, image, phase, image_id, ready = (line.split("\t") + [""] * 8)[:8]
+        res["%s.%s" % (name, namespace)] = _pod_entry(
+            namespace, name, resource_version, spec_hash, image, phase, _first(image_id),
+            bool(ready) and all(x == "true" for x in ready.split())
+        )
+    return res
+
+
+def get_kube_manager(stack, env):
+    # kube_backend selects how the cluster is driven: "kubectl" runs kubectl over SSH, "api" talks to the API
+    # server through a tunnel to `kubectl proxy`
+    backend = stack.vars.get("kube_backend", "kubectl")
+    if backend == "kubectl":
+        return KubeManager(stack, env)
+    elif backend == "api":
+        from deploy.kube_api import KubeApiManager
+        return KubeApiManager(stack, env)
+    raise ValueError("Unknown kube_backend %s, expected kubectl or api" % backend)
+
+
+@trace_methods("kube")
 class KubeManager:
+    # Pod queries are scoped by namespace and label selector and only fetch the fields deploy needs
     def __init__(self, stack, env):
         self.stack = stack
         self.env = env
 
-    def get_containers(self):
-        result = json.loads(self.env.run("kubectl get pods --all-namespaces -o json", hide=True)["stdout"])
+    def _query_pods(self, namespace=None, selector=None):
+        return _parse_pods(self.env.run(self.pods_command(namespace, selector), hide=True)["stdout"])
+
+    def pods_command(self, namespace=None, selector=None):
+        cmd = "kubectl get pods %s -o jsonpath='%s'" % (
+            ("--namespace=%s" % namespace) if namespace else "--all-namespaces",
+            POD_JSONPATH
+        )
+        if selector:
+            cmd += " -l '%s'" % selector
+        return cmd
+
+    def get_containers(self, namespace=None, selector=None):
+        return self._query_pods(namespace, selector)
+
+    def watch_pods(self, namespace, names, timeout):
+        # Yields a _pod_state for the current state of every pod in `names` and then for each change, until timeout
+        for line in self.env.stream(self.watch_command(namespace, names, timeout)):
+            if line.strip():
+                yield _pod_state(*(line.split("\t") + [""] * 13)[:13])
 
-        res = {}
-        for item in result["items"]:
-            name = "%s.%s" % (item["metadata"]["name"], item["metadata"]["namespace"])
-            res[name] = copy(item["spec"]["containers"][0])
-            res[name]["metadata"] = copy(item["metadata"])
-            if "containerStatuses" in item["status"]:
-                res[name]["status"] = copy(item["status"]["containerStatuses"][0])
-            else:
-                res[name]["status"] = None
+    def watch_command(self, namespace, names, timeout):
+        selector = "name in (%s)" % ",".join(sorted(name.rsplit(".", 1)[0] for name in names))
+        return "timeout %d kubectl get pods --namespace=%s -l '%s' --watch -o jsonpath='%s'" % (
+            timeout, namespace, selector, ROLLOUT_JSONPATH
+        )
+
+    def get_events(self, namespace, name=None):
+        # Events of the namespace, or only those about pod `name`
+        return self.parse_events(
+            namespace, self.env.run(self.events_command(namespace, name), hide=True, ignore_errors=True)["stdout"]
+        )
 
+    def events_command(self, namespace, name=None):
+        cmd = "kubectl get events --namespace=%s -o jsonpath='%s'" % (namespace, EVENT_JSONPATH)
+        if name:
+            cmd += " --field-selector involvedObject.name=%s" % name.rsplit(".", 1)[0]
+        return cmd
+
+    def parse_events(self, namespace, data):
+        res = []
+        for line in data.split("\n"):
+            if line.strip():
+                pod, first, last, event_type, reason, message = (line.split("\t", 5) + [""] * 6)[:6]
+                res.append({
+                    "name": "%s.%s" % (pod, namespace),
+                    "first": first,
+                    "last": last,
+                    "type": event_type,
+                    "reason": reason,
+                    "message": message
+                })
         return res
 
-    def add_container(self, image, name, instance, privileged=False, network=None, expose=None, restart="always", volumes=None,
-                      envs=None, nonce=None, host_network=False, mem_limit=None, oneshot=False, cmd=None, service=None):
-        #env.run("kubectl label nodes %s node=%s" % (instance, instance))
+    def get_ledger(self, namespace, selector=None):
+        # {(kind, name): ledger entry} of the pods and services in a namespace, or of those matching selector
+        return self._parse_ledger(namespace, self.env.run(self.ledger_command(namespace, selector), hide=True)["stdout"])
+
+    def ledger_command(self, namespace, selector=None):
+        cmd = "kubectl get pods,services --namespace=%s -o jsonpath='%s'" % (namespace, LEDGER_JSONPATH)
+        if selector:
+            cmd += " -l '%s'" % selector
+        return cmd
+
+    def _parse_ledger(self, namespace, data):
+        ledger = {}
+        for line in data.split("\n"):
+            if line.strip():
+                kind, name, spec_hash, services = (line.split("\t") + [""] * 4)[:4]
+                ledger[(kind, "%s.%s" % (name, namespace))] = _ledger_entry(spec_hash, services)
+        return ledger
+
+    def get_snapshot(self, namespace):
+        # Whether the namespace exists and its ledger, in one round trip
+        return self.parse_snapshot(namespace, self.env.run_batch(
+            self.snapshot_commands(namespace), hide=True, stop_on_error=False
+        ))
+
+    def snapshot_commands(self, namespace):
+        return [
+            {"cmd": "kubectl get namespace %s -o name" % namespace, "ignore_errors": True},
+            self.ledger_command(namespace)
+        ]
+
+    def parse_snapshot(self, namespace, results):
+        namespace_result, ledger_result = results
+        if namespace_result["return_code"]:
+            return {"namespace": False, "ledger": {}}
+        return {"namespace": True, "ledger": self._parse_ledger(namespace, ledger_result["stdout"])}
+
+    def apply(self, objects, replace=None):
+        # Applies all objects as one v1 List streamed to `kubectl apply -f -`. `replace` lists (kind, name, namespace)
+        # objects deleted first in the same command, for objects whose fields must not be merged.
+        if not objects:
+            return
+        cmd, stdin = self.apply_command(objects, replace)
+        self.env.run(cmd, stdin=stdin)
+
+    def apply_command(self, objects, replace=None):
+        # (command, stdin) applying the stamped objects
+        for item in objects:
+            stamp(item)
+        cmd = "kubectl apply -f -"
+        for kind, name, namespace in replace or []:
+            cmd = "kubectl delete %s %s --namespace=%s --ignore-not-found && %s" % (kind.lower(), name, namespace, cmd)
+        return cmd, json.dumps({"apiVersion": "v1", "kind": "List", "items": objects})
+
+    def get_pod_manifest(self, image, name, instance, privileged=False, envs=None, image_id=None, host_network=False,
+                         mem_limit=None, oneshot=False, cmd=None, service=None, volumes=None, services=None):
         desc = {
             "kind": "Pod",
             "apiVersion": "v1",
@@ -81,8 +287,14 @@ class KubeManager:
         }
         if service:
             desc["metadata"]["labels"]["service"] = service
-        if nonce:
-            desc["metadata"]["labels"]["nonce"] = nonce
+        for service_name in services or []:
+            desc["metadata"]["labels"]["service-%s" % service_name.rsplit(".", 1)[0]] = "true"
+        if services:
+            # Lets plan tell which service labels a pod carries without listing all of its labels
+            desc["metadata"]["annotations"] = {"services": ",".join(sorted(services))}
+        if image_id:
+            # Part of the pod's spec hash, so a rebuilt image under the same name counts as a change
+            desc["metadata"]["annotations"] = dict(desc["metadata"].get("annotations", {}), **{"image-id": image_id})
         if oneshot:
             desc["spec"]["restartPolicy"] = "Never"
         if cmd:
@@ -106,46 +318,42 @@ class KubeManager:
                 }
                 for volume_in_container, volume_on_instance in volumes.items()
             ]
+        return desc
 
-        self.env.run("cat /dev/null > /tmp/pod.json", hide=True)
-        self.env.put(json.dumps(desc), "/tmp/pod.json")
-        cmd = "kubectl create -f /tmp/pod.json"
-        self.env.run(cmd, ignore_errors=True)
-        if expose and not host_network:
-            for target_port, port in expose.items():
-                self.env.run(
-                    "kubectl delete service %s-%s --namespace=%s" % (
-                        name.rsplit(".", 1)[0].replace(".", "-"),
-                        target_port,
-                        name.rsplit(".", 1)[1]
-                    ),
-                    hide=True,
-                    ignore_errors=True
-                )
-                self.env.run(
-                    "kubectl expose pod %s --port=%s --target-port=%s --namespace=%s --name=%s-%s --external-ip=%s" % (
-                        name.rsplit(".", 1)[0],
-                        port,
-                        target_port,
-                        name.rsplit(".", 1)[1],
-                        name.rsplit(".", 1)[0].replace(".", "-"),
-                        target_port,
-                        self.stack[instance].expose_ip or self.stack[instance].public_ip
-                    ),
-                    hide=True,
-                    ignore_errors=True
-                )
-
-
-    def remove_container(self, name):
-        # stop_container(name)
-        # env.run("docker rm %s" % name, show=True)
-        pass
-
+    def get_expose_manifests(self, name, instance, expose):
+        # One service per exposed port, what `kubectl expose pod` used to create, selecting the pod by its name label
+        return [
+            {
+                "kind": "Service",
+                "apiVersion": "v1",
+                "metadata": {
+                    "name": "%s-%s" % (name.rsplit(".", 1)[0].replace(".", "-"), target_port),
+                    "namespace": name.rsplit(".", 1)[1],
+                    "labels": {
+                        "name": name.rsplit(".", 1)[0]
+                    }
+                },
+                "spec": {
+                    "selector": {
+                        "name": name.rsplit(".", 1)[0]
+                    },
+                    "ports": [
+                        {
+                            "protocol": "TCP",
+                            "port": int(port),
+                            "targetPort": int(target_port)
+                        }
+                    ],
+                    "externalIPs": [self.stack[instance].expose_ip or self.stack[instance].public_ip]
+                }
+            }
+            for target_port, port in (expose or {}).items()
+        ]
 
-    def add_service(self, name, ports, expose):
+    def get_service_manifests(self, name, ports, expose):
+        manifests = []
         if ports:
-            desc = {
+            manifests.append({
                 "kind": "Service",
                 "apiVersion": "v1",
                 "metadata": {
@@ -165,14 +373,9 @@ class KubeManager:
                         for target_port, port in ports.items()
                     ]
                 }
-            }
-            self.env.run("cat /dev/null > /tmp/svc.json", hide=True)
-            self.env.put(json.dumps(desc), "/tmp/svc.json")
-            cmd = "kubectl create -f /tmp/svc.json"
-            self.env.run("kubectl delete svc %s --namespace=%s" % (name.rsplit(".", 1)[0], name.rsplit(".", 1)[1]), ignore_errors=True)
-            self.env.run(cmd, ignore_errors=True)
+            })
         if expose:
-            desc = {
+            manifests.append({
                 "kind": "Service",
                 "apiVersion": "v1",
                 "metadata": {
@@ -191,45 +394,175 @@ class KubeManager:
                         }
                         for target_port, port in expose.items()
                     ],
-                    "externalIPs": [ self.env.hostname ]
+                    "externalIPs": [self.env.hostname]
                 }
-            }
-            print(desc)
-            self.env.run("cat /dev/null > /tmp/svc.json", hide=True)
-            self.env.put(json.dumps(desc), "/tmp/svc.json")
-            cmd = "kubectl create -f /tmp/svc.json"
-            self.env.run("kubectl delete svc %s-expose --namespace=%s" % (name.rsplit(".", 1)[0], name.rsplit(".", 1)[1]), ignore_errors=True)
-            self.env.run(cmd, ignore_errors=True)
+            })
+        return manifests
+
+    def get_container_manifests(self, image, name, instance, privileged=False, network=None, expose=None,
+                                restart="always", volumes=None, envs=None, image_id=None, host_network=False,
+                                mem_limit=None, oneshot=False, cmd=None, service=None, services=None):
+        # The pod, the services exposing its ports and the domain services it belongs to (`services`, names of
+        # stack services), with the (kind, name, namespace) of objects to recreate rather than merge
+        objects = [self.get_pod_manifest(
+            image, name, instance, privileged=privileged, envs=envs, image_id=image_id, host_network=host_network,
+            mem_limit=mem_limit, oneshot=oneshot, cmd=cmd, service=service, volumes=volumes, services=services
+        )]
+        replace = []
+        if not host_network:
+            expose_manifests = self.get_expose_manifests(name, instance, expose)
+            objects += expose_manifests
+            replace = [("Service", x["metadata"]["name"], x["metadata"]["namespace"]) for x in expose_manifests]
+        for service_name in services or []:
+            service = self.stack[service_name]
+            objects += self.get_service_manifests(service_name, service.ports, service.expose)
+        return objects, replace
+
+    def get_container_hashes(self, **kwargs):
+        # {(kind, name): spec hash} of the pod and its port services as add_container(**kwargs) would create them
+        objects, replace = self.get_container_manifests(**kwargs)
+        return {
+            (item["kind"], "%s.%s" % (item["metadata"]["name"], item["metadata"]["namespace"])): object_hash(item)
+            for item in objects
+            if item["kind"] == "Pod" or (item["kind"], item["metadata"]["name"], item["metadata"]["namespace"]) in replace
+        }
+
+    def add_container(self, image, name, instance, privileged=False, network=None, expose=None, restart="always", volumes=None,
+                      envs=None, image_id=None, host_network=False, mem_limit=None, oneshot=False, cmd=None, service=None,
+                      services=None):
+        # Everything goes out in a single apply; port services are recreated as `kubectl expose` used to do
+        self.apply(*self.get_container_manifests(
+            image, name, instance, privileged=privileged, network=network, expose=expose, restart=restart,
+            volumes=volumes, envs=envs, image_id=image_id, host_network=host_network, mem_limit=mem_limit,
+            oneshot=oneshot, cmd=cmd, service=service, services=services
+        ))
+
+    def remove_container(self, name):
+        # stop_container(name)
+        # env.run("docker rm %s" % name, show=True)
+        pass
+
+    def add_service(self, name, ports, expose):
+        self.apply(self.get_service_manifests(name, ports, expose))
 
     def label_container(self, container, key, value):
-        self.env.run("kubectl label pod %s --namespace=%s %s=%s --overwrite" % (
+        self.env.run(self.label_command(container, key, value), ignore_errors=True)
+
+    def label_command(self, container, key, value):
+        return "kubectl label pod %s --namespace=%s %s=%s --overwrite" % (
             container.rsplit(".", 1)[0],
             container.rsplit(".", 1)[1],
             key,
             value
-        ), ignore_errors=True)
+        )
+
+    def set_services(self, container, services, previous=None):
+        self.env.run(self.services_command(container, services, previous))
+
+    def services_command(self, container, services, previous=None):
+        # Labels the pod for `services` only, dropping the labels of `previous` services it no longer belongs to
+        labels = ["service-%s=true" % x.rsplit(".", 1)[0] for x in services]
+        labels += ["service-%s-" % x.rsplit(".", 1)[0] for x in previous or [] if x not in services]
+        pod, namespace = container.rsplit(".", 1)
+        return (
+            "kubectl label pod %s --namespace=%s %s --overwrite && "
+            "kubectl annotate pod %s --namespace=%s services=%s --overwrite" % (
+                pod, namespace, " ".join(labels), pod, namespace, ",".join(sorted(services))
+            )
+        )
 
     def logs(self, service, tail=100):
-        while True:
-            try:
-                self.env.run(
-                    "kubectl logs %s -f --tail=%s --namespace=%s --timestamps=true" % (
-                        service.rsplit(".", 1)[0],
-                        tail,
-                        service.rsplit(".", 1)[1]
-                    )
-                )
-                break
-            except Exception:
-                sleep(1)
+        for line in follow_resumable(lambda **kwargs: self.follow_logs(service, **kwargs), tail):
+            print("\033[32m        - [%s] %s\033[0m" % (service, line))
 
+    def follow_logs(self, service, tail=100, since_time=None):
+        # Yields timestamped log lines of the pod as they arrive, the last `tail` ones or those since since_time
+        return self.env.stream(self.logs_command(service, tail, since_time))
 
+    def logs_command(self, service, tail=100, since_time=None):
+        return "kubectl logs %s -f %s --namespace=%s --timestamps=true" % (
+            service.rsplit(".", 1)[0],
+            "--since-time=%s" % since_time if since_time else "--tail=%s" % tail,
+            service.rsplit(".", 1)[1]
+        )
 
     def stop(self, service):
-        self.env.run(
-            "kubectl delete pod %s --namespace=%s" % (
-                service.rsplit(".", 1)[0],
-                service.rsplit(".", 1)[1]
-            ),
-            ignore_errors=True
+        self.env.run(self.stop_command(service), ignore_errors=True)
+
+    def stop_command(self, service):
+        return "kubectl delete pod %s --namespace=%s" % (
+            service.rsplit(".", 1)[0],
+            service.rsplit(".", 1)[1]
+        )
+
+
+def get_async_kube_manager(stack, env):
+    # There is only a kubectl based async manager; with kube_backend "api" it drives the same cluster through
+    # kubectl on the root instance
+    return AsyncKubeManager(stack, env)
+
+
+@trace_methods("kube")
+class AsyncKubeManager(KubeManager):
+    # KubeManager over an AsyncEnvironment: manifests and hashes are shared with the blocking manager, every call
+    # reaching the cluster is a coroutine
+    async def _query_pods(self, namespace=None, selector=None):
+        return _parse_pods((await self.env.run(self.pods_command(namespace, selector), hide=True))["stdout"])
+
+    async def get_containers(self, namespace=None, selector=None):
+        return await self._query_pods(namespace, selector)
+
+    async def watch_pods(self, namespace, names, timeout):
+        async for line in self.env.stream(self.watch_command(namespace, names, timeout)):
+            if line.strip():
+                yield _pod_state(*(line.split("\t") + [""] * 13)[:13])
+
+    async def get_events(self, namespace, name=None):
+        return self.parse_events(
+            namespace, (await self.env.run(self.events_command(namespace, name), hide=True, ignore_errors=True))["stdout"]
+        )
+
+    async def get_ledger(self, namespace, selector=None):
+        return self._parse_ledger(
+            namespace, (await self.env.run(self.ledger_command(namespace, selector), hide=True))["stdout"]
         )
+
+    async def get_snapshot(self, namespace):
+        return self.parse_snapshot(namespace, await self.env.run_batch(
+            self.snapshot_commands(namespace), hide=True, stop_on_error=False
+        ))
+
+    async def apply(self, objects, replace=None):
+        if not objects:
+            return
+        cmd, stdin = self.apply_command(objects, replace)
+        await self.env.run(cmd, stdin=stdin)
+
+    async def add_container(self, image, name, instance, privileged=False, network=None, expose=None, restart="always",
+                            volumes=None, envs=None, image_id=None, host_network=False, mem_limit=None, oneshot=False,
+                            cmd=None, service=None, services=None):
+        await self.apply(*self.get_container_manifests(
+            image, name, instance, privileged=privileged, network=network, expose=expose, restart=restart,
+            volumes=volumes, envs=envs, image_id=image_id, host_network=host_network, mem_limit=mem_limit,
+            oneshot=oneshot, cmd=cmd, service=service, services=services
+        ))
+
+    async def add_service(self, name, ports, expose):
+        await self.apply(self.get_service_manifests(name, ports, expose))
+
+    async def label_container(self, container, key, value):
+        await self.env.run(self.label_command(container, key, value), ignore_errors=True)
+
+    async def set_services(self, container, services, previous=None):
+        await self.env.run(self.services_command(container, services, previous))
+
+    async def logs(self, service, tail=100):
+        async for line in follow_resumable_async(lambda **kwargs: self.follow_logs(service, **kwargs), tail):
+            print("\033[32m        - [%s] %s\033[0m" % (service, line))
+
+    async def follow_logs(self, service, tail=100, since_time=None):
+        async for line in self.env.stream(self.logs_command(service, tail, since_time)):
+            yield line
+
+    async def stop(self, service):
+        await self.env.run(self.stop_command(service), ignore_errors=True)
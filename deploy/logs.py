@@ -0,0 +1,285 @@
+import asyncio
+import heapq
+import os
+import re
+import time
+from datetime import datetime, timedelta
+from queue import Queue, Empty
+from threading import Thread
+
+
+# RFC 3339 prefix `kubectl logs --timestamps` and `docker logs -t` put on every line
+TIMESTAMP_RE = re.compile(r"^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)? ")
+COLORS = ("32", "33", "34", "35", "36", "92", "93", "94", "95", "96")
+BUFFER_LINES = 1000
+MERGE_DELAY = 0.5
+LOG_CACHE_DIR = ".deploy/logs"
+SEGMENT_BYTES = 16 * 1024 * 1024
+RELATIVE_TIME_RE = re.compile(r"^(\d+)([smhd])$")
+TIME_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+RESUME_RETRIES = 10
+
+
+def timestamp_key(line):
+    # Sortable form of the line's timestamp: docker trims trailing zeros of the fraction, kubectl does not
+    match = TIMESTAMP_RE.match(line)
+    if not match:
+        return None
+    return match.group(1) + (match.group(2) or ".").ljust(10, "0")
+
+
+def since_time(key):
+    # --since-time and sinceTime take whole seconds, the overlap with lines already seen is dropped by follow_resumable
+    return key[:19] + "Z"
+
+
+def parse_time(value):
+    # Key of an absolute time (2024-05-01, 2024-05-01T10:00, ...) or of one relative to now (30s, 10m, 2h, 1d), in UTC
+    match = RELATIVE_TIME_RE.match(value)
+    if match:
+        moment = datetime.utcnow() - timedelta(**{TIME_UNITS[match.group(2)]: int(match.group(1))})
+        return moment.strftime("%Y-%m-%dT%H:%M:%S") + ".000000000"
+    if timestamp_key(value.rstrip("Z") + "Z "):
+        return timestamp_key(value.rstrip("Z") + "Z ")
+    for time_format in ("%Y-%m-%dT%H:%M", "%Y-%m-%dT%H", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value.rstrip("Z"), time_format).strftime("%Y-%m-%dT%H:%M:%S") + ".000000000"
+        except ValueError:
+            pass
+    raise ValueError("Unknown time %s, use e.g. 2024-05-01T10:00:00 or 10m" % value)
+
+
+class _Resume:
+    # Where follow_resumable and follow_resumable_async stand between attempts: the last timestamp yielded, how many
+    # lines carried it, and how many attempts in a row failed or brought nothing
+    def __init__(self, tail, last_key, last_count, retries):
+        self.tail = tail
+        self.last_key = last_key
+        self.last_count = last_count
+        self.retries = retries
+        self.failures = 0
+        self.new = False
+        self.skip = 0
+
+    def begin(self):
+        # Arguments of the next follow
+        self.new = False
+        self.skip = self.last_count
+        if self.last_key:
+            return {"tail": None, "since_time": since_time(self.last_key)}
+        return {"tail": self.tail, "since_time": None}
+
+    def accept(self, line):
+        # Whether the line is new, lines of the last timestamp seen are skipped up to last_count
+        key = timestamp_key(line)
+        if key and self.last_key and key <= self.last_key:
+            if key < self.last_key:
+                return False
+            if self.skip:
+                self.skip -= 1
+                return False
+            self.last_count += 1
+        elif key:
+            self.last_key, self.last_count, self.skip = key, 1, 0
+        self.new = True
+        return True
+
+    def failed(self):
+        # Whether the error of this attempt is to be raised
+        self.failures = 0 if self.new else self.failures + 1
+        return self.failures > self.retries
+
+    def ended(self):
+        # Whether the follow is over after a clean end of this attempt
+        if self.last_key and self.new:
+            self.failures = 0
+            return False
+        if self.last_key or self.new:
+            # A reconnect brought nothing new, or there are no timestamps to resume from
+            return True
+        # Nothing to read yet, e.g. the container is still being created, or there is no such container
+        self.failures += 1
+        return self.failures > self.retries
+
+
+def follow_resumable(follow, tail, last_key=None, last_count=0, retry_delay=1, retries=RESUME_RETRIES):
+    # Yields the lines of follow(tail, since_time) across dropped connections. Every reconnect asks for the lines
+    # since the last timestamp seen and skips the ones already yielded, last_count being how many lines carried
+    # that timestamp. The follow is over once a reconnect after a clean end brings nothing new, or after `retries`
+    # attempts in a row failed or brought nothing, the last error being raised.
+    resume = _Resume(tail, last_key, last_count, retries)
+    while True:
+        try:
+            for line in follow(**resume.begin()):
+                if resume.accept(line):
+                    yield line
+        except Exception:
+            if resume.failed():
+                raise
+            time.sleep(retry_delay)
+            continue
+        if resume.ended():
+            return
+        if not resume.new:
+            time.sleep(retry_delay)
+
+
+async def follow_resumable_async(follow, tail, last_key=None, last_count=0, retry_delay=1, retries=RESUME_RETRIES):
+    # follow_resumable for a follow returning an async iterator
+    resume = _Resume(tail, last_key, last_count, retries)
+    while True:
+        try:
+            async for line in follow(**resume.begin()):
+                if resume.accept(line):
+                    yield line
+        except Exception:
+            if resume.failed():
+                raise
+            await asyncio.sleep(retry_delay)
+            continue
+        if resume.ended():
+            return
+        if not resume.new:
+            await asyncio.sleep(retry_delay)
+
+
+class LogCache:
+    # Log lines of one container appended to segment files under .deploy/logs. The index file lists the first
+    # timestamp of every segment, so reading a time range opens only the segments it overlaps.
+    def __init__(self, mode, name, directory=LOG_CACHE_DIR, segment_bytes=SEGMENT_BYTES):
+        self.directory = os.path.join(directory, mode, name)
+        self.segment_bytes = segment_bytes
+        self.index_file = os.path.join(self.directory, "index")
+
+    def get_index(self):
+        # [(first timestamp key, segment file name)] in time order
+        if not os.path.exists(self.index_file):
+            return []
+        with open(self.index_file) as fd:
+            return [tuple(line.rstrip("\n").split("\t")) for line in fd if line.strip()]
+
+    def last(self):
+        # (last timestamp key, lines carrying it) of the cache, where following resumes
+        last_key, last_count = None, 0
+        index = self.get_index()
+        if index:
+            for key, _ in self._read(index[-1][1]):
+                if key != last_key:
+                    last_key, last_count = key, 0
+                last_count += 1
+        return last_key, last_count
+
+    def _read(self, segment):
+        with open(os.path.join(self.directory, segment), encoding="utf8", errors="replace") as fd:
+            last_key = ""
+            for line in fd:
+                line = line.rstrip("\n")
+                last_key = timestamp_key(line) or last_key
+                yield last_key, line
+
+    def record(self, lines):
+        # Passes lines through, appending them to the cache. Lines of one timestamp stay in one segment, last() only
+        # reads the last segment.
+        os.makedirs(self.directory, exist_ok=True)
+        index = self.get_index()
+        fd = open(os.path.join(self.directory, index[-1][1]), "a", encoding="utf8") if index else None
+        last_key = self.last()[0]
+        try:
+            for line in lines:
+                key = timestamp_key(line)
+                if fd is None or (fd.tell() >= self.segment_bytes and key and key != last_key):
+                    if fd:
+                        fd.close()
+                    segment = "%08d.log" % (len(index) + 1)
+                    index.append((key or (index[-1][0] if index else ""), segment))
+                    with open(self.index_file, "a") as index_fd:
+                        index_fd.write("%s\t%s\n" % index[-1])
+                    fd = open(os.path.join(self.directory, segment), "a", encoding="utf8")
+                fd.write(line + "\n")
+                fd.flush()
+                last_key = key or last_key
+                yield line
+        finally:
+            if fd:
+                fd.close()
+
+    def read(self, since=None, until=None):
+        # Cached lines with since <= timestamp < until
+        index = self.get_index()
+        for i, (first_key, segment) in enumerate(index):
+            if until and first_key >= until:
+                break
+            if since and i + 1 < len(index) and index[i + 1][0] < since:
+                continue
+            for key, line in self._read(segment):
+                if until and key >= until:
+                    return
+                if not since or key >= since:
+                    yield line
+
+
+class LogStream:
+    # Follows one container's logs on a thread into a bounded queue. When the queue is full the thread stops
+    # reading, which holds back the remote command instead of buffering its output here.
+    def __init__(self, name, follow, buffer_lines=BUFFER_LINES):
+        self.name = name
+        self.follow = follow
+        self.queue = Queue(maxsize=buffer_lines)
+        self.thread = Thread(target=self._read, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _read(self):
+        try:
+            for line in self.follow():
+                self.queue.put((time.time(), line))
+        except Exception as e:
+            self.queue.put((time.time(), "\033[31mLogs of %s failed: %s\033[0m" % (self.name, e)))
+        self.queue.put(None)
+
+
+class LogMultiplexer:
+    # Merges the lines of several LogStreams by timestamp. It holds at most one line per stream: the earliest held
+    # line is printed once every stream holds one, or once it has waited `delay` seconds for quiet streams, so a
+    # chatty stream is slowed down only by its own buffer filling up.
+    def __init__(self, streams, delay=MERGE_DELAY):
+        self.streams = streams
+        self.delay = delay
+        self.colors = {stream.name: COLORS[i % len(COLORS)] for i, stream in enumerate(streams)}
+        self.width = max(len(stream.name) for stream in streams) if streams else 0
+
+    def print_line(self, name, line):
+        print("\033[%sm%s\033[0m %s" % (self.colors[name], name.ljust(self.width), line))
+
+    def run(self):
+        for stream in self.streams:
+            stream.start()
+        live = list(range(len(self.streams)))
+        heads = []
+        held = set()
+        last_keys = {}
+        while live or heads:
+            for i in list(live):
+                if i in held:
+                    continue
+                try:
+                    item = self.streams[i].queue.get_nowait()
+                except Empty:
+                    continue
+                if item is None:
+                    live.remove(i)
+                    continue
+                arrived_at, line = item
+                # Lines without a timestamp (wrapped output) stay right after the line before them
+                key = timestamp_key(line) or last_keys.get(i, "")
+                last_keys[i] = key
+                heapq.heappush(heads, (key, arrived_at, i, line))
+                held.add(i)
+            if heads and (len(held) == len(live) or time.time() - heads[0][1] >= self.delay):
+                _, _, i, line = heapq.heappop(heads)
+                held.discard(i)
+                self.print_line(self.streams[i].name, line)
+                continue
+            time.sleep(0.01)
@@ -0,0 +1,119 @@
+import time
+from datetime import datetime
+
+from deploy.environment import EnvironmentFactory
+from deploy.kube_manager import get_kube_manager
+from deploy.tracing import span
+from deploy.utils import run_parallel, raise_errors
+
+
+# Container states that do not resolve by waiting
+FAILURE_REASONS = (
+    "CrashLoopBackOff",
+    "ImagePullBackOff",
+    "ErrImagePull",
+    "InvalidImageName",
+    "CreateContainerConfigError",
+    "CreateContainerError"
+)
+
+
+def _parse_time(value):
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ") if value else None
+
+
+def _elapsed(start, end):
+    start, end = _parse_time(start), _parse_time(end)
+    if not start or not end:
+        return "-"
+    return "%ds" % (end - start).total_seconds()
+
+
+def _describe(state):
+    if state["ready"]:
+        return "Ready"
+    return "%s%s" % (state["phase"] or "Pending", " (%s)" % state["waiting"] if state["waiting"] else "")
+
+
+def wait_for_rollout(stack, pods, timeout=None):
+    # Waits until every pod (container names) is Ready, one watch per namespace, all namespaces concurrently
+    timeout = int(timeout or stack.vars.get("rollout_timeout", 300))
+    namespaces = {}
+    for pod in pods:
+        namespaces.setdefault(pod.rsplit(".", 1)[1], []).append(pod)
+    print("\033[1;37;40mWaiting for %s to become ready\033[0m" % ", ".join(pods))
+
+    def wait_namespace(namespace):
+        root_instance = stack.get_root_instance(stack[namespace])
+        env = EnvironmentFactory.get_remote(root_instance.public_ip, root_instance.public_port)
+        kube_manager = get_kube_manager(stack, env)
+        with span("rollout", "kube", host=env.hostname, detail=namespace):
+            states = wait_for_pods(kube_manager, namespace, namespaces[namespace], timeout)
+        report_rollout(kube_manager, namespace, states)
+
+    _, errors = run_parallel(wait_namespace, list(namespaces))
+    raise_errors("Rollout", errors)
+
+
+def wait_for_pods(kube_manager, namespace, pods, timeout):
+    # Follows pod events until all pods are ready. Fails as soon as one of them is stuck in a state from
+    # FAILURE_REASONS, or once the deadline passes.
+    deadline = time.time() + timeout
+    pending = set(pods)
+    states = {}
+    while pending:
+        remaining = int(deadline - time.time())
+        if remaining <= 0:
+            for name in sorted(pending):
+                print_events(kube_manager, name)
+            raise RuntimeError("Timed out after %ss waiting for %s" % (timeout, ", ".join(sorted(pending))))
+        watch = kube_manager.watch_pods(namespace, pods, remaining)
+        try:
+            for state in watch:
+                name = state["name"]
+                if name not in pending or state["deleted"]:
+                    continue
+                if not states.get(name) or _describe(states[name]) != _describe(state):
+                    print(" - [%s] %s" % (name, _describe(state)))
+                states[name] = state
+                if state["waiting"] in FAILURE_REASONS:
+                    print_events(kube_manager, name)
+                    raise RuntimeError("%s is in %s" % (name, state["waiting"]))
+                if state["ready"]:
+                    pending.discard(name)
+                    if not pending:
+                        break
+        finally:
+            watch.close()
+        if pending:
+            # The watch ended early (server side timeout or a dropped connection), watch again shortly
+            time.sleep(1)
+    return states
+
+
+def print_events(kube_manager, name):
+    for event in kube_manager.get_events(name.rsplit(".", 1)[1], name):
+        print("\033[31m    - [%s] %s %s: %s\033[0m" % (
+            event["last"] or event["first"], event["type"], event["reason"], event["message"]
+        ))
+
+
+def report_rollout(kube_manager, namespace, states):
+    # Times are relative to pod creation, pull time spans the Pulling and Pulled events
+    events = {}
+    for event in kube_manager.get_events(namespace):
+        events.setdefault(event["name"], {})[event["reason"]] = event
+    for name, state in sorted(states.items()):
+        pod_events = events.get(name, {})
+        if "Pulling" in pod_events and "Pulled" in pod_events:
+            pull = _elapsed(pod_events["Pulling"]["first"], pod_events["Pulled"]["last"])
+        else:
+            pull = "cached" if "Pulled" in pod_events else "-"
+        print(" - [%s] scheduled %s, pull %s, started %s, ready %s, restarts %s" % (
+            name,
+            _elapsed(state["created"], state["scheduled"]),
+            pull,
+            _elapsed(state["created"], state["started"]),
+            _elapsed(state["created"], state["ready"]),
+            state["restarts"]
+        ))
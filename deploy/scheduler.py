@@ -0,0 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from deploy.tracing import span
+from deploy.utils import raise_errors
+
+
+class Scheduler:
+    # Runs named tasks as a dependency graph: a task starts once all of its dependencies succeeded, at most `jobs`
+    # at a time. Adding a task under an existing name is a no-op, which is how shared steps (bootstrap of a host,
+    # namespace init of a domain) end up running once no matter how many targets need them.
+    def __init__(self, jobs=4, title="Deploy"):
+        self.jobs = jobs
+        self.title = title
+        self.tasks = {}
+        self.results = {}
+
+    def add(self, name, func, deps=()):
+        if name not in self.tasks:
+            self.tasks[name] = (func, set(deps))
+        return name
+
+    def __contains__(self, name):
+        return name in self.tasks
+
+    def _check(self):
+        for name, (_, deps) in self.tasks.items():
+            for dep in deps:
+                if dep not in self.tasks:
+                    raise ValueError("Task %s depends on unknown task %s" % (name, dep))
+        visited = {}
+
+        def visit(name, path):
+            if visited.get(name) == "done":
+                return
+            if visited.get(name) == "active":
+                raise ValueError("Dependency cycle: %s" % " -> ".join(path + [name]))
+            visited[name] = "active"
+            for dep in sorted(self.tasks[name][1]):
+                visit(dep, path + [name])
+            visited[name] = "done"
+
+        for name in sorted(self.tasks):
+            visit(name, [])
+
+    def _run_task(self, name, func):
+        with span(name, "task"):
+            return func()
+
+    def run(self):
+        self._check()
+        pending = dict(self.tasks)
+        errors = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                for name, (func, deps) in sorted(pending.items()):
+                    if any(dep in errors for dep in deps):
+                        errors[name] = RuntimeError("Skipped, dependency failed")
+                        del pending[name]
+                    elif deps.issubset(self.results):
+                        running[pool.submit(self._run_task, name, func)] = name
+                        del pending[name]
+                if not running:
+                    # Only tasks whose dependencies failed can be left here, the next pass marks them skipped
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as e:
+                        errors[name] = e
+        raise_errors(self.title, errors)
+        return self.results
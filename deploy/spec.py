@@ -0,0 +1,48 @@
+import hashlib
+import json
+
+
+# Every object deploy creates carries the hash of the spec it was created from: label HASH_LABEL on kubernetes
+# objects, DOCKER_HASH_LABEL on docker containers, networks and volumes. These labels are the ledger drift checks
+# read, one listing per node or namespace instead of comparing live objects field by field.
+HASH_LABEL = "spec-hash"
+DOCKER_HASH_LABEL = "SPEC_HASH"
+# Annotations that can change in place and so are left out of an object's hash
+MUTABLE_ANNOTATIONS = ("services",)
+
+
+def canonical(value):
+    # JSON-ready form with a single representation per value: dict keys become strings (stack files mix int and str
+    # ports), tuples become lists and sets sorted lists
+    if isinstance(value, dict):
+        return {str(key): canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted(canonical(item) for item in value)
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def spec_hash(*parts):
+    data = json.dumps(canonical(parts), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf8")).hexdigest()[:32]
+
+
+def object_hash(item):
+    # Hash of a kubernetes manifest: kind, name, spec and annotations. Labels are left out, they are patched in place
+    # and carry the hash itself.
+    metadata = item["metadata"]
+    return spec_hash(
+        item["kind"],
+        metadata["name"],
+        metadata.get("namespace"),
+        item.get("spec"),
+        {key: value for key, value in (metadata.get("annotations") or {}).items() if key not in MUTABLE_ANNOTATIONS}
+    )
+
+
+def stamp(item):
+    item["metadata"].setdefault("labels", {})[HASH_LABEL] = object_hash(item)
+    return item
@@ -1,27 +1,57 @@
+import fnmatch
+import hashlib
 import json
 import os
+import pickle
+import re
 
 from io import StringIO
+from threading import RLock
 
 import yaml
 from jinja2 import FileSystemLoader, Environment, PackageLoader
 
+from deploy.tracing import span
+
 
 class Domain:
     def __init__(self, value):
         self.value = value
         self.instances = {}
         self.services = {}
+        self._index = None
 
     def set_instances(self, instances):
         self.instances = instances
         for instance in instances.values():
             instance.domain = self
+        self._index = None
 
     def set_services(self, services):
         self.services = services
         for service in services.values():
             service.domain = self
+        self._index = None
+
+    def get_index(self):
+        # ({full name: instance, container or service}, {container name: names of its services}), built on first use.
+        # An instance and a service of the same name resolve to the instance.
+        if self._index is None:
+            names = {}
+            container_services = {}
+            for instance in self.instances.values():
+                names[str(instance)] = instance
+                for container in instance.containers.values():
+                    names[str(container)] = container
+            for service in self.services.values():
+                names.setdefault(str(service), service)
+                for container in service.containers:
+                    container_services.setdefault(container, []).append(str(service))
+            self._index = (names, container_services)
+        return self._index
+
+    def get_container_services(self, container):
+        return self.get_index()[1].get(str(container), [])
 
     def __str__(self):
         return self.value
@@ -52,7 +82,7 @@ class Instance:
 
 class Container:
     def __init__(self, value, build=None, docker_file=None, run=None, volumes=None, env=None, expose=None,
-                 is_privileged=False, network=None, mem_limit=None):
+                 is_privileged=False, network=None, mem_limit=None, depends_on=None):
         self.value = value
         self.instance = None
         self.build = build
@@ -64,6 +94,7 @@ class Container:
         self.is_privileged = is_privileged
         self.network = network or "overlay"
         self.mem_limit = mem_limit or None
+        self.depends_on = depends_on or []
 
     def __str__(self):
         return self.value
@@ -81,155 +112,402 @@ class Service:
         return self.value
 
 
-def posprocess_dict(d):
-    if "<" in d:
+class Inheritance:
+    # Resolves `<` merge keys: {"<": base or [bases], ...} starts from the keys of the bases, later ones winning, and
+    # {"<key": base or [bases], "key": {...}} does the same for the sibling "key". Bases are merged as they are
+    # written, nested dicts are resolved after merging.
+    # Results are memoized by the identity of the dict they come from, so a template used at many places (YAML
+    # aliases) is resolved once, and dicts nothing changes in are returned as they are instead of copied. The input is
+    # never modified and results share structure with it and with each other: treat both as read-only.
+    def __init__(self, resolve=None):
+        self.load = resolve or (lambda x: x)
+        self.results = {}
+        self.active = set()
+        self.path = []
+
+    def resolve(self, d, recursive=True):
+        key = id(d)
+        if key in self.results:
+            return self.results[key][1]
+        if key in self.active:
+            raise ValueError("Inheritance cycle at %s" % (".".join(str(x) for x in self.path) or "top level"))
+        self.active.add(key)
+        try:
+            result = self._resolve(d, recursive)
+        finally:
+            self.active.discard(key)
+        # The source dict is kept alive with its result, its id must not be reused
+        self.results[key] = (d, result)
+        return result
+
+    def _merged(self, value):
         new_d = {}
-        if type(d["<"]) is list:
-            for x in d["<"]:
-                new_d.update(x)
+        if type(value) is list:
+            for x in value:
+                new_d.update(self.load(x))
         else:
-            new_d.update(d["<"])
-        del(d["<"])
-        new_d.update(d)
-        d = new_d
-
-    for k in list(d.keys()):
-        if type(k) is str and k != "<" and k.startswith("<"):
-            new_d = {}
-            if type(d[k]) is list:
-                for x in d[k]:
-                    new_d.update(x)
-            else:
-                new_d.update(d[k])
-            del (d[k])
-            new_d.update(d[k[1:]])
-            d[k[1:]] = new_d
-
-    for k in d:
-        if type(d[k]) == dict:
-            d[k] = posprocess_dict(d[k])
-
-    return d
+            new_d.update(self.load(value))
+        return new_d
+
+    def _resolve(self, d, recursive):
+        copied = "<" in d
+        if copied:
+            new_d = self._merged(d["<"])
+            for k, v in d.items():
+                if k != "<":
+                    new_d[k] = v
+            d = new_d
+
+        for k in list(d.keys()):
+            if type(k) is str and k != "<" and k.startswith("<"):
+                if not copied:
+                    d, copied = dict(d), True
+                new_d = self._merged(d[k])
+                del (d[k])
+                new_d.update(self.load(d[k[1:]]))
+                d[k[1:]] = new_d
+
+        if recursive:
+            for k in list(d.keys()):
+                if type(d[k]) == dict:
+                    self.path.append(k)
+                    value = self.resolve(d[k])
+                    self.path.pop()
+                    if value is not d[k]:
+                        if not copied:
+                            d, copied = dict(d), True
+                        d[k] = value
+
+        return d
+
+
+def posprocess_dict(d, resolve=None, recursive=True):
+    # resolve loads the merged values that are still an Include, recursive=False leaves the nested dicts for later
+    return Inheritance(resolve).resolve(d, recursive)
+
+
+def _file_hash(path):
+    with open(path, "rb") as fd:
+        return hashlib.md5(fd.read()).hexdigest()
+
+
+class RecordingLoaderMixin:
+    # Remembers the content hash of every template it serves, so the compiled stack cache knows its inputs
+    def get_source(self, environment, template):
+        source, filename, uptodate = super(RecordingLoaderMixin, self).get_source(environment, template)
+        self.sources[filename] = hashlib.md5(source.encode("utf8")).hexdigest()
+        return source, filename, uptodate
+
+
+class RecordingFileSystemLoader(RecordingLoaderMixin, FileSystemLoader):
+    def __init__(self, sources, *args, **kwargs):
+        super(RecordingFileSystemLoader, self).__init__(*args, **kwargs)
+        self.sources = sources
+
+
+class RecordingPackageLoader(RecordingLoaderMixin, PackageLoader):
+    def __init__(self, sources, *args, **kwargs):
+        super(RecordingPackageLoader, self).__init__(*args, **kwargs)
+        self.sources = sources
+
+
+CACHE_DIR = ".deploy/stack_cache"
+CACHE_STATE = ("vault", "vars", "domain_names")
+SELECTOR_KINDS = {Domain: "domain", Instance: "instance", Service: "service", Container: "container"}
+GLOB_CHARS = "*?["
+
+
+def is_selector(target):
+    # Targets with a kind prefix or glob characters select containers, others name one object
+    return ":" in target or any(x in target for x in GLOB_CHARS)
+
+
+def _selector_domain(kind, pattern):
+    # The only domain names matching pattern can be in, None when it could be any
+    domain = pattern if kind == "domain" else pattern.rsplit(".", 1)[1] if "." in pattern else None
+    if domain is None or any(x in domain for x in GLOB_CHARS):
+        return None
+    return domain
+
+
+class Include:
+    # An !include not loaded yet. stack.yml is parsed with its includes left as Include, a domain loads the ones
+    # it holds when it is first used.
+    def __init__(self, filename):
+        self.filename = filename
+
+
+class StackLoader(yaml.SafeLoader):
+    def include(self, node):
+        return Include(os.path.join("_stack/", self.construct_scalar(node)))
+
+    def json(self, node):
+        return json.dumps(self.construct_sequence(node, True))
+
+
+StackLoader.add_constructor('!include', StackLoader.include)
+StackLoader.add_constructor('!json', StackLoader.json)
+
+
+def _jsonify(x):
+    return json.dumps(x).replace("\n", " ")
+
+
+def _write_cache(cache_file, data):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + ".tmp", "wb") as fd:
+        pickle.dump(data, fd, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(cache_file + ".tmp", cache_file)
+
+
+def _read_cache(cache_file, key):
+    # The cache entry if it was written for key and none of its sources changed since
+    try:
+        with open(cache_file, "rb") as fd:
+            cache = pickle.load(fd)
+        if cache["key"] != key or any(_file_hash(path) != digest for path, digest in cache["sources"].items()):
+            return None
+    except Exception:
+        return None
+    return cache
+
+
+def _build_domain(domain, opts, instance_common):
+    # opts may share dicts with other domains and instances (see Inheritance), they are only read here
+    _instances = opts["instances"]
+    _services = opts["services"]
+    instances = {}
+    services = {}
+    for service, service_opts in _services.items():
+        service = "%s.%s" % (service, domain)
+        services[service] = Service(
+            value=service,
+            containers=list(service_opts.get("containers") or []),
+            ports=dict(service_opts.get("ports") or {}),
+            expose=dict(service_opts.get("expose") or {})
+        )
+
+    for instance, instance_opts in _instances.items():
+        instance = "%s.%s" % (instance, domain)
+        _containers = dict(instance_opts.get("containers", {}) or {})
+        _containers.update(instance_common.get("containers", {}))
+        volumes = [
+            "%s.%s" % (volume, instance)
+            for volume in instance_common.get("volumes", []) + instance_opts.get("volumes", [])
+        ]
+        containers = {}
+        for container, container_opts in _containers.items():
+            container = "%s.%s" % (container, instance)
+            containers[container] = Container(
+                value=container,
+                build=container_opts.get("build"),
+                docker_file=container_opts.get("docker_file"),
+                run=container_opts.get("run"),
+                volumes={
+                    volume_in_container: (
+                        "%s.%s" % (volume_on_instance, instance) if not volume_on_instance.startswith("/")
+                        else volume_on_instance
+                    )
+                    for volume_in_container, volume_on_instance in container_opts.get("volumes", {}).items()
+                },
+                env=dict(container_opts.get("env") or {}),
+                expose=dict(container_opts.get("expose") or {}),
+                is_privileged=container_opts.get("is_privileged") is True,
+                network=container_opts.get("network"),
+                mem_limit=container_opts.get("mem_limit"),
+                # Dependencies are full container names or names relative to the instance/domain
+                depends_on=[
+                    "%s.%s" % (dependency, instance) if dependency.count(".") == 0
+                    else "%s.%s" % (dependency, domain) if dependency.count(".") == 1
+                    else dependency
+                    for dependency in container_opts.get("depends_on") or []
+                ]
+            )
+
+        instances[instance] = Instance(
+            value=instance,
+            public_ip=instance_opts.get("public_ip"),
+            expose_ip=instance_opts.get("expose_ip"),
+            is_root=instance_opts.get("root") is True,
+            volumes=volumes
+        )
+        instances[instance].set_containers(containers)
+    result = Domain(value=domain)
+    result.set_instances(instances)
+    result.set_services(services)
+    return result
 
 
 class Stack:
-    def __init__(self, mode, vault_file, stack_vars_file, stack_file, instance_common_file):
+    # Instances of all domains, once get_instances loaded them
+    _instances = None
+
+    def __init__(self, mode, vault_file, stack_vars_file, stack_file, instance_common_file, cache_dir=CACHE_DIR):
+        # Only the vars and the domain names are loaded here. A domain, with the includes it holds, is built when
+        # first used (get_domain), so a command about one domain does not pay for the others.
+        # Both are cached on disk per mode. The stack entry records the hash of the vault and of every template
+        # rendered for it (vars, stack, instance_common), a domain entry the hash of its includes and of the stack
+        # entry it was built from. Entries are reused only while all of them, the project directory and this module
+        # are unchanged.
+        self.stack_file = stack_file
+        self.instance_common_file = instance_common_file
+        self.cache_dir = os.path.join(cache_dir, mode) if cache_dir else None
+        self.domains = {}
+        self._stack = None
+        self._j2_envs = None
+        self._lock = RLock()
+        key = (mode, os.getcwd(), _file_hash(__file__), _file_hash(vault_file))
+        cache_file = os.path.join(self.cache_dir, "stack.pickle") if self.cache_dir else None
+        cache = _read_cache(cache_file, key) if cache_file else None
+        if cache:
+            for attr in CACHE_STATE:
+                setattr(self, attr, cache["state"][attr])
+            sources = cache["sources"]
+        else:
+            sources = {}
+            self._load(mode, vault_file, stack_vars_file, sources)
+            if cache_file:
+                _write_cache(cache_file, {
+                    "key": key,
+                    "sources": sources,
+                    "state": {attr: getattr(self, attr) for attr in CACHE_STATE}
+                })
+        self._digest = hashlib.md5(repr((key, sorted(sources.items()))).encode("utf8")).hexdigest()
+
+    def _render(self, template_file, sources, context, package=False):
+        # Templates are not cached by jinja, so every render records its source in `sources`
+        if not self._j2_envs:
+            self._j2_envs = (
+                Environment(loader=RecordingFileSystemLoader(None, '.'), cache_size=0),
+                Environment(loader=RecordingPackageLoader(None, "deploy", "."), cache_size=0)
+            )
+            for j2_env in self._j2_envs:
+                j2_env.filters["jsonify"] = _jsonify
+        j2_env = self._j2_envs[package]
+        j2_env.loader.sources = sources
+        buf = StringIO(j2_env.get_template(template_file).render(**context))
+        buf.name = template_file
+        return buf
+
+    def _load(self, mode, vault_file, stack_vars_file, sources):
         project_dir = os.getcwd()
         with open(vault_file) as fd:
             self.vault = yaml.load(fd)
 
-        loader = FileSystemLoader('.')
-        package_loader = PackageLoader("deploy", ".")
-        j2_env = Environment(loader=loader)
-        j2_package_env = Environment(loader=package_loader)
-        def jsonify(x):
-            return json.dumps(x).replace("\n", " ")
-        j2_env.filters["jsonify"] = jsonify
-        j2_package_env.filters["jsonify"] = jsonify
-
-        stack_vars_j2_template = j2_env.get_template(stack_vars_file)
-        buf = StringIO(stack_vars_j2_template.render(**{
+        self.vars = yaml.load(self._render(stack_vars_file, sources, {
             "vault": self.vault,
             "mode": mode,
             "project_dir": project_dir
         }))
-        vars = self.vars = yaml.load(buf)
         self.vars["vault"] = self.vault
         self.vars["mode"] = mode
         self.vars["project_dir"] = project_dir
-
-        stack_j2_template = j2_env.get_template(stack_file)
-        buf = StringIO(stack_j2_template.render(**self.vars))
-        buf.name = stack_file
-        class Loader(yaml.SafeLoader):
-            def __init__(self, stream):
-                super(Loader, self).__init__(stream)
-
-            def include(self, node):
-                filename = os.path.join("_stack/", self.construct_scalar(node))
-                stack_j2_template = j2_env.get_template(filename)
-                buf = StringIO(stack_j2_template.render(**vars))
-                buf.name = filename
-                return yaml.load(buf, Loader)
-
-            def json(self, node):
-                return json.dumps(self.construct_sequence(node, True))
-
-        Loader.add_constructor('!include', Loader.include)
-        Loader.add_constructor('!json', Loader.json)
-        stack = yaml.load(buf, Loader)
-        stack = posprocess_dict(stack)
-        instance_common_j2_template = j2_package_env.get_template(instance_common_file)
-        buf = StringIO(instance_common_j2_template.render(**self.vars))
-        instance_common = yaml.load(buf)
-
-        self.domains = {}
-        for domain in stack:
-            _instances = stack[domain]["instances"]
-            _services = stack[domain]["services"]
-            instances = {}
-            services = {}
-            for service, service_opts in _services.items():
-                service = "%s.%s" % (service, domain)
-                services[service] = Service(
-                    value=service,
-                    containers=service_opts.get("containers", []),
-                    ports=service_opts.get("ports", {}),
-                    expose=service_opts.get("expose", {})
+        self._load_stack(sources)
+        self.domain_names = list(self._stack)
+
+    def _load_stack(self, sources):
+        # Top level of stack.yml, includes below the domains stay Include
+        stack = yaml.load(self._render(self.stack_file, sources, self.vars), StackLoader)
+        self._stack = posprocess_dict(stack, lambda value: self._resolve(value, sources, deep=False), recursive=False)
+        self._instance_common = yaml.load(self._render(self.instance_common_file, sources, self.vars, package=True))
+
+    def _resolve(self, value, sources, deep=True, loaded=None):
+        # value with its Include loaded, and with deep=True those nested in it too. Like Inheritance, dicts and lists
+        # without an Include are returned as they are and each file is loaded once.
+        loaded = {} if loaded is None else loaded
+        if isinstance(value, Include):
+            if value.filename not in loaded:
+                loaded[value.filename] = None
+                loaded[value.filename] = self._resolve(
+                    yaml.load(self._render(value.filename, sources, self.vars), StackLoader), sources, deep, loaded
                 )
-
-            for instance, instance_opts in _instances.items():
-                instance = "%s.%s" % (instance, domain)
-                _containers = instance_opts.pop("containers", {}) or {}
-                _containers.update(instance_common.get("containers", {}))
-                instance_opts["volumes"] = [
-                    "%s.%s" % (volume, instance)
-                    for volume in instance_common.get("volumes", []) + instance_opts.pop("volumes", [])
-                ]
-                containers = {}
-                for container, container_opts in _containers.items():
-                    container = "%s.%s" % (container, instance)
-                    container_opts["volumes"] = {
-                        volume_in_container: (
-                            "%s.%s" % (volume_on_instance, instance) if not volume_on_instance.startswith("/")
-                            else volume_on_instance
-                        )
-                        for volume_in_container, volume_on_instance in container_opts.get("volumes", {}).items()
-                    }
-                    containers[container] = Container(
-                        value=container,
-                        build=container_opts.get("build"),
-                        docker_file=container_opts.get("docker_file"),
-                        run=container_opts.get("run"),
-                        volumes=container_opts.get("volumes"),
-                        env=container_opts.get("env"),
-                        expose=container_opts.get("expose"),
-                        is_privileged=container_opts.get("is_privileged") is True,
-                        network=container_opts.get("network"),
-                        mem_limit=container_opts.get("mem_limit")
-                    )
-
-                instances[instance] = Instance(
-                    value=instance,
-                    public_ip=instance_opts.get("public_ip"),
-                    expose_ip=instance_opts.get("expose_ip"),
-                    is_root=instance_opts.get("root") is True,
-                    volumes=instance_opts.get("volumes")
-                )
-                instances[instance].set_containers(containers)
-            self.domains[domain] = Domain(value=domain)
-            self.domains[domain].set_instances(instances)
-            self.domains[domain].set_services(services)
+            elif loaded[value.filename] is None:
+                raise ValueError("%s includes itself" % value.filename)
+            return loaded[value.filename]
+        if deep and isinstance(value, dict):
+            items = [(k, self._resolve(v, sources, deep, loaded)) for k, v in value.items()]
+            return value if all(v is value[k] for k, v in items) else dict(items)
+        if deep and isinstance(value, list):
+            items = [self._resolve(x, sources, deep, loaded) for x in value]
+            return value if all(x is y for x, y in zip(items, value)) else items
+        return value
+
+    def get_domain(self, name):
+        domain = self.domains.get(name)
+        if domain is None:
+            if name not in self.domain_names:
+                raise KeyError(name)
+            with self._lock:
+                if name not in self.domains:
+                    with span("load domain", "stack", detail=name):
+                        self.domains[name] = self._load_domain(name)
+            domain = self.domains[name]
+        return domain
+
+    def _load_domain(self, name):
+        cache_file = os.path.join(self.cache_dir, "domains", "%s.pickle" % name) if self.cache_dir else None
+        cache = _read_cache(cache_file, self._digest) if cache_file else None
+        if cache:
+            return cache["domain"]
+        if self._stack is None:
+            # The stack entry came from the cache, its sources are unchanged
+            self._load_stack({})
+        sources = {}
+        domain = _build_domain(name, posprocess_dict(self._resolve(self._stack[name], sources)), self._instance_common)
+        if cache_file:
+            _write_cache(cache_file, {"key": self._digest, "sources": sources, "domain": domain})
+        return domain
 
     def get_domains(self):
-        return self.domains.values()
+        return [self.get_domain(name) for name in self.domain_names]
 
     def get_instances(self, domain=None):
-        domains = [domain] if domain else self.get_domains()
-        result = []
-        for domain in domains:
-            result += list(self.domains[str(domain)].instances.values())
-        return result
+        if domain:
+            return list(self.get_domain(str(domain)).instances.values())
+        if self._instances is None:
+            self._instances = [instance for domain in self.get_domains() for instance in domain.instances.values()]
+        return list(self._instances)
+
+    def select(self, selectors):
+        # Containers, in stack order, matched by any of the selectors: globs of full names of any kind ("*.prod",
+        # "web.*.prod") or of one kind ("instance:*.prod", "service:web.prod", "container:db.*"). A selected domain,
+        # instance or service stands for its containers. All selectors are matched in one scan of the domains they
+        # can reach.
+        patterns = {}
+        domains = set()
+        for selector in selectors:
+            kind, pattern = selector.split(":", 1) if ":" in selector else (None, selector)
+            if kind is not None and kind not in SELECTOR_KINDS.values():
+                raise ValueError("Unknown selector kind %s, expected one of %s" % (
+                    kind, ", ".join(SELECTOR_KINDS.values())
+                ))
+            patterns.setdefault(kind, []).append(fnmatch.translate(pattern))
+            domains.add(_selector_domain(kind, pattern))
+        regexes = {kind: re.compile("|".join(x)) for kind, x in patterns.items()}
+        any_regex = regexes.pop(None, None)
+
+        selected = set()
+        for name in self.domain_names if None in domains else [x for x in self.domain_names if x in domains]:
+            domain = self.get_domain(name)
+            for item_name, item in [(name, domain)] + list(domain.get_index()[0].items()):
+                regex = regexes.get(SELECTOR_KINDS[type(item)])
+                if not (any_regex and any_regex.match(item_name) or regex and regex.match(item_name)):
+                    continue
+                if isinstance(item, Container):
+                    selected.add(item_name)
+                elif isinstance(item, Service):
+                    selected.update(item.containers)
+                else:
+                    for instance in [item] if isinstance(item, Instance) else item.instances.values():
+                        selected.update(instance.containers)
+
+        containers = []
+        selected_domains = set(x.rsplit(".", 1)[1] for x in selected)
+        for name in self.domain_names:
+            if name in selected_domains:
+                for instance in self.get_domain(name).instances.values():
+                    containers += [x for x in instance.containers.values() if str(x) in selected]
+        return containers
 
     def get_root_instance(self, domain):
         for instance in domain.instances.values():
@@ -238,16 +516,10 @@ class Stack:
 
     def __getitem__(self, item):
         if item.count(".") == 0:
-            return self.domains[item]
-        elif item.count(".") == 1:
-            try:
-                return self.domains[item.split(".")[-1]].instances[item]
-            except Exception:
-                pass
-            try:
-                return self.domains[item.split(".")[-1]].services[item]
-            except Exception:
-                pass
-            raise ValueError("No services or instances found by name %s" % item)
-        elif item.count(".") == 2:
-            return self.domains[item.split(".")[-1]].instances[item.split(".", 1)[-1]].containers[item]
+            return self.get_domain(item)
+        try:
+            return self.get_domain(item.rsplit(".", 1)[1]).get_index()[0][item]
+        except KeyError:
+            if item.count(".") == 1:
+                raise ValueError("No services or instances found by name %s" % item)
+            raise
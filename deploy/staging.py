@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import tempfile
+from fnmatch import fnmatch
+from threading import Lock
+
+
+FILE_HASHES_FILE = ".deploy/file_hashes.json"
+REMOTE_SOURCE_DIR = "/home/ubuntu/serv_files_orig"
+REMOTE_STAGING_DIR = "/home/ubuntu/serv_build"
+
+
+def get_common_modules(project_dir="."):
+    common_dir = os.path.join(project_dir, "_common")
+    if not os.path.isdir(common_dir):
+        return []
+    return sorted(
+        module for module in os.listdir(common_dir)
+        if os.path.isdir(os.path.join(common_dir, module, module))
+    )
+
+
+def get_build_context(container, project_dir="."):
+    # (path in the project, path inside the build context) for everything `docker build` of the container sees:
+    # the build directory itself plus every _common/<module>/<module> package copied next to it
+    if not container.build:
+        return []
+    return [(container.build, ".")] + [
+        (os.path.join("_common", module, module), module)
+        for module in get_common_modules(project_dir)
+    ]
+
+
+def sync_build_contexts(stack, env, containers):
+    paths = list(dict.fromkeys(
+        "./%s" % path
+        for container in containers
+        for path, _ in get_build_context(container)
+    ))
+    if not paths:
+        return
+    env.run("mkdir -p %s" % REMOTE_SOURCE_DIR)
+    env.sync(
+        local_dir=paths,
+        exclude=[".git", ".deploy"] + stack.vars.get("rsync_exclude", "").split(";"),
+        remote_dir=REMOTE_SOURCE_DIR,
+        delete=True,
+        relative=True
+    )
+
+
+def stage_build_context(env, container):
+    # Assembles the build context from hardlinks to the synced sources, so staging costs no data copies.
+    # rsync replaces changed files with new inodes, so a staged context never changes under a running build.
+    staging_dir = "%s/%s" % (REMOTE_STAGING_DIR, container)
+    commands = ["rm -rf %s" % staging_dir, "mkdir -p %s" % staging_dir]
+    for path, context_path in get_build_context(container):
+        if context_path == ".":
+            commands.append("cp -al %s/%s/. %s/" % (REMOTE_SOURCE_DIR, path, staging_dir))
+        else:
+            commands.append("cp -al %s/%s %s/%s" % (REMOTE_SOURCE_DIR, path, staging_dir, context_path))
+    env.run_batch(commands, hide=True)
+    return staging_dir
+
+
+def stage_local_build_context(env, container):
+    # Local counterpart of stage_build_context, the caller removes the returned directory after the build
+    staging_dir = tempfile.mktemp()
+    for path, context_path in get_build_context(container):
+        if context_path == ".":
+            env.run("cp -R %s %s" % (path, staging_dir))
+        else:
+            env.run("cp -R %s %s/%s" % (path, staging_dir, context_path))
+    return staging_dir
+
+
+_file_hashes = None
+_file_hashes_lock = Lock()
+
+
+def _get_file_hash(path):
+    # Content digests are remembered by (size, mtime) in .deploy/file_hashes.json, so unchanged files are not reread
+    global _file_hashes
+    stat = os.stat(path)
+    with _file_hashes_lock:
+        if _file_hashes is None:
+            try:
+                with open(FILE_HASHES_FILE) as fd:
+                    _file_hashes = json.load(fd)
+            except (IOError, ValueError):
+                _file_hashes = {}
+        cached = _file_hashes.get(path)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    cipher = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+            cipher.update(chunk)
+    with _file_hashes_lock:
+        _file_hashes[path] = [stat.st_size, stat.st_mtime_ns, cipher.hexdigest()]
+    return cipher.hexdigest()
+
+
+def _save_file_hashes():
+    with _file_hashes_lock:
+        if _file_hashes is None:
+            return
+        os.makedirs(os.path.dirname(FILE_HASHES_FILE), exist_ok=True)
+        with open(FILE_HASHES_FILE + ".tmp", "w") as fd:
+            json.dump(_file_hashes, fd)
+        os.rename(FILE_HASHES_FILE + ".tmp", FILE_HASHES_FILE)
+
+
+def _is_excluded(path, exclude):
+    # Approximates rsync exclude semantics: a pattern matches the file name or the path relative to the project
+    return any(pattern and (fnmatch(os.path.basename(path), pattern) or fnmatch(path, pattern)) for pattern in exclude)
+
+
+def get_build_hash(stack, container):
+    # Hash of everything that determines the image: file names, modes and contents of the build context as it is
+    # assembled remotely, plus the Dockerfile used. Stored as the BUILD_HASH image label.
+    exclude = [".git", ".deploy"] + stack.vars.get("rsync_exclude", "").split(";")
+    cipher = hashlib.sha256()
+    cipher.update(("docker_file:%s\n" % container.docker_file).encode("utf8"))
+    for path, context_path in get_build_context(container):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(x for x in dirs if not _is_excluded(os.path.join(root, x), exclude))
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                if _is_excluded(file_path, exclude):
+                    continue
+                relative_path = os.path.normpath(os.path.join(context_path, os.path.relpath(file_path, path)))
+                if os.path.islink(file_path):
+                    digest = "link:%s" % os.readlink(file_path)
+                else:
+                    digest = _get_file_hash(file_path)
+                cipher.update(("%s %o %s\n" % (
+                    relative_path, os.lstat(file_path).st_mode & 0o777, digest
+                )).encode("utf8"))
+    _save_file_hashes()
+    return cipher.hexdigest()[:32]
@@ -0,0 +1,86 @@
+from collections import deque
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _decode(line):
+    return line.decode("utf8", errors="replace").strip()
+
+
+class LineSplitter:
+    # Turns chunks of bytes into decoded lines. UTF-8 multibyte sequences never contain b"\n", so per-line decoding
+    # is safe.
+    def __init__(self):
+        self.pending = []
+
+    def feed(self, chunk):
+        parts = chunk.split(b"\n")
+        if len(parts) == 1:
+            self.pending.append(chunk)
+            return []
+        self.pending.append(parts[0])
+        lines = [_decode(b"".join(self.pending))] + [_decode(part) for part in parts[1:-1]]
+        self.pending = [parts[-1]] if parts[-1] else []
+        return lines
+
+    def flush(self):
+        lines = [_decode(b"".join(self.pending))] if self.pending else []
+        self.pending = []
+        return lines
+
+
+def iter_lines(read, chunk_size=CHUNK_SIZE):
+    # `read` must return whatever is available (up to chunk_size) and b"" on EOF, e.g. BufferedReader.read1
+    # or paramiko Channel.recv
+    splitter = LineSplitter()
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        for line in splitter.feed(chunk):
+            yield line
+    for line in splitter.flush():
+        yield line
+
+
+class OutputBuffer:
+    def __init__(self, max_lines=None, max_bytes=None):
+        self.lines = deque(maxlen=max_lines)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.dropped = 0
+
+    def append(self, line):
+        if self.lines.maxlen == 0:
+            # max_lines=0 keeps nothing, only the count of dropped lines
+            self.dropped += 1
+            return
+        if self.lines.maxlen is not None and len(self.lines) == self.lines.maxlen:
+            self._drop()
+        self.lines.append(line)
+        self.size += len(line) + 1
+        if self.max_bytes is not None:
+            while len(self.lines) > 1 and self.size > self.max_bytes:
+                self._drop()
+
+    def _drop(self):
+        self.size -= len(self.lines.popleft()) + 1
+        self.dropped += 1
+
+    def pop(self):
+        line = self.lines.pop()
+        self.size -= len(line) + 1
+        return line
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, item):
+        return self.lines[item]
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def text(self):
+        return "\n".join(self.lines)
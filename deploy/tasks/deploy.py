@@ -1,20 +1,26 @@
 import pkg_resources
-import tempfile
 from jinja2 import Template
 
-from deploy.docker_manager import DockerManager
+from deploy.docker_manager import DockerManager, container_hash
 from deploy.environment import LocalEnvironment, EnvironmentFactory
-from deploy.kube_manager import KubeManager
-from deploy.utils import get_nonce, wait_for_cloud_init
-from deploy.tasks.log import log
-
-
-def deploy(mode, stack, service):
-    print("\033[1;37;40mDeploying service %s @ %s\033[0m" % (service, mode))
+from deploy.kube_manager import get_kube_manager
+from deploy.facts import HostFacts, gather_facts, recipe_hash, GATHER_FACTS_CMD
+from deploy.rollout import wait_for_rollout
+from deploy.scheduler import Scheduler
+from deploy.staging import (
+    get_build_hash, sync_build_contexts, stage_build_context, stage_local_build_context
+)
+from deploy.stack import Domain, Instance, Service, is_selector
+
+
+def deploy(mode, stack, targets, refresh_facts=False, jobs=None):
+    if isinstance(targets, str):
+        targets = [targets]
+    print("\033[1;37;40mDeploying %s @ %s\033[0m" % (", ".join(targets), mode))
     if mode == "dev":
-        deploy_dev(stack, service)
+        deploy_dev(stack, targets, jobs)
     elif mode == "prod":
-        deploy_prod(stack, service)
+        deploy_prod(stack, targets, refresh_facts, jobs)
 
     # openvpn_j2_template = Template(pkg_resources.resource_string("deploy", "templates/gateway.ovpn.j2"))
     # rendered_data = None
@@ -26,102 +32,403 @@ def deploy(mode, stack, service):
     # if rendered_data:
     #     open("ovpn_%s.ovpn" % mode, "w").write(rendered_data)
 
-    log(mode, stack, service)
+    if len(targets) == 1 and len(targets[0].split(".")) == 3:
+        # Imported here, log resolves its targets with this module
+        from deploy.tasks.log import log
+        log(mode, stack, targets[0])
+
+
+def resolve_deploy_targets(stack, targets):
+    # Full names give the object they name, selectors (see Stack.select) the containers they match
+    selectors = [target for target in targets if is_selector(target)]
+    containers = stack.select(selectors) if selectors else []
+    services = []
+    for target in targets:
+        if target in selectors:
+            continue
+        item = stack[target]
+        if isinstance(item, Domain):
+            for instance in item.instances.values():
+                containers += instance.containers.values()
+            services += item.services.values()
+        elif isinstance(item, Instance):
+            containers += item.containers.values()
+        elif isinstance(item, Service):
+            services.append(item)
+        else:
+            containers.append(item)
+    return list(dict.fromkeys(containers)), list(dict.fromkeys(services))
+
+
+def get_jobs(stack, jobs=None):
+    return int(jobs or stack.vars.get("deploy_jobs", 4))
+
+
+def get_depends_on(container, containers, prefix):
+    # Only dependencies deployed in the same run are ordered, others are assumed to be running already
+    names = [str(x) for x in containers]
+    return ["%s:%s" % (prefix, dependency) for dependency in container.depends_on if dependency in names]
+
+
+def deploy_dev(stack, targets, jobs=None):
+    if isinstance(targets, str):
+        targets = [targets]
+    containers, services = resolve_deploy_targets(stack, targets)
+    if services:
+        print("Deploying services is not supported in dev mode, skipping %s" % ", ".join(str(x) for x in services))
+    scheduler = Scheduler(get_jobs(stack, jobs))
+    scheduler.add("prepare", lambda: deploy_dev_prepare(stack, containers))
+    for container in containers:
+        scheduler.add(
+            "container:%s" % container,
+            lambda container=container: deploy_dev_container(stack, container),
+            ["prepare"] + get_depends_on(container, containers, "container")
+        )
+    scheduler.run()
 
 
-def deploy_dev(stack, service):
-    local_env = LocalEnvironment()
-    docker_manager = DockerManager(stack, local_env)
+def deploy_dev_prepare(stack, containers):
+    docker_manager = DockerManager(stack, EnvironmentFactory.get_local())
 
+    networks = docker_manager.get_networks()
     for domain in stack.get_domains():
-        if str(domain) not in docker_manager.get_networks():
+        if str(domain) not in networks:
             docker_manager.add_network(str(domain))
 
-    for volume in stack[service].instance.volumes:
-        if volume not in docker_manager.get_volumes():
-            docker_manager.add_volume(volume)
+    instance_volumes = docker_manager.get_volumes()
+    for instance in dict.fromkeys(container.instance for container in containers):
+        for volume in instance.volumes:
+            if volume not in instance_volumes:
+                docker_manager.add_volume(volume)
 
-    container = stack[service]
-    volumes = container.volumes
-    image_name = None
-    if container.build:
-        image_name = str(container)
-        tmp_dir = tempfile.mktemp()
-        local_env.run("cp -R %s %s" % (container.build, tmp_dir))
-        modules = local_env.run("ls _common/", hide=True)["stdout"].split("\n")
-        for module in modules:
-            local_env.run("cp -R _common/%s/%s %s" % (module, module, tmp_dir))
-        docker_manager.build_image(tmp_dir, str(container), docker_file=container.docker_file)
-        local_env.run("rm -Rf %s" % tmp_dir)
-    elif container.run:
-        image_name = container.run
-        docker_manager.pull_image(container.run)
-    image = docker_manager.get_images(get_all=True)[image_name]
-    add_container_parms = {
-        "image": image_name,
+
+def get_dev_container_parms(container):
+    return {
+        "image": str(container) if container.build else container.run,
         "name": str(container),
         "privileged": container.is_privileged,
         "network": str(container.instance.domain),
-        "volumes": volumes,
+        "volumes": container.volumes,
         "expose": container.expose,
         "envs": container.env,
     }
-    nonce = get_nonce(add_container_parms)
 
-    if (
-        str(container) in docker_manager.get_containers() and (
-            docker_manager.get_containers()[str(container)]["Config"]["Labels"].get("NONCE") != nonce or
-            not docker_manager.get_containers()[str(container)]["Image"].startswith("sha256:%s" % image["Id"])
-        )
-    ):
+
+def deploy_dev_build_image(stack, env, container, build_hash):
+    docker_manager = DockerManager(stack, env)
+    tmp_dir = stage_local_build_context(env, container)
+    image = docker_manager.build_image(
+        tmp_dir, str(container), docker_file=container.docker_file, labels={"BUILD_HASH": build_hash}
+    )
+    env.run("rm -Rf %s" % tmp_dir)
+    return image
+
+
+def deploy_dev_container(stack, container):
+    local_env = EnvironmentFactory.get_local()
+    docker_manager = DockerManager(stack, local_env)
+
+    image = None
+    if container.build:
+        build_hash = get_build_hash(stack, container)
+        image = docker_manager.find_images("BUILD_HASH", [build_hash])[build_hash]
+        if image:
+            image = docker_manager.tag_image(image, str(container))
+        else:
+            image = deploy_dev_build_image(stack, local_env, container, build_hash)
+    elif container.run:
+        image = docker_manager.pull_image(container.run)
+    add_container_parms = dict(get_dev_container_parms(container), image_id=image["Id"])
+
+    # The ledger holds the hash each container was created with, covering its parameters and image
+    ledger = docker_manager.get_ledger()
+    key = ("container", str(container))
+    if key in ledger:
+        if ledger[key] == container_hash(**add_container_parms):
+            return
         docker_manager.remove_container(str(container))
+    docker_manager.add_container(**add_container_parms)
+
+
+def deploy_prod(stack, targets, refresh_facts=False, jobs=None):
+    # Shared steps (bootstrap and project sync per host, namespace init per domain) are added once and every
+    # container or service only waits for the steps it needs
+    if isinstance(targets, str):
+        targets = [targets]
+    containers, services = resolve_deploy_targets(stack, targets)
+    scheduler = Scheduler(get_jobs(stack, jobs))
+
+    domains = list(dict.fromkeys(container.instance.domain for container in containers))
+    instances = [instance for domain in domains for instance in domain.instances.values()]
+    warm_instances(stack, instances)
+    add_bootstrap_tasks(scheduler, stack, instances, refresh_facts)
+    for domain in domains:
+        root_env = get_root_env(stack, domain)
+        scheduler.add(
+            "namespace:%s" % domain,
+            lambda root_env=root_env, domain=domain: deploy_prod_initialize_kube_namespaces(stack, root_env, domain),
+            ["kube:%s" % instance for instance in domain.instances.values()]
+        )
 
-    if str(container) not in docker_manager.get_containers():
-        add_container_parms["nonce"] = nonce
-        docker_manager.add_container(**add_container_parms)
-
-
-def deploy_prod(stack, service):
-    if len(service.split(".")) == 2:
-        # Deploying service
-        root_instance = stack.get_root_instance(stack[service].domain)
-        root_env = EnvironmentFactory.get_remote(root_instance.public_ip, root_instance.public_port)
-        kube_manager = KubeManager(stack, root_env)
-        kube_manager.add_service(service, ports=stack[service].ports, expose=stack[service].expose)
-        for container in stack[service].containers:
-            kube_manager.label_container(container, "service-%s" % service.rsplit(".", 1)[0], "true")
-    elif len(service.split(".")) == 3:
-        for instance in stack.get_instances():
-            print("\033[1;37;40mBootstraping %s (%s)\033[0m" % (str(instance), instance.public_ip))
+    build_on = stack.vars.get("build_on", "instance")
+    if build_on == "instance":
+        add_instance_build_tasks(scheduler, stack, containers)
+    elif build_on in ("root", "local"):
+        add_shared_build_tasks(scheduler, stack, containers, build_on)
+    else:
+        raise ValueError("Unknown build_on %s, expected instance, root or local" % build_on)
+
+    for container in containers:
+        root_env = get_root_env(stack, container.instance.domain)
+        scheduler.add(
+            "pod:%s" % container,
+            lambda root_env=root_env, container=container: deploy_prod_service(
+                stack, root_env, container, scheduler.results["build:%s" % container]
+            ),
+            ["build:%s" % container, "namespace:%s" % container.instance.domain] +
+            get_depends_on(container, containers, "pod")
+        )
+
+    for service in services:
+        scheduler.add(
+            "service:%s" % service,
+            lambda service=service: deploy_prod_kube_service(stack, get_root_env(stack, service.domain), service),
+            ["pod:%s" % container for container in service.containers if "pod:%s" % container in scheduler]
+        )
+
+    scheduler.run()
+    created = [str(container) for container in containers if scheduler.results["pod:%s" % container]]
+    if created:
+        wait_for_rollout(stack, created)
+
+
+def add_instance_build_tasks(scheduler, stack, containers):
+    # Every instance builds the images of its own containers
+    for instance in dict.fromkeys(container.instance for container in containers):
+        build_containers = [x for x in containers if x.instance == instance and x.build]
+        if build_containers:
             env = EnvironmentFactory.get_remote(instance.public_ip, instance.public_port)
-            deploy_prod_bootstrap(stack, env, instance)
-        # Deploying container
-        root_instance = stack.get_root_instance(stack[service].instance.domain)
-
-        print("\033[1;37;40mBuilding docker image\033[0m")
-        env = EnvironmentFactory.get_remote(stack[service].instance.public_ip, stack[service].instance.public_port)
-        image = deploy_prod_build_docker_images(stack, env, stack[service])
-
-        print("\033[1;37;40mDeploying service\033[0m")
-        env = EnvironmentFactory.get_remote(root_instance.public_ip, root_instance.public_port)
-        deploy_prod_initialize_kube_namespaces(stack, env, root_instance.domain)
-        deploy_prod_service(stack, env, stack[service], image)
-
-
-def deploy_prod_bootstrap(stack, env, instance):
-    wait_for_cloud_init(env)
-    env.run("apt-get install -y software-properties-common", hide=True)
-    print(" - Checking for curl")
-    if "command not found" in env.run("curl", hide=True, ignore_errors=True)["stderr"]:
-        env.run("apt-get install -y curl")
-
-    print(" - Checking for hostname")
-    if env.run("hostname", hide=True)["stdout"].strip() != str(instance):
-        print(" - Setting up host")
-        env.run("echo \"\" >> /etc/hosts")
-        env.run("echo \"%s %s\" >> /etc/hosts" % (instance.public_ip, instance))
-        env.run("echo %s > /etc/hostname" % str(instance))
-        env.run("hostname %s" % str(instance))
+            scheduler.add(
+                "sync:%s" % instance,
+                lambda env=env, build_containers=build_containers: deploy_prod_prepare_builds(
+                    stack, env, build_containers
+                ),
+                ["bootstrap:%s" % instance]
+            )
+
+    for container in containers:
+        env = EnvironmentFactory.get_remote(container.instance.public_ip, container.instance.public_port)
+        scheduler.add(
+            "build:%s" % container,
+            lambda env=env, container=container: deploy_prod_build_docker_image(
+                stack, env, container,
+                scheduler.results["sync:%s" % container.instance][str(container)] if container.build else None
+            ),
+            ["sync:%s" % container.instance if container.build else "bootstrap:%s" % container.instance]
+        )
+
+
+def add_shared_build_tasks(scheduler, stack, containers, build_on):
+    # Each distinct build context is built once, on the domain root instance or locally, as image:<builder>:<hash>.
+    # ship:<hash>:<instance> streams it to every instance that runs it and does not have it yet, in parallel, and
+    # build:<container> only tags the shipped image on the container's instance. A remote builder syncs the contexts
+    # of all its images in one sync:<builder> task first, builds running side by side never sync the same tree.
+    builds = []
+    builders = {}
+    for container in containers:
+        if not container.build:
+            builds.append((container, None, None, None))
+            continue
+        if build_on == "local":
+            builder = "local"
+            builder_env = EnvironmentFactory.get_local()
+            builder_deps = []
+        else:
+            root_instance = stack.get_root_instance(container.instance.domain)
+            builder = str(root_instance)
+            builder_env = get_root_env(stack, container.instance.domain)
+            builder_deps = ["bootstrap:%s" % root_instance]
+            builders.setdefault(builder, (builder_env, builder_deps, []))[2].append(container)
+        builds.append((container, builder, builder_env, builder_deps))
+
+    for builder, (builder_env, builder_deps, build_containers) in builders.items():
+        scheduler.add(
+            "sync:%s" % builder,
+            lambda builder_env=builder_env, build_containers=build_containers: deploy_prod_prepare_builds(
+                stack, builder_env, build_containers
+            ),
+            builder_deps
+        )
+
+    for container, builder, builder_env, builder_deps in builds:
+        env = EnvironmentFactory.get_remote(container.instance.public_ip, container.instance.public_port)
+        if not container.build:
+            scheduler.add(
+                "build:%s" % container,
+                lambda env=env, container=container: deploy_prod_build_docker_image(stack, env, container),
+                ["bootstrap:%s" % container.instance]
+            )
+            continue
+
+        build_hash = get_build_hash(stack, container)
+        image_task = scheduler.add(
+            "image:%s:%s" % (builder, build_hash),
+            lambda builder=builder, builder_env=builder_env, container=container, build_hash=build_hash:
+                deploy_prod_build_shared_image(
+                    stack, builder_env, container, build_hash,
+                    scheduler.results["sync:%s" % builder][str(container)] if builder in builders else None
+                ),
+            ["sync:%s" % builder] if builder in builders else builder_deps
+        )
+        ship_task = scheduler.add(
+            "ship:%s:%s" % (build_hash, container.instance),
+            lambda builder_env=builder_env, env=env, build_hash=build_hash: deploy_prod_ship_image(
+                stack, builder_env, env, build_hash
+            ),
+            [image_task, "bootstrap:%s" % container.instance]
+        )
+        scheduler.add(
+            "build:%s" % container,
+            lambda env=env, container=container, build_hash=build_hash: deploy_prod_use_shared_image(
+                stack, env, container, build_hash
+            ),
+            [ship_task]
+        )
+
+
+def get_root_env(stack, domain):
+    root_instance = stack.get_root_instance(domain)
+    return EnvironmentFactory.get_remote(root_instance.public_ip, root_instance.public_port)
+
+
+def warm_instances(stack, instances):
+    # Connects to the instances and the roots of their domains in parallel before the first step needs them
+    instances = list(instances) + [stack.get_root_instance(instance.domain) for instance in instances]
+    EnvironmentFactory.warm([(instance.public_ip, instance.public_port) for instance in instances])
+
+
+def deploy_prod_kube_service(stack, env, service):
+    print(" - Creating kubernetes service %s" % service)
+    kube_manager = get_kube_manager(stack, env)
+    kube_manager.add_service(str(service), ports=service.ports, expose=service.expose)
+    for container in service.containers:
+        kube_manager.label_container(container, "service-%s" % str(service).rsplit(".", 1)[0], "true")
+
+
+SETUP_HOST = [
+    "echo \"\" >> /etc/hosts",
+    "echo \"{public_ip} {instance}\" >> /etc/hosts",
+    "echo {instance} > /etc/hostname",
+    "hostname {instance}"
+]
+SETUP_DOCKER = [
+    "curl -fsSL https://download.docker.com/linux/ubuntu/gpg | apt-key add -",
+    "apt-key fingerprint 0EBFCD88",
+    "add-apt-repository \"deb [arch=amd64] https://download.docker.com/linux/ubuntu $(lsb_release -cs) stable\"",
+    "apt-get update -y",
+    "apt-get install -y docker-ce",
+    "systemctl enable docker",
+    "systemctl restart docker"
+]
+SETUP_KUBERNETES = [
+    "curl -s https://packages.cloud.google.com/apt/doc/apt-key.gpg | apt-key add",
+    "echo \"deb http://apt.kubernetes.io/ kubernetes-xenial main\" > /etc/apt/sources.list.d/kubernetes.list",
+    "apt-get update",
+    "apt-get install -y kubelet=1.19.0-00 kubeadm=1.19.0-00 kubectl=1.19.0-00 kubernetes-cni=0.8.6-00"
+]
+KUBE_INIT = [
+    "kubeadm init --token 40iy4i.mg57avb3c9ih1fob --token-ttl 0 --pod-network-cidr=10.244.0.0/16 --ignore-preflight-errors=NumCPU,swap,SystemVerification",
+    "mkdir -p $HOME/.kube",
+    "cp -i /etc/kubernetes/admin.conf $HOME/.kube/config",
+    "kubectl apply -f https://raw.githubusercontent.com/coreos/flannel/master/Documentation/kube-flannel.yml",
+    "kubectl apply -f https://raw.githubusercontent.com/coreos/flannel/master/Documentation/k8s-manifests/kube-flannel-rbac.yml",
+    # "kubectl -n kube-system apply -f https://raw.githubusercontent.com/coreos/flannel/bc79dd1505b0c8681ece4de4c0d86c5cd2643275/Documentation/kube-flannel.yml",
+    "kubectl taint nodes {instance} node-role.kubernetes.io/master:NoSchedule-"
+]
+KUBE_JOIN = [
+    "kubeadm join {root_ip}:6443 --token 40iy4i.mg57avb3c9ih1fob --discovery-token-unsafe-skip-ca-verification --ignore-preflight-errors=NumCPU,SystemVerification,swap",
+    "touch ~/.kube_slave"
+]
+BOOTSTRAP_RECIPE = recipe_hash(GATHER_FACTS_CMD, SETUP_HOST, SETUP_DOCKER, SETUP_KUBERNETES, KUBE_INIT, KUBE_JOIN)
+
+
+def is_kube_initialized(instance, facts):
+    return facts["kube" if instance.is_root else "kube_slave"]
+
+
+def is_bootstrapped(instance, facts):
+    return bool(
+        facts and
+        facts["hostname"] == str(instance) and
+        facts["software_properties"] and facts["curl"] and facts["docker"] and facts["kubeadm"] and
+        is_kube_initialized(instance, facts)
+    )
+
+
+def add_bootstrap_tasks(scheduler, stack, instances, refresh_facts=False):
+    # bootstrap:<instance> sets the host up, kube:<instance> runs kubeadm init on the root instance and kubeadm
+    # join on the others once their root is done. Instances whose cached facts say they are fully bootstrapped with
+    # the current recipe are not contacted at all.
+    host_facts = HostFacts(ttl=int(stack.vars.get("facts_ttl", 86400)))
+    instances = list(dict.fromkeys(
+        list(instances) + [stack.get_root_instance(instance.domain) for instance in instances]
+    ))
+
+    def bootstrap_host(instance):
+        facts = host_facts.get(instance, BOOTSTRAP_RECIPE)
+        if not refresh_facts and is_bootstrapped(instance, facts):
+            print(" - [%s] Bootstrap is up to date" % instance)
+            return facts
+        env = EnvironmentFactory.get_remote(instance.public_ip, instance.public_port)
+        try:
+            facts = deploy_prod_bootstrap_host(stack, env, instance)
+        except Exception:
+            host_facts.invalidate(instance)
+            raise
+        if is_bootstrapped(instance, facts):
+            host_facts.set(instance, BOOTSTRAP_RECIPE, facts)
+        return facts
+
+    def bootstrap_kube(instance):
+        facts = scheduler.results["bootstrap:%s" % instance]
+        if is_bootstrapped(instance, facts):
+            return
+        env = EnvironmentFactory.get_remote(instance.public_ip, instance.public_port)
+        try:
+            deploy_prod_bootstrap_kube(stack, env, instance, is_kube_initialized(instance, facts))
+        except Exception:
+            host_facts.invalidate(instance)
+            raise
+        host_facts.set(instance, BOOTSTRAP_RECIPE, gather_facts(env))
+
+    for instance in instances:
+        scheduler.add("bootstrap:%s" % instance, lambda instance=instance: bootstrap_host(instance))
+        scheduler.add(
+            "kube:%s" % instance,
+            lambda instance=instance: bootstrap_kube(instance),
+            ["bootstrap:%s" % instance] + (
+                [] if instance.is_root else ["kube:%s" % stack.get_root_instance(instance.domain)]
+            )
+        )
+
+
+def deploy_prod_bootstrap_host(stack, env, instance):
+    facts = gather_facts(env)
+
+    commands = []
+    if not facts["software_properties"]:
+        commands.append("apt-get install -y software-properties-common")
+    print(" - [%s] Checking for curl" % instance)
+    if not facts["curl"]:
+        commands.append("apt-get install -y curl")
+
+    print(" - [%s] Checking for hostname" % instance)
+    is_reboot_needed = facts["hostname"] != str(instance)
+    if is_reboot_needed:
+        print(" - [%s] Setting up host" % instance)
+        commands += [cmd.format(instance=instance, public_ip=instance.public_ip) for cmd in SETUP_HOST]
+    env.run_batch(commands)
+    if is_reboot_needed:
         env.reboot()
 
     #print(" - Checking swap")
@@ -132,41 +439,33 @@ def deploy_prod_bootstrap(stack, env, instance):
     #     env.run("mkswap /swapfile")
     #     env.run("swapon /swapfile")
 
-    print(" - Checking for docker")
-    if "command not found" in env.run("docker --version", hide=True, ignore_errors=True)["stderr"]:
-        print(" - Setting up docker")
-        env.run("curl -fsSL https://download.docker.com/linux/ubuntu/gpg | apt-key add -")
-        env.run("apt-key fingerprint 0EBFCD88")
-        env.run("add-apt-repository \"deb [arch=amd64] https://download.docker.com/linux/ubuntu $(lsb_release -cs) stable\"")
-        env.run("apt-get update -y")
-        env.run("apt-get install -y docker-ce")
-        env.run("systemctl enable docker")
-        env.run("systemctl restart docker")
-
-
-    print(" - Checking for kubernetes")
-    if "command not found" in env.run("kubeadm", hide=True, ignore_errors=True)["stderr"]:
-        print(" - Setting up kubernetes")
-        env.run("curl -s https://packages.cloud.google.com/apt/doc/apt-key.gpg | apt-key add")
-        env.run("echo \"deb http://apt.kubernetes.io/ kubernetes-xenial main\" > /etc/apt/sources.list.d/kubernetes.list")
-        env.run("apt-get update")
-        env.run("apt-get install -y kubelet=1.19.0-00 kubeadm=1.19.0-00 kubectl=1.19.0-00 kubernetes-cni=0.8.6-00")
+    commands = []
+    print(" - [%s] Checking for docker" % instance)
+    if not facts["docker"]:
+        print(" - [%s] Setting up docker" % instance)
+        commands += SETUP_DOCKER
+
+    print(" - [%s] Checking for kubernetes" % instance)
+    if not facts["kubeadm"]:
+        print(" - [%s] Setting up kubernetes" % instance)
+        commands += SETUP_KUBERNETES
+
+    env.run_batch(commands)
+    if commands or is_reboot_needed:
+        facts = gather_facts(env)
+    return facts
+
 
+def deploy_prod_bootstrap_kube(stack, env, instance, is_initialized):
+    if is_initialized:
+        return
     if instance.is_root:
         # Master
-        if "No such file" in env.run("stat ~/.kube", hide=True, ignore_errors=True)["stderr"]:
-            env.run("kubeadm init --token 40iy4i.mg57avb3c9ih1fob --token-ttl 0 --pod-network-cidr=10.244.0.0/16 --ignore-preflight-errors=NumCPU,swap,SystemVerification")
-            env.run("mkdir -p $HOME/.kube")
-            env.run("cp -i /etc/kubernetes/admin.conf $HOME/.kube/config")
-            env.run("kubectl apply -f https://raw.githubusercontent.com/coreos/flannel/master/Documentation/kube-flannel.yml")
-            env.run("kubectl apply -f https://raw.githubusercontent.com/coreos/flannel/master/Documentation/k8s-manifests/kube-flannel-rbac.yml")
-            # env.run("kubectl -n kube-system apply -f https://raw.githubusercontent.com/coreos/flannel/bc79dd1505b0c8681ece4de4c0d86c5cd2643275/Documentation/kube-flannel.yml")
-            env.run("kubectl taint nodes %s node-role.kubernetes.io/master:NoSchedule-" % str(instance),)
+        env.run_batch([cmd.format(instance=instance) for cmd in KUBE_INIT])
     else:
         # Slave
-        if "No such file" in env.run("stat ~/.kube_slave", hide=True, ignore_errors=True)["stderr"]:
-            env.run("kubeadm join %s:6443 --token 40iy4i.mg57avb3c9ih1fob --discovery-token-unsafe-skip-ca-verification --ignore-preflight-errors=NumCPU,SystemVerification,swap" % (stack.get_root_instance(instance.domain).public_ip,))
-            env.run("touch ~/.kube_slave")
+        root_ip = stack.get_root_instance(instance.domain).public_ip
+        env.run_batch([cmd.format(root_ip=root_ip) for cmd in KUBE_JOIN])
 
 
 def deploy_prod_initialize_kube_namespaces(stack, env, domain):
@@ -185,79 +484,163 @@ def deploy_prod_initialize_kube_namespaces(stack, env, domain):
         - name: foo
           port: 1234
           targetPort: 1234"""
-    env.run("kubectl create namespace %s" % str(domain), hide=True, ignore_errors=True)
+    commands = [{"cmd": "kubectl create namespace %s" % str(domain), "ignore_errors": True}]
     for instance in domain.instances.values():
-        env.put(service % (str(instance.domain), str(instance).split(".")[0]), "/tmp/svc.yml")
-        env.run("kubectl create -f /tmp/svc.yml && sleep 10", hide=True, ignore_errors=True)
-        env.run("kubectl taint nodes %s node-role.kubernetes.io/master:NoSchedule-" % str(instance), hide=True, ignore_errors=True)
-        env.run("kubectl label node %s node=\"%s\"" % (str(instance), str(instance)), hide=True, ignore_errors=True)
+        commands += [
+            {
+                "cmd": "kubectl create -f - <<'EOF' && sleep 10\n%s\nEOF" % (
+                    service % (str(instance.domain), str(instance).split(".")[0])
+                ),
+                "ignore_errors": True
+            },
+            {
+                "cmd": "kubectl taint nodes %s node-role.kubernetes.io/master:NoSchedule-" % str(instance),
+                "ignore_errors": True
+            },
+            {"cmd": "kubectl label node %s node=\"%s\"" % (str(instance), str(instance)), "ignore_errors": True}
+        ]
+    env.run_batch(commands, hide=True)
+
+
+def deploy_prod_prepare_builds(stack, env, containers):
+    # Looks up images already built from an identical build context and syncs only the contexts that still
+    # need a build. Returns {container: (build hash, existing image or None)}.
+    docker_manager = DockerManager(stack, env)
+    build_hashes = {str(container): get_build_hash(stack, container) for container in containers}
+    images = docker_manager.find_images("BUILD_HASH", list(dict.fromkeys(build_hashes.values())))
+    missing = [container for container in containers if not images[build_hashes[str(container)]]]
+    if missing:
+        print(" - Syncing build contexts")
+        sync_build_contexts(stack, env, missing)
+    return {
+        str(container): (build_hashes[str(container)], images[build_hashes[str(container)]])
+        for container in containers
+    }
 
 
-def deploy_prod_build_docker_images(stack, env, container):
-    docker_manager = DockerManager(stack, env)
+def get_volume_dir(volume):
+    return "/srv/volumes/" + volume.replace(".", "-").replace("_", "-")
 
-    print(" - Syncing project files")
-    env.run("mkdir -p /home/ubuntu/serv_files_orig")
-    env.sync(
-        local_dir=".",
-        exclude=[".git"] + stack.vars.get("rsync_exclude", "").split(";"),
-        remote_dir="/home/ubuntu/serv_files_orig",
-        delete=True
-    )
-    env.run("rm -R /home/ubuntu/serv_files", ignore_errors=True)
-    env.run("cp -R /home/ubuntu/serv_files_orig /home/ubuntu/serv_files")
-    if container.build:
-        modules = env.run("ls /home/ubuntu/serv_files_orig/_common/", hide=True, ignore_errors=True)["stdout"].split("\n")
-        for module in modules:
-            env.run("cp -R /home/ubuntu/serv_files_orig/_common/%s/%s /home/ubuntu/serv_files/%s/%s" % (module, module, container.build, module))
-    env.cd("/home/ubuntu/serv_files")
 
-    print(" - Creating volume directories")
-    for volume in container.instance.volumes:
-        env.run("mkdir -p /srv/volumes/" + volume.replace(".", "-").replace("_", "-"))
+def deploy_prod_create_volume_dirs(env, instance):
+    if instance.volumes:
+        print(" - Creating volume directories")
+        env.run("mkdir -p %s" % " ".join(get_volume_dir(volume) for volume in instance.volumes))
+
+
+def deploy_prod_build_docker_image(stack, env, container, build=None):
+    deploy_prod_create_volume_dirs(env, container.instance)
+    return deploy_prod_get_image(stack, env, container, build)
+
+
+def deploy_prod_get_image(stack, env, container, build=None):
+    docker_manager = DockerManager(stack, env)
 
     print(" - Building docker image")
     if container.build:
-        return docker_manager.build_image(container.build, str(container), docker_file=container.docker_file)
+        build_hash, image = build or deploy_prod_prepare_builds(stack, env, [container])[str(container)]
+        if image:
+            print(" - Image of %s is up to date" % container)
+            return docker_manager.tag_image(image, str(container))
+        build_dir = stage_build_context(env, container)
+        return docker_manager.build_image(
+            build_dir, str(container), docker_file=container.docker_file, labels={"BUILD_HASH": build_hash}
+        )
     elif container.run:
         return docker_manager.pull_image(container.run)
 
 
-def deploy_prod_service(stack, env, container, image):
-    print(" - Creating kubernetes pod")
-    kube_manager = KubeManager(stack, env)
+def get_shared_image_name(build_hash):
+    return "build-%s" % build_hash
 
-    env.cd("/home/ubuntu/serv_files")
-    volumes = container.volumes
-    image_name = container.run or str(container)
-    add_container_parms = {
+
+def deploy_prod_build_shared_image(stack, env, container, build_hash, build=None):
+    docker_manager = DockerManager(stack, env)
+    image_name = get_shared_image_name(build_hash)
+    if isinstance(env, LocalEnvironment):
+        image = docker_manager.find_images("BUILD_HASH", [build_hash])[build_hash]
+    else:
+        # build is what deploy_prod_prepare_builds found for the container, its context is synced if needed
+        _, image = build or deploy_prod_prepare_builds(stack, env, [container])[str(container)]
+    if image:
+        print(" - Image %s is up to date" % image_name)
+        # docker save needs a name to keep the tag on the receiving side
+        return docker_manager.tag_image(image, image_name)
+
+    print(" - Building docker image %s from %s" % (image_name, container.build))
+    if isinstance(env, LocalEnvironment):
+        build_dir = stage_local_build_context(env, container)
+    else:
+        build_dir = stage_build_context(env, container)
+    image = docker_manager.build_image(
+        build_dir, image_name, docker_file=container.docker_file, labels={"BUILD_HASH": build_hash}
+    )
+    if isinstance(env, LocalEnvironment):
+        env.run("rm -Rf %s" % build_dir)
+    return image
+
+
+def deploy_prod_ship_image(stack, source_env, env, build_hash):
+    if env is source_env:
+        return
+    image_name = get_shared_image_name(build_hash)
+    if DockerManager(stack, env).find_images("BUILD_HASH", [build_hash])[build_hash]:
+        print(" - [%s] Image %s is already present" % (env.hostname, image_name))
+        return
+    print(" - [%s] Shipping image %s" % (env.hostname, image_name))
+    transferred = source_env.pipe_to("docker save %s" % image_name, env, "docker load")
+    print(" - [%s] Shipped image %s (%.1f MB)" % (env.hostname, image_name, transferred / 1024.0 / 1024.0))
+
+
+def deploy_prod_use_shared_image(stack, env, container, build_hash):
+    docker_manager = DockerManager(stack, env)
+    deploy_prod_create_volume_dirs(env, container.instance)
+
+    image = docker_manager.find_images("BUILD_HASH", [build_hash])[build_hash]
+    if not image:
+        raise RuntimeError("Image %s of %s is missing on %s" % (
+            get_shared_image_name(build_hash), container, container.instance
+        ))
+    return docker_manager.tag_image(image, str(container))
+
+
+def get_pod_parms(container):
+    return {
         "instance": str(container.instance),
-        "image": image_name,
+        "image": container.run or str(container),
         "name": str(container),
-        "volumes": volumes,
+        "volumes": container.volumes,
         "expose": container.expose,
         "envs": container.env,
         "privileged": container.is_privileged,
         "host_network": container.network == "host",
         "mem_limit": container.mem_limit
     }
-    nonce = get_nonce(add_container_parms)
-    containers = kube_manager.get_containers()
-    if (
-        str(container) in containers and (
-            containers[str(container)]["metadata"]["labels"].get("nonce") != nonce or
-            not containers[str(container)]["status"] or
-            not containers[str(container)]["status"]["imageID"].startswith("docker://sha256:%s" % image["Id"])
-        )
+
+
+def get_pod_services(container):
+    return list(container.instance.domain.get_container_services(container))
+
+
+def deploy_prod_service(stack, env, container, image):
+    kube_manager = get_kube_manager(stack, env)
+
+    add_container_parms = dict(get_pod_parms(container), image_id=image["Id"], services=get_pod_services(container))
+    # One ledger lookup covers the pod and its port services, they all carry the name label of the pod
+    ledger = kube_manager.get_ledger(str(container.instance.domain), "name=%s" % str(container).rsplit(".", 1)[0])
+    pod = ledger.get(("Pod", str(container)))
+    if pod and all(
+        ledger.get(key, {}).get("hash") == spec_hash
+        for key, spec_hash in kube_manager.get_container_hashes(**add_container_parms).items()
     ):
-        kube_manager.stop(str(container))
+        if pod["services"] != sorted(add_container_parms["services"]):
+            print(" - Relabeling kubernetes pod")
+            kube_manager.set_services(str(container), add_container_parms["services"], pod["services"])
+        return False
 
-    containers = kube_manager.get_containers()
-    if str(container) not in containers:
-        add_container_parms["nonce"] = nonce
-        kube_manager.add_container(**add_container_parms)
-        for service in container.instance.domain.services.values():
-            for _container in service.containers:
-                if _container == str(container):
-                    kube_manager.label_container(str(container), "service-%s" % str(service).rsplit(".", 1)[0], "true")
+    print(" - Creating kubernetes pod")
+    if pod:
+        kube_manager.stop(str(container))
+    kube_manager.add_container(**add_container_parms)
+    return True
 
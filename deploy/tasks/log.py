@@ -1,28 +1,86 @@
-from deploy.environment import EnvironmentFactory, LocalEnvironment
-from deploy.kube_manager import KubeManager
+import re
+
+from deploy.environment import EnvironmentFactory
+from deploy.kube_manager import get_kube_manager
 from deploy.docker_manager import DockerManager
+from deploy.logs import LogStream, LogMultiplexer, LogCache, follow_resumable, parse_time
+from deploy.tasks.deploy import resolve_deploy_targets, get_root_env
+
+
+def get_log_containers(stack, targets):
+    # Containers of the targets, services standing for the containers they route to
+    containers, services = resolve_deploy_targets(stack, targets)
+    for service in services:
+        containers += [stack[name] for name in service.containers]
+    return list(dict.fromkeys(containers))
 
 
-def log(mode, stack, service, tail=None):
-    if len(service.split(".")) != 3:
-        print("Logging service is not supported yet")
+def log(mode, stack, targets, tail=None, since=None, until=None, grep=None, cache=False):
+    # Follows the logs of the targets, or with since/until reads them from the local cache `cache` fills
+    if isinstance(targets, str):
+        targets = [targets]
+    containers = get_log_containers(stack, targets)
+    if not containers:
+        print("No containers in %s" % ", ".join(targets))
         return
-    print("\033[1;37;40mGetting logs of service %s @ %s\033[0m" % (service, mode))
+    pattern = re.compile(grep) if grep else None
+    if since or until:
+        return log_cached(mode, containers, since and parse_time(since), until and parse_time(until), pattern)
+    print("\033[1;37;40mGetting logs of %s @ %s\033[0m" % (", ".join(targets), mode))
     tail = tail or 100
     if mode == "dev":
-        return log_dev(stack, service, tail)
+        follow = log_dev(stack)
     elif mode == "prod":
-        return log_prod(stack, service, tail)
+        follow = log_prod(stack)
+
+    def lines(container):
+        log_cache = LogCache(mode, str(container)) if cache else None
+        # A cache resumes where it stopped instead of starting from the tail again
+        last_key, last_count = log_cache.last() if log_cache else (None, 0)
+        result = follow_resumable(follow(container), tail, last_key, last_count)
+        if log_cache:
+            result = log_cache.record(result)
+        return _grep(result, pattern)
+
+    LogMultiplexer([
+        LogStream(str(container), lambda container=container: lines(container)) for container in containers
+    ]).run()
+
+
+def log_cached(mode, containers, since, until, pattern):
+    print("\033[1;37;40mCached logs of %s from %s to %s @ %s\033[0m" % (
+        ", ".join(str(x) for x in containers), since or "start", until or "end", mode
+    ))
+    streams = []
+    for container in containers:
+        log_cache = LogCache(mode, str(container))
+        if not log_cache.get_index():
+            print(" - No cached logs of %s, follow them with --cache first" % container)
+            continue
+        streams.append(LogStream(
+            str(container), lambda log_cache=log_cache: _grep(log_cache.read(since, until), pattern)
+        ))
+    LogMultiplexer(streams).run()
+
+
+def _grep(lines, pattern):
+    for line in lines:
+        if not pattern or pattern.search(line):
+            yield line
+
+
+def log_dev(stack):
+    docker_manager = DockerManager(stack, EnvironmentFactory.get_local())
+    return lambda container: lambda **kwargs: docker_manager.follow_logs(str(container), **kwargs)
 
 
-def log_dev(stack, service, tail):
-    local_env = LocalEnvironment()
-    docker_manager = DockerManager(stack, local_env)
-    docker_manager.logs(service, tail)
+def log_prod(stack):
+    kube_managers = {}
 
+    def follow(container):
+        domain = container.instance.domain
+        if domain not in kube_managers:
+            kube_managers[domain] = get_kube_manager(stack, get_root_env(stack, domain))
+        return lambda **kwargs: kube_managers[domain].follow_logs(str(container), **kwargs)
 
-def log_prod(stack, service, tail):
-    root_instance = stack.get_root_instance(stack[service].instance.domain)
-    env = EnvironmentFactory.get_remote(root_instance.public_ip, root_instance.public_port)
-    kube_manager = KubeManager(stack, env)
-    kube_manager.logs(service, tail=tail)
+    return follow
@@ -1,8 +1,8 @@
 import os
 
-from deploy.environment import EnvironmentFactory, LocalEnvironment
+from deploy.environment import EnvironmentFactory
 from deploy.docker_manager import DockerManager
-from deploy.kube_manager import KubeManager
+from deploy.kube_manager import get_kube_manager
 
 
 def migrate(mode, stack, service, is_rollback=False, revision=None):
@@ -14,7 +14,7 @@ def migrate(mode, stack, service, is_rollback=False, revision=None):
 
 def migrate_dev(stack, service, is_rollback, revision):
     container = stack[service]
-    local_env = LocalEnvironment()
+    local_env = EnvironmentFactory.get_local()
     docker_manager = DockerManager(stack, local_env)
 
     print(" - Running migration task")
@@ -66,13 +66,13 @@ def migrate_prod(stack, service, is_rollback, revision):
     root_instance = stack.get_root_instance(stack[service].instance.domain)
     env = EnvironmentFactory.get_remote(root_instance.public_ip)
     instance_env = EnvironmentFactory.get_remote(container.instance.public_ip)
-    kube_manager = KubeManager(stack, env)
+    kube_manager = get_kube_manager(stack, env)
 
     print(" - Syncing project files")
     instance_env.run("mkdir -p /home/ubuntu/serv_files")
     instance_env.sync(
         local_dir=".",
-        exclude=[".git"],
+        exclude=[".git", ".deploy"],
         remote_dir="/home/ubuntu/serv_files",
         delete=True
     )
@@ -0,0 +1,463 @@
+import json
+import os
+import time
+
+from deploy.docker_manager import DockerManager, container_hash
+from deploy.environment import EnvironmentFactory
+from deploy.facts import HostFacts, gather_facts
+from deploy.kube_manager import KubeManager, get_kube_manager
+from deploy.rollout import wait_for_rollout
+from deploy.scheduler import Scheduler
+from deploy.staging import get_build_hash
+from deploy.spec import object_hash
+from deploy.stack import Container, Domain, Instance
+from deploy.utils import run_parallel, raise_errors
+from deploy.tasks.deploy import (
+    BOOTSTRAP_RECIPE, is_bootstrapped, resolve_deploy_targets, get_jobs, get_depends_on, get_root_env,
+    get_dev_container_parms, get_pod_parms, get_pod_services, get_volume_dir, deploy_dev_build_image,
+    add_bootstrap_tasks, deploy_prod_initialize_kube_namespaces, deploy_prod_get_image, warm_instances
+)
+
+
+PLAN_FILE = ".deploy/plan.json"
+OP_COLORS = {"create": "32", "build": "32", "pull": "32", "run": "32", "replace": "33", "tag": "36", "update": "36"}
+
+
+def plan(mode, stack, targets, plan_file=None, jobs=None):
+    # Takes one snapshot of every node involved, diffs it against the stack and saves the actions needed to get
+    # there, in the order `d apply` runs them. Objects that already match get no action.
+    if isinstance(targets, str):
+        targets = [targets]
+    plan_file = plan_file or PLAN_FILE
+    print("\033[1;37;40mPlanning %s @ %s\033[0m" % (", ".join(targets), mode))
+    containers, services = resolve_deploy_targets(stack, targets)
+    if mode == "dev":
+        actions = plan_dev(stack, containers, services)
+        services = []
+    else:
+        actions = plan_prod(stack, containers, services, jobs)
+    print_plan(actions, containers, services)
+    save_plan(plan_file, mode, targets, actions)
+    if actions:
+        print("Plan written to %s, run `d %sapply %s` to carry it out" % (
+            plan_file, "dev " if mode == "dev" else "", plan_file
+        ))
+    return actions
+
+
+def _add(actions, kind, target, op, reason, depends_on=(), **extra):
+    action_id = "%s:%s" % (kind, target)
+    actions[action_id] = dict(
+        extra, id=action_id, kind=kind, target=str(target), op=op, reason=reason, depends_on=list(depends_on)
+    )
+    return action_id
+
+
+def _finish(actions):
+    # Drops dependencies on objects that need no action and orders the actions so each one comes after its
+    # dependencies, keeping the planning order otherwise
+    ordered = []
+    visited = set()
+
+    def visit(action_id):
+        if action_id in visited:
+            return
+        visited.add(action_id)
+        action = actions[action_id]
+        action["depends_on"] = [x for x in dict.fromkeys(action["depends_on"]) if x in actions]
+        for dependency in action["depends_on"]:
+            visit(dependency)
+        ordered.append(action)
+
+    for action_id in actions:
+        visit(action_id)
+    return ordered
+
+
+def _plan_image(actions, container, images, build_image, build_hash, depends_on):
+    # Adds the action getting the container's image onto its node, if any. Returns the id of the image the container
+    # will run when it is known already, None when it is yet to be built or pulled.
+    if container.build:
+        if not build_image:
+            _add(actions, "image", container, "build", "no image of %s" % container.build, depends_on,
+                 build_hash=build_hash)
+            return None
+        current = images.get(str(container))
+        if not current or current["Id"] != build_image["Id"]:
+            _add(actions, "image", container, "tag", "image of %s exists" % container.build, depends_on,
+                 image=build_image)
+        return build_image["Id"]
+    if container.run:
+        image = images.get(container.run.split(":")[0])
+        if not image:
+            _add(actions, "image", container, "pull", "%s is not on the node" % container.run, depends_on)
+            return None
+        return image["Id"]
+
+
+def plan_dev(stack, containers, services):
+    if services:
+        print("Deploying services is not supported in dev mode, skipping %s" % ", ".join(str(x) for x in services))
+    docker_manager = DockerManager(stack, EnvironmentFactory.get_local())
+    build_hashes = {str(container): get_build_hash(stack, container) for container in containers if container.build}
+    ledger = docker_manager.get_ledger()
+    images = docker_manager.get_images(get_all=True)
+    builds = docker_manager.find_images("BUILD_HASH", list(dict.fromkeys(build_hashes.values()))) if build_hashes else {}
+
+    actions = {}
+    for domain in stack.get_domains():
+        if ("network", str(domain)) not in ledger:
+            _add(actions, "network", domain, "create", "missing")
+    for instance in dict.fromkeys(container.instance for container in containers):
+        for volume in instance.volumes:
+            if ("volume", volume) not in ledger:
+                _add(actions, "volume", volume, "create", "missing")
+
+    for container in containers:
+        build_hash = build_hashes.get(str(container))
+        image_id = _plan_image(actions, container, images, builds.get(build_hash), build_hash, [])
+        depends_on = (
+            ["network:%s" % container.instance.domain, "image:%s" % container] +
+            ["volume:%s" % volume for volume in container.instance.volumes] +
+            get_depends_on(container, containers, "container")
+        )
+        key = ("container", str(container))
+        if key not in ledger:
+            _add(actions, "container", container, "create", "missing", depends_on, image_id=image_id)
+        elif not image_id:
+            _add(actions, "container", container, "replace", "new image", depends_on)
+        elif ledger[key] != container_hash(image_id=image_id, **get_dev_container_parms(container)):
+            _add(actions, "container", container, "replace", "spec changed", depends_on, image_id=image_id)
+    return _finish(actions)
+
+
+def snapshot_instance(stack, instance, build_hashes):
+    # Images by name, the image of every build hash and the volume directories of an instance, in one round trip
+    env = EnvironmentFactory.get_remote(instance.public_ip, instance.public_port)
+    docker_manager = DockerManager(stack, env)
+    results = env.run_batch(
+        [docker_manager.images_command(get_all=True), {"cmd": "ls -1 /srv/volumes", "ignore_errors": True}] +
+        [docker_manager.images_command(label="BUILD_HASH", value=build_hash) for build_hash in build_hashes],
+        hide=True, stop_on_error=False
+    )
+    return {
+        "images": {image["Name"]: image for image in docker_manager.parse_images(results[0]["stdout"])},
+        "volume_dirs": ["/srv/volumes/%s" % x.strip() for x in results[1]["stdout"].split("\n") if x.strip()],
+        "builds": {
+            build_hash: (docker_manager.parse_images(result["stdout"]) or [None])[0]
+            for build_hash, result in zip(build_hashes, results[2:])
+        }
+    }
+
+
+def plan_prod(stack, containers, services, jobs=None):
+    host_facts = HostFacts(ttl=int(stack.vars.get("facts_ttl", 86400)))
+    domains = list(dict.fromkeys(
+        [container.instance.domain for container in containers] + [service.domain for service in services]
+    ))
+    instances = list(dict.fromkeys(container.instance for container in containers))
+    roots = {domain: stack.get_root_instance(domain) for domain in domains}
+    nodes = list(dict.fromkeys(instances + list(roots.values())))
+    build_hashes = {str(container): get_build_hash(stack, container) for container in containers if container.build}
+
+    # The facts cache only holds bootstrapped hosts and expires, a host missing from it (a fresh checkout, facts_ttl
+    # gone by) is asked for its facts again rather than planned from scratch
+    def refresh_facts(instance):
+        facts = gather_facts(EnvironmentFactory.get_remote(instance.public_ip, instance.public_port))
+        if is_bootstrapped(instance, facts):
+            host_facts.set(instance, BOOTSTRAP_RECIPE, facts)
+        return facts
+
+    facts = {instance: host_facts.get(instance, BOOTSTRAP_RECIPE) for instance in nodes}
+    missing = [instance for instance in nodes if not is_bootstrapped(instance, facts[instance])]
+    warm_instances(stack, nodes)
+    if missing:
+        print(" - Gathering facts of %s instances" % len(missing))
+        gathered, errors = run_parallel(refresh_facts, missing, jobs=get_jobs(stack, jobs))
+        raise_errors("Facts", errors)
+        facts.update(gathered)
+    bootstrapped = {instance: is_bootstrapped(instance, facts[instance]) for instance in nodes}
+
+    # Hosts without a bootstrap are not asked anything, everything on them is planned from scratch
+    def snapshot(node):
+        if isinstance(node, tuple):
+            domain = node[1]
+            if not bootstrapped[roots[domain]]:
+                return {"namespace": False, "ledger": {}}
+            return get_kube_manager(stack, get_root_env(stack, domain)).get_snapshot(str(domain))
+        if not bootstrapped[node]:
+            return {"images": {}, "volume_dirs": [], "builds": {}}
+        return snapshot_instance(stack, node, list(dict.fromkeys(
+            build_hashes[str(container)] for container in node.containers.values()
+            if str(container) in build_hashes
+        )))
+
+    print(" - Taking a snapshot of %s instances and %s namespaces" % (len(instances), len(domains)))
+    snapshots, errors = run_parallel(
+        snapshot, instances + [("namespace", domain) for domain in domains], jobs=get_jobs(stack, jobs)
+    )
+    raise_errors("Snapshot", errors)
+
+    # bootstrap:<instance> and kube:<instance> are the steps of add_bootstrap_tasks, apply runs them the same way
+    actions = {}
+    for instance, is_done in bootstrapped.items():
+        if not is_done:
+            root = stack.get_root_instance(instance.domain)
+            _add(actions, "bootstrap", instance, "run", "not bootstrapped according to its facts")
+            _add(actions, "kube", instance, "run", "kubeadm init" if instance.is_root else "kubeadm join",
+                 ["bootstrap:%s" % instance] + ([] if instance.is_root else ["kube:%s" % root]))
+    for domain in domains:
+        if not snapshots[("namespace", domain)]["namespace"]:
+            _add(actions, "namespace", domain, "create", "missing",
+                 ["kube:%s" % instance for instance in domain.instances.values()])
+    for instance in instances:
+        missing = [
+            get_volume_dir(volume) for volume in instance.volumes
+            if get_volume_dir(volume) not in snapshots[instance]["volume_dirs"]
+        ]
+        if missing:
+            _add(actions, "volumes", instance, "create", "%s missing" % len(missing), ["bootstrap:%s" % instance],
+                 paths=missing)
+
+    # KubeManager only renders manifests here, to hash them the way apply stamps them
+    kube_managers = {domain: KubeManager(stack, get_root_env(stack, domain)) for domain in domains}
+    for container in containers:
+        instance_snapshot = snapshots[container.instance]
+        ledger = snapshots[("namespace", container.instance.domain)]["ledger"]
+        build_hash = build_hashes.get(str(container))
+        image_id = _plan_image(
+            actions, container, instance_snapshot["images"], instance_snapshot["builds"].get(build_hash), build_hash,
+            ["kube:%s" % container.instance]
+        )
+        services_of_pod = get_pod_services(container)
+        depends_on = [
+            "namespace:%s" % container.instance.domain, "volumes:%s" % container.instance, "image:%s" % container
+        ] + get_depends_on(container, containers, "pod")
+        pod = ledger.get(("Pod", str(container)))
+        if not pod:
+            _add(actions, "pod", container, "create", "missing", depends_on, image_id=image_id,
+                 services=services_of_pod)
+            continue
+        if not image_id:
+            _add(actions, "pod", container, "replace", "new image", depends_on, services=services_of_pod)
+            continue
+        changed = [
+            name for (kind, name), spec_hash in kube_managers[container.instance.domain].get_container_hashes(
+                image_id=image_id, services=services_of_pod, **get_pod_parms(container)
+            ).items()
+            if ledger.get((kind, name), {}).get("hash") != spec_hash
+        ]
+        if changed:
+            _add(actions, "pod", container, "replace", "%s changed" % ", ".join(changed), depends_on,
+                 image_id=image_id, services=services_of_pod)
+        elif pod["services"] != sorted(services_of_pod):
+            _add(actions, "labels", container, "update", "services changed", [], services=services_of_pod,
+                 previous=pod["services"])
+
+    for service in services:
+        ledger = snapshots[("namespace", service.domain)]["ledger"]
+        changed = []
+        for manifest in kube_managers[service.domain].get_service_manifests(str(service), service.ports, service.expose):
+            entry = ledger.get(("Service", "%s.%s" % (manifest["metadata"]["name"], service.domain)))
+            if not entry or entry["hash"] != object_hash(manifest):
+                changed.append("%s %s" % (manifest["metadata"]["name"], "changed" if entry else "missing"))
+        if changed:
+            _add(
+                actions, "service", service, "apply", ", ".join(changed),
+                ["namespace:%s" % service.domain] + ["pod:%s" % container for container in service.containers]
+            )
+    return _finish(actions)
+
+
+def print_plan(actions, containers, services):
+    for action in actions:
+        print(" - \033[%sm%-8s\033[0m %s (%s)" % (
+            OP_COLORS.get(action["op"], "37"), action["op"], action["id"], action["reason"]
+        ))
+    touched = set(action["target"] for action in actions if action["kind"] in ("container", "pod", "labels", "service"))
+    unchanged = [x for x in list(containers) + list(services) if str(x) not in touched]
+    print("\033[1;37;40m%s actions, %s of %s containers and services unchanged\033[0m" % (
+        len(actions), len(unchanged), len(containers) + len(services)
+    ))
+
+
+def save_plan(plan_file, mode, targets, actions):
+    directory = os.path.dirname(plan_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(plan_file, "w") as fd:
+        json.dump({
+            "mode": mode,
+            "targets": targets,
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "actions": actions
+        }, fd, indent=2)
+
+
+def load_plan(plan_file, mode):
+    with open(plan_file) as fd:
+        saved = json.load(fd)
+    if saved["mode"] != mode:
+        raise ValueError("Plan %s was made for %s mode, not %s" % (plan_file, saved["mode"], mode))
+    return saved
+
+
+def apply(mode, stack, plan_file=None, jobs=None):
+    # Runs the actions of a saved plan as a dependency graph. The plan is not re-checked against the nodes, an
+    # action whose object changed meanwhile fails the way the underlying docker or kubectl command does.
+    plan_file = plan_file or PLAN_FILE
+    saved = load_plan(plan_file, mode)
+    actions = saved["actions"]
+    print("\033[1;37;40mApplying plan of %s from %s @ %s\033[0m" % (
+        ", ".join(saved["targets"]), saved["created_at"], mode
+    ))
+    if not actions:
+        print(" - Nothing to do")
+        return
+    executors = DEV_EXECUTORS if mode == "dev" else PROD_EXECUTORS
+    scheduler = Scheduler(get_jobs(stack, jobs), title="Apply")
+    bootstrap = [stack[action["target"]] for action in actions if action["kind"] == "bootstrap"]
+    if mode == "prod":
+        warm_instances(stack, [x for x in _action_instances(stack, actions) if x not in bootstrap])
+    if bootstrap:
+        add_bootstrap_tasks(scheduler, stack, bootstrap)
+    for action in actions:
+        scheduler.add(
+            action["id"],
+            lambda action=action: executors[action["kind"]](stack, action, scheduler.results),
+            action["depends_on"]
+        )
+    scheduler.run()
+    if mode == "prod":
+        created = [action["target"] for action in actions if action["kind"] == "pod"]
+        if created:
+            wait_for_rollout(stack, created)
+
+
+def _action_instances(stack, actions):
+    # Instances the actions run on; domains and services stand for their root instance
+    instances = []
+    for action in actions:
+        item = stack[action["target"]]
+        if isinstance(item, Container):
+            instances.append(item.instance)
+        elif isinstance(item, Instance):
+            instances.append(item)
+        else:
+            instances.append(stack.get_root_instance(item if isinstance(item, Domain) else item.domain))
+    return list(dict.fromkeys(instances))
+
+
+def _print_action(action):
+    print(" - \033[%sm%s\033[0m %s" % (OP_COLORS.get(action["op"], "37"), action["op"], action["id"]))
+
+
+def _image_id(stack, env, container, action, results):
+    # Id of the image the container runs: known at plan time, or returned by its image action
+    if action.get("image_id"):
+        return action["image_id"]
+    if results.get("image:%s" % container):
+        return results["image:%s" % container]["Id"]
+    name = str(container) if container.build else container.run.split(":")[0]
+    return DockerManager(stack, env).get_images(True)[name]["Id"]
+
+
+def apply_dev_network(stack, action, results):
+    _print_action(action)
+    DockerManager(stack, EnvironmentFactory.get_local()).add_network(action["target"])
+
+
+def apply_dev_volume(stack, action, results):
+    _print_action(action)
+    DockerManager(stack, EnvironmentFactory.get_local()).add_volume(action["target"])
+
+
+def apply_dev_image(stack, action, results):
+    _print_action(action)
+    container = stack[action["target"]]
+    env = EnvironmentFactory.get_local()
+    docker_manager = DockerManager(stack, env)
+    if action["op"] == "build":
+        return deploy_dev_build_image(stack, env, container, action["build_hash"])
+    elif action["op"] == "tag":
+        return docker_manager.tag_image(action["image"], str(container))
+    return docker_manager.pull_image(container.run)
+
+
+def apply_dev_container(stack, action, results):
+    _print_action(action)
+    container = stack[action["target"]]
+    env = EnvironmentFactory.get_local()
+    docker_manager = DockerManager(stack, env)
+    image_id = _image_id(stack, env, container, action, results)
+    if action["op"] == "replace":
+        docker_manager.remove_container(str(container))
+    docker_manager.add_container(image_id=image_id, **get_dev_container_parms(container))
+
+
+DEV_EXECUTORS = {
+    "network": apply_dev_network,
+    "volume": apply_dev_volume,
+    "image": apply_dev_image,
+    "container": apply_dev_container
+}
+
+
+def _instance_env(instance):
+    return EnvironmentFactory.get_remote(instance.public_ip, instance.public_port)
+
+
+def apply_prod_namespace(stack, action, results):
+    _print_action(action)
+    domain = stack[action["target"]]
+    deploy_prod_initialize_kube_namespaces(stack, get_root_env(stack, domain), domain)
+
+
+def apply_prod_volumes(stack, action, results):
+    _print_action(action)
+    _instance_env(stack[action["target"]]).run("mkdir -p %s" % " ".join(action["paths"]))
+
+
+def apply_prod_image(stack, action, results):
+    _print_action(action)
+    container = stack[action["target"]]
+    env = _instance_env(container.instance)
+    if action["op"] == "tag":
+        return DockerManager(stack, env).tag_image(action["image"], str(container))
+    return deploy_prod_get_image(stack, env, container)
+
+
+def apply_prod_pod(stack, action, results):
+    _print_action(action)
+    container = stack[action["target"]]
+    kube_manager = get_kube_manager(stack, get_root_env(stack, container.instance.domain))
+    image_id = _image_id(stack, _instance_env(container.instance), container, action, results)
+    if action["op"] == "replace":
+        kube_manager.stop(str(container))
+    kube_manager.add_container(image_id=image_id, services=action["services"], **get_pod_parms(container))
+
+
+def apply_prod_labels(stack, action, results):
+    _print_action(action)
+    container = stack[action["target"]]
+    get_kube_manager(stack, get_root_env(stack, container.instance.domain)).set_services(
+        str(container), action["services"], action["previous"]
+    )
+
+
+def apply_prod_service(stack, action, results):
+    _print_action(action)
+    service = stack[action["target"]]
+    get_kube_manager(stack, get_root_env(stack, service.domain)).add_service(
+        str(service), ports=service.ports, expose=service.expose
+    )
+
+
+PROD_EXECUTORS = {
+    "namespace": apply_prod_namespace,
+    "volumes": apply_prod_volumes,
+    "image": apply_prod_image,
+    "pod": apply_prod_pod,
+    "labels": apply_prod_labels,
+    "service": apply_prod_service
+}
@@ -1,5 +1,5 @@
-from deploy.environment import EnvironmentFactory, LocalEnvironment
-from deploy.kube_manager import KubeManager
+from deploy.environment import EnvironmentFactory
+from deploy.kube_manager import get_kube_manager
 from deploy.docker_manager import DockerManager
 
 
@@ -12,7 +12,7 @@ def stop(mode, stack, service):
 
 
 def stop_dev(stack, service):
-    local_env = LocalEnvironment()
+    local_env = EnvironmentFactory.get_local()
     docker_manager = DockerManager(stack, local_env)
     docker_manager.remove_container(service)
 
@@ -20,6 +20,6 @@ def stop_dev(stack, service):
 def stop_prod(stack, service):
     root_instance = stack.get_root_instance(stack[service].instance.domain)
     env = EnvironmentFactory.get_remote(root_instance.public_ip, root_instance.public_port)
-    kube_manager = KubeManager(stack, env)
+    kube_manager = get_kube_manager(stack, env)
     kube_manager.stop(service)
 
@@ -0,0 +1,191 @@
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+TOP_SPANS = 15
+
+_enabled = False
+_started_at = None
+_spans = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable():
+    global _enabled, _started_at
+    _enabled = True
+    _started_at = time.perf_counter()
+
+
+def is_enabled():
+    return _enabled
+
+
+@contextmanager
+def span(name, category, **args):
+    # Records a nested span of work: name, category, start, duration, thread and free form args (host, bytes,
+    # return_code...). Yields the args dict so the caller can add values found out while the span runs.
+    if not _enabled:
+        yield args
+        return
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    args = {key: value for key, value in args.items() if value is not None}
+    stack.append(args)
+    started_at = time.perf_counter()
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = str(e)[:200]
+        raise
+    finally:
+        stack.pop()
+        _record(name, category, started_at, len(stack), args)
+
+
+def _record(name, category, started_at, depth, args):
+    finished_at = time.perf_counter()
+    with _lock:
+        _spans.append({
+            "name": name,
+            "category": category,
+            "start": started_at - _started_at,
+            "duration": finished_at - started_at,
+            "thread": threading.get_ident(),
+            "thread_name": threading.current_thread().name,
+            "depth": depth,
+            "args": args
+        })
+
+
+def _annotate_result(current, result):
+    if isinstance(result, dict) and "return_code" in result:
+        current["return_code"] = result["return_code"]
+        current["bytes"] = len(result.get("stdout") or "") + len(result.get("stderr") or "")
+    elif isinstance(result, int) and not isinstance(result, bool):
+        current["bytes"] = result
+
+
+def annotate(**args):
+    # Adds values to the innermost open span of the current thread
+    stack = getattr(_local, "stack", None)
+    if _enabled and stack:
+        stack[-1].update(args)
+
+
+def _host(obj):
+    env = getattr(obj, "env", obj)
+    return getattr(env, "hostname", "local")
+
+
+def traced(category, name=None):
+    # Method decorator: one span per call with the host of the object (or of its env) and the first argument,
+    # usually the command. Results in Environment.run form also record return code and output size.
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            return _traced_coroutine(func, category, name)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not _enabled:
+                return func(self, *args, **kwargs)
+            detail = str(args[0] if args else kwargs.get("name", ""))[:200] or None
+            with span(name or func.__name__, category, host=_host(self), detail=detail) as current:
+                result = func(self, *args, **kwargs)
+                _annotate_result(current, result)
+                return result
+        return wrapper
+    return decorator
+
+
+def _traced_coroutine(func, category, name):
+    # Coroutines interleave on one thread, so their spans stay out of the thread's span stack: they are recorded
+    # flat and annotate() does not reach them
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        if not _enabled:
+            return await func(self, *args, **kwargs)
+        current = {"host": _host(self), "detail": str(args[0] if args else kwargs.get("name", ""))[:200] or None}
+        current = {key: value for key, value in current.items() if value is not None}
+        started_at = time.perf_counter()
+        try:
+            result = await func(self, *args, **kwargs)
+            _annotate_result(current, result)
+            return result
+        except BaseException as e:
+            current["error"] = str(e)[:200]
+            raise
+        finally:
+            _record(name or func.__name__, category, started_at, 0, current)
+    return wrapper
+
+
+def trace_methods(category):
+    # Class decorator applying traced to every public method defined on the class; generators are left alone
+    # since their work happens after the call returns
+    def decorator(cls):
+        for attr, value in list(vars(cls).items()):
+            if attr.startswith("_") or not inspect.isfunction(value) or inspect.isgeneratorfunction(value) or \
+                    inspect.isasyncgenfunction(value):
+                continue
+            setattr(cls, attr, traced(category, "%s.%s" % (cls.__name__, attr))(value))
+        return cls
+    return decorator
+
+
+def write_chrome_trace(path):
+    # Trace Event Format, loadable in chrome://tracing and ui.perfetto.dev
+    with _lock:
+        spans = list(_spans)
+    events = []
+    threads = {}
+    for item in spans:
+        threads[item["thread"]] = item["thread_name"]
+        events.append({
+            "name": item["name"],
+            "cat": item["category"],
+            "ph": "X",
+            "ts": int(item["start"] * 1000000),
+            "dur": int(item["duration"] * 1000000),
+            "pid": 1,
+            "tid": item["thread"],
+            "args": item["args"]
+        })
+    for thread, thread_name in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": thread, "args": {"name": thread_name}})
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as fd:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, fd)
+
+
+def print_summary(top=TOP_SPANS):
+    with _lock:
+        spans = sorted(_spans, key=lambda x: x["duration"], reverse=True)
+    if not spans:
+        return
+    print("\033[1;37;40mSlowest steps\033[0m")
+    for item in spans[:top]:
+        args = item["args"]
+        print(" - %8.2fs  %-8s %-32s %-16s %s%s" % (
+            item["duration"],
+            item["category"],
+            item["name"][:32],
+            args.get("host", ""),
+            (args.get("detail") or "")[:80],
+            " (%s bytes)" % args["bytes"] if "bytes" in args else ""
+        ))
+    totals = {}
+    for item in spans:
+        if item["depth"] == 0:
+            totals[item["category"]] = totals.get(item["category"], 0) + item["duration"]
+    print(" - Top level time by category: %s" % ", ".join(
+        "%s %.2fs" % (category, duration) for category, duration in sorted(totals.items(), key=lambda x: -x[1])
+    ))
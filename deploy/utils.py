@@ -1,26 +1,8 @@
-import hashlib
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from socket import create_connection
 
 
-def get_nonce(struct):
-    cipher = hashlib.md5()
-
-    if isinstance(struct, dict):
-        struct = list(struct.items())
-
-    if isinstance(struct, list):
-        for x in sorted(struct):
-            cipher.update(get_nonce(x).encode("utf8"))
-    elif isinstance(struct, tuple):
-        for x in struct:
-            cipher.update(get_nonce(x).encode("utf8"))
-    else:
-        cipher.update(repr(struct).encode("utf8"))
-
-    return cipher.hexdigest()
-
-
 def wait_for_port(address, port=22):
     while True:
         try:
@@ -31,14 +13,26 @@ def wait_for_port(address, port=22):
         time.sleep(5)
 
 
-def wait_for_cloud_init(env):
-    while True:
-        res = env.run(
-            "ls /var/lib/cloud/instance/ | grep boot-finished",
-            hide=True,
-            ignore_errors=True
-        )
-        if "No such file" in res["stderr"] or res["stdout"].strip():
-            break
-        print("Still waiting for cloud-init")
-        time.sleep(5)
+def run_parallel(func, items, jobs=None):
+    # Returns ({item: result}, {item: exception}); every item is attempted even when others fail
+    results = {}
+    errors = {}
+    if not items:
+        return results, errors
+    with ThreadPoolExecutor(max_workers=jobs or len(items)) as pool:
+        futures = {pool.submit(func, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                results[item] = future.result()
+            except Exception as e:
+                errors[item] = e
+    return results, errors
+
+
+def raise_errors(title, errors):
+    if not errors:
+        return
+    for item, error in errors.items():
+        print("\033[31m%s failed on %s: %s\033[0m" % (title, item, error))
+    raise RuntimeError("%s failed on %s" % (title, ", ".join(sorted(str(item) for item in errors))))
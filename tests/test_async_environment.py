@@ -0,0 +1,300 @@
+import asyncio
+import os
+import subprocess
+from threading import Lock, Thread
+
+import pytest
+
+from deploy.async_environment import (
+    AsyncLocalEnvironment, AsyncSSHEnvironment, ThreadedAsyncEnvironment, run_parallel_async
+)
+from deploy.environment import LocalEnvironment
+
+
+class FakeChannel:
+    # paramiko exec Channel running its command in a local shell. As with paramiko, fileno() is a pipe that is
+    # readable while output is buffered or once EOF was received.
+    def __init__(self):
+        self.lock = Lock()
+        self.stdout = bytearray()
+        self.stderr = bytearray()
+        self.eof_received = False
+        self.closed = False
+        self.command = None
+        self.process = None
+        self.read_fd, self.write_fd = os.pipe()
+        self.readable = False
+        self.pumping = 2
+
+    def fileno(self):
+        return self.read_fd
+
+    def exec_command(self, cmd):
+        self.command = cmd
+        self.process = subprocess.Popen(
+            ["sh", "-c", cmd], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        Thread(target=self._pump, args=(self.process.stdout, self.stdout), daemon=True).start()
+        Thread(target=self._pump, args=(self.process.stderr, self.stderr), daemon=True).start()
+
+    def _pump(self, pipe, buffer):
+        for chunk in iter(lambda: pipe.read1(4096), b""):
+            with self.lock:
+                buffer.extend(chunk)
+                self._signal()
+        with self.lock:
+            self.pumping -= 1
+            if not self.pumping:
+                self.eof_received = True
+                self._signal()
+
+    def _signal(self):
+        if not self.readable and not self.closed:
+            os.write(self.write_fd, b"x")
+            self.readable = True
+
+    def _recv(self, buffer, size):
+        with self.lock:
+            data = bytes(buffer[:size])
+            del buffer[:size]
+            if self.readable and not self.stdout and not self.stderr and not self.eof_received:
+                os.read(self.read_fd, 1)
+                self.readable = False
+            return data
+
+    def recv_ready(self):
+        with self.lock:
+            return bool(self.stdout)
+
+    def recv_stderr_ready(self):
+        with self.lock:
+            return bool(self.stderr)
+
+    def recv(self, size):
+        return self._recv(self.stdout, size)
+
+    def recv_stderr(self, size):
+        return self._recv(self.stderr, size)
+
+    def exit_status_ready(self):
+        # A shell killed by SIGKILL stands for a dropped connection, no exit status arrives then
+        return self.process.wait() != -9
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def shutdown_write(self):
+        self.process.stdin.close()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+        if self.process:
+            self.process.wait()
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class FakeSSHEnvironment:
+    # What AsyncSSHEnvironment uses of a SSHEnvironment: the client, transport and session are the env itself
+    hostname = "fake"
+    port = 22
+
+    def __init__(self, cwd, failures=0):
+        self.cwd = cwd
+        self.failures = failures
+        self.channels = []
+        self.resets = []
+
+    def get_client(self):
+        return self
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        if self.failures:
+            self.failures -= 1
+            raise EOFError("connection dropped")
+        self.channels.append(FakeChannel())
+        return self.channels[-1]
+
+    def reset_client(self, e):
+        self.resets.append(e)
+
+
+async def collect(lines, count=None):
+    res = []
+    async for line in lines:
+        res.append(line)
+        if count and len(res) == count:
+            break
+    return res
+
+
+@pytest.fixture
+def local(tmp_path):
+    env = AsyncLocalEnvironment()
+    env.cd(str(tmp_path))
+    return env
+
+
+@pytest.fixture
+def ssh(tmp_path):
+    return AsyncSSHEnvironment(FakeSSHEnvironment(str(tmp_path)))
+
+
+def test_run_parallel_async_bounds_jobs():
+    running = []
+    peak = []
+
+    async def work(item):
+        running.append(item)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(item)
+        if item == 7:
+            raise ValueError("item %s" % item)
+        return item * 2
+
+    results, errors = asyncio.run(run_parallel_async(work, list(range(20)), jobs=3))
+    assert max(peak) == 3
+    assert results == {item: item * 2 for item in range(20) if item != 7}
+    assert list(errors) == [7] and isinstance(errors[7], ValueError)
+
+
+def test_local_run(local, tmp_path):
+    (tmp_path / "file").write_text("content\n")
+    local.add_env("GREETING", "hello")
+    result = asyncio.run(local.run("sh -c 'cat file; echo $GREETING; echo oops >&2; exit 3'", hide=True))
+    assert result == {"stdout": "content\nhello", "stderr": "oops", "return_code": 3}
+
+
+def test_local_run_stdin(local):
+    result = asyncio.run(local.run("cat", hide=True, stdin="a\nb\n"))
+    assert result["stdout"] == "a\nb"
+
+
+def test_local_run_max_lines(local):
+    result = asyncio.run(local.run("seq 100", hide=True, max_lines=3))
+    assert result["stdout"] == "98\n99\n100"
+
+
+def test_local_run_batch(local):
+    results = asyncio.run(local.run_batch(["echo a", {"cmd": "false", "ignore_errors": True}, "echo b"], hide=True))
+    assert [(x["stdout"], x["return_code"]) for x in results] == [("a", 0), ("", 1), ("b", 0)]
+    with pytest.raises(RuntimeError):
+        asyncio.run(local.run_batch(["false", "echo never"], hide=True))
+
+
+def test_local_stream(local):
+    assert asyncio.run(collect(local.stream("printf 'a\\nb\\nc'"))) == ["a", "b", "c"]
+
+
+def test_local_stream_stopped_early(local):
+    # The generator is closed after three lines, which kills the endless command
+    async def head():
+        lines = local.stream("yes")
+        res = await collect(lines, 3)
+        await lines.aclose()
+        return res
+
+    assert asyncio.run(asyncio.wait_for(head(), 5)) == ["y", "y", "y"]
+
+
+def test_ssh_run(ssh, tmp_path):
+    (tmp_path / "file").write_text("content\n")
+    result = asyncio.run(ssh.run("cat file; echo oops >&2", hide=True))
+    assert result == {"stdout": "content", "stderr": "oops", "return_code": 0}
+    assert ssh.env.channels[0].command == "cd %s; cat file; echo oops >&2; echo $?" % tmp_path
+    assert ssh.env.channels[0].closed
+
+
+def test_ssh_run_return_code(ssh):
+    assert asyncio.run(ssh.run("sh -c 'exit 4'", hide=True, ignore_errors=True))["return_code"] == 4
+    with pytest.raises(RuntimeError):
+        asyncio.run(ssh.run("false", hide=True))
+
+
+def test_ssh_run_stdin(ssh):
+    assert asyncio.run(ssh.run("cat", hide=True, stdin="a\nb\n"))["stdout"] == "a\nb"
+
+
+def test_ssh_run_max_lines(ssh):
+    # The exit status is read from the extra line kept beyond max_lines
+    assert asyncio.run(ssh.run("seq 5", hide=True, max_lines=2)) == {"stdout": "4\n5", "stderr": "", "return_code": 0}
+    assert asyncio.run(ssh.run("seq 5", hide=True, max_lines=0)) == {"stdout": "", "stderr": "", "return_code": 0}
+
+
+def test_ssh_run_large_output(ssh):
+    # More than one read worth of output, the loop waits on the channel's pipe between reads
+    result = asyncio.run(ssh.run("seq 50000", hide=True))
+    assert result["stdout"].split("\n") == [str(x) for x in range(1, 50001)]
+
+
+def test_ssh_run_reconnects(tmp_path):
+    ssh = AsyncSSHEnvironment(FakeSSHEnvironment(str(tmp_path), failures=1))
+    assert asyncio.run(ssh.run("echo a", hide=True))["stdout"] == "a"
+    assert len(ssh.env.resets) == 1
+
+
+def test_ssh_run_batch(ssh):
+    results = asyncio.run(ssh.run_batch(
+        ["echo a; echo err >&2", {"cmd": "exit 2", "ignore_errors": True}, "echo b"], hide=True
+    ))
+    assert [(x["stdout"], x["stderr"], x["return_code"]) for x in results] == [
+        ("a", "err", 0), ("", "", 2), ("b", "", 0)
+    ]
+    assert len(ssh.env.channels) == 1
+
+
+def test_ssh_run_batch_resumes_after_dropped_connection(ssh, tmp_path):
+    drop = "[ -e dropped ] || { touch dropped; kill -9 $$; exit 1; }"
+    results = asyncio.run(ssh.run_batch(
+        ["echo a >> log; echo a", "%s; echo b >> log; echo b" % drop, "echo c >> log; echo c"], hide=True
+    ))
+    assert [(x["stdout"], x["return_code"]) for x in results] == [("a", 0), ("b", 0), ("c", 0)]
+    assert (tmp_path / "log").read_text() == "a\nb\nc\n"
+    assert len(ssh.env.resets) == 1 and len(ssh.env.channels) == 2
+
+
+def test_ssh_run_batch_stops_on_error(ssh):
+    with pytest.raises(RuntimeError):
+        asyncio.run(ssh.run_batch(["false", "echo never"], hide=True))
+
+
+def test_ssh_stream(ssh):
+    assert asyncio.run(collect(ssh.stream("echo a; echo ignored >&2; printf 'b\\nc'"))) == ["a", "b", "c"]
+
+
+def test_ssh_stream_stopped_early(ssh):
+    async def head():
+        lines = ssh.stream("yes")
+        res = await collect(lines, 3)
+        await lines.aclose()
+        return res
+
+    assert asyncio.run(asyncio.wait_for(head(), 5)) == ["y", "y", "y"]
+    assert ssh.env.channels[0].closed
+
+
+def test_parallel_ssh_runs_share_the_loop(ssh):
+    # Each run waits on its own channel, so the sleeps overlap
+    async def run_all():
+        return await run_parallel_async(lambda x: ssh.run("sleep 0.3; echo %s" % x, hide=True), list(range(5)))
+
+    results, errors = asyncio.run(asyncio.wait_for(run_all(), 1.2))
+    assert {x: result["stdout"] for x, result in results.items()} == {x: str(x) for x in range(5)}
+    assert not errors
+
+
+def test_threaded_environment(tmp_path):
+    env = ThreadedAsyncEnvironment(LocalEnvironment())
+    env.cd(str(tmp_path))
+    assert asyncio.run(env.run("echo a", hide=True))["stdout"] == "a"
+    assert asyncio.run(collect(env.stream("printf 'a\\nb'"))) == ["a", "b"]
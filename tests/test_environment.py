@@ -0,0 +1,145 @@
+import subprocess
+import time
+
+import pytest
+
+from deploy import environment
+from deploy.environment import EnvironmentFactory, SSHEnvironment
+from deploy.stream import iter_lines
+from deploy.utils import run_parallel
+
+
+class SlowSSHEnvironment(environment.SSHEnvironment):
+    # Widens the window between the factory's lookup and its insert
+    created = []
+
+    def __init__(self, hostname, port=22):
+        time.sleep(0.05)
+        super().__init__(hostname, port)
+        self.created.append((hostname, port))
+
+    def connect(self):
+        return self
+
+
+def test_get_remote_creates_one_environment_per_host(monkeypatch):
+    monkeypatch.setattr(environment, "SSHEnvironment", SlowSSHEnvironment)
+    monkeypatch.setattr(EnvironmentFactory, "_remotes", {})
+    SlowSSHEnvironment.created = []
+    results, errors = run_parallel(lambda i: EnvironmentFactory.get_remote("node%s" % (i % 2)), list(range(16)))
+    assert not errors
+    assert sorted(SlowSSHEnvironment.created) == [("node0", 22), ("node1", 22)]
+    assert len({id(env) for env in results.values()}) == 2
+
+
+def test_warm_shares_environments(monkeypatch):
+    monkeypatch.setattr(environment, "SSHEnvironment", SlowSSHEnvironment)
+    monkeypatch.setattr(EnvironmentFactory, "_remotes", {})
+    SlowSSHEnvironment.created = []
+    EnvironmentFactory.warm([("node0", 22), ("node1", 22), ("node0", 22)])
+    assert sorted(SlowSSHEnvironment.created) == [("node0", 22), ("node1", 22)]
+    assert EnvironmentFactory.get_remote("node0") is EnvironmentFactory._remotes["node0", 22]
+
+
+class FakeExecChannel:
+    # The part of a paramiko exec channel run_batch reads, running the command in a local shell
+    def __init__(self, cmd):
+        self.process = subprocess.Popen(["sh", "-c", cmd], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.channel = self
+
+    def recv(self, size):
+        return self.process.stdout.read1(size)
+
+    def recv_stderr(self, size):
+        return self.process.stderr.read1(size)
+
+    def exit_status_ready(self):
+        # A shell killed by SIGKILL stands for a dropped connection, no exit status arrives then
+        return self.process.wait() != -9
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+
+class FakeSession:
+    # A session channel as open_reader uses it, the command starts on exec_command
+    def exec_command(self, cmd):
+        self.channel = FakeExecChannel(cmd)
+        self.recv, self.recv_stderr = self.channel.recv, self.channel.recv_stderr
+        self.recv_exit_status = self.channel.recv_exit_status
+
+
+class FakeSSHEnvironment(SSHEnvironment):
+    def __init__(self, cwd):
+        super().__init__("fake")
+        self.cwd = cwd
+        self.scripts = []
+        self.resets = []
+
+    def get_client(self):
+        return self
+
+    def get_transport(self):
+        return self
+
+    def open_session(self):
+        return FakeSession()
+
+    def exec_command(self, cmd):
+        self.scripts.append(cmd)
+        channel = FakeExecChannel(cmd)
+        return None, channel, channel
+
+    def reset_client(self, error):
+        self.resets.append(error)
+
+
+# Kills the batch's shell the first time it runs, as a dropped connection would
+DROP = "[ -e dropped ] || { touch dropped; kill -9 $$; exit 1; }"
+
+
+def test_run_batch(tmp_path):
+    env = FakeSSHEnvironment(str(tmp_path))
+    results = env.run_batch(["echo a; echo err >&2", {"cmd": "exit 2", "ignore_errors": True}, "echo b"], hide=True)
+    assert [(x["stdout"], x["stderr"], x["return_code"]) for x in results] == [("a", "err", 0), ("", "", 2), ("b", "", 0)]
+    with pytest.raises(RuntimeError):
+        env.run_batch(["false", "echo never > never"], hide=True)
+    assert not (tmp_path / "never").exists()
+    assert len(env.scripts) == 2 and not env.resets
+
+
+def test_run_batch_resumes_after_dropped_connection(tmp_path):
+    env = FakeSSHEnvironment(str(tmp_path))
+    results = env.run_batch(
+        ["echo a >> log; echo a", "%s; echo b >> log; echo b" % DROP, "echo c >> log; echo c"], hide=True
+    )
+    assert [(x["stdout"], x["return_code"]) for x in results] == [("a", 0), ("b", 0), ("c", 0)]
+    # The command that finished before the drop ran once, the batch resumed from the interrupted one
+    assert (tmp_path / "log").read_text() == "a\nb\nc\n"
+    assert len(env.resets) == 1
+    assert "echo a" not in env.scripts[1]
+
+
+def test_run_batch_ended_early(tmp_path):
+    env = FakeSSHEnvironment(str(tmp_path))
+    # The shell exits by itself before the last command, there is no connection to blame
+    with pytest.raises(RuntimeError):
+        env.run_batch(["echo a", "kill $$", "echo never"], hide=True)
+    assert not env.resets
+
+
+def test_open_reader_drains_stderr(tmp_path):
+    env = FakeSSHEnvironment(str(tmp_path))
+    drained = []
+    env.process_stream = lambda read, lines, hide=False: drained.extend(iter_lines(read))
+    # Far more stderr than a pipe holds before the command writes to stdout
+    read, wait = env.open_reader("yes err | head -n 200000 >&2; echo done")
+    chunks = []
+    while True:
+        chunk = read(4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    assert b"".join(chunks) == b"done\n"
+    assert wait() == 0
+    assert drained[0] == "err"
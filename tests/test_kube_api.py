@@ -0,0 +1,306 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from deploy import kube_api
+from deploy.kube_api import KubeApiClient, KubeApiError, KubeApiManager, KINDS, get_object_path
+from deploy.spec import HASH_LABEL
+
+
+NOT_FOUND = {"kind": "Status", "status": "Failure", "reason": "NotFound", "code": 404}
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    # Keeps objects by path and records every request as (method, path, query, content type, body). Watches and
+    # follows are answered with the chunks queued in `streams` for their path.
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeApiHandler)
+        self.lock = Lock()
+        self.objects = {}
+        self.streams = {}
+        self.requests = []
+        self.connections = 0
+        self.resource_version = 0
+        # Answer DELETE with a Status instead of the object and keep the object until its DELETED event
+        self.delete_status = False
+        self.graceful = False
+        # Close kept-alive connections after each response without telling the client
+        self.drop_connections = False
+
+    def store(self, path, item):
+        self.resource_version += 1
+        item = dict(item, metadata=dict(item["metadata"], resourceVersion=str(self.resource_version)))
+        self.objects[path] = item
+        return item
+
+    def respond(self, method, path, body):
+        if method == "GET":
+            if path in self.objects:
+                return 200, self.objects[path]
+            if path.rsplit("/", 1)[1] in KINDS.values():
+                return 200, {"kind": "List", "items": [
+                    item for key, item in sorted(self.objects.items()) if key.rsplit("/", 1)[0] == path
+                ]}
+            return 404, NOT_FOUND
+        if method == "POST":
+            path = "%s/%s" % (path, body["metadata"]["name"])
+            if path in self.objects:
+                return 409, {"kind": "Status", "status": "Failure", "reason": "AlreadyExists", "code": 409}
+            return 201, self.store(path, body)
+        if method == "PATCH":
+            return 200, self.store(path, body)
+        if method == "DELETE":
+            if path not in self.objects:
+                return 404, NOT_FOUND
+            item = self.objects[path] if self.graceful else self.objects.pop(path)
+            if self.delete_status:
+                return 200, {"kind": "Status", "status": "Success", "metadata": {}}
+            return 200, dict(item, metadata=dict(item["metadata"], deletionTimestamp="2026-01-01T00:00:00Z"))
+
+    def requested(self, method):
+        return [x for x in self.requests if x[0] == method]
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self):
+        url = urlsplit(self.path)
+        query = {key: value[0] for key, value in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        with self.server.lock:
+            self.server.requests.append((self.command, url.path, query, self.headers.get("Content-Type"), body))
+            if query.get("watch") != "true" and query.get("follow") != "true":
+                status, payload = self.server.respond(self.command, url.path, body)
+            else:
+                status, payload = None, self.server.streams.get(url.path, [])
+        if status is None:
+            self.send_stream(payload)
+            return
+        data = json.dumps(payload).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if self.server.drop_connections:
+            self.close_connection = True
+
+    def send_stream(self, chunks):
+        # No Content-Length: the body ends when the connection closes, chunks arrive separately
+        self.send_response(200)
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for chunk in chunks:
+            if isinstance(chunk, float):
+                # A number of seconds the stream stays silent for
+                time.sleep(chunk)
+                continue
+            self.wfile.write(chunk)
+            self.wfile.flush()
+            time.sleep(0.01)
+        self.close_connection = True
+
+    do_GET = do_POST = do_PATCH = do_DELETE = handle_request
+
+
+class FakeEnv:
+    hostname = "fake-root"
+    port = 22
+
+
+def event(event_type, item):
+    return (json.dumps({"type": event_type, "object": item}) + "\n").encode("utf8")
+
+
+def pod(name, namespace="bench"):
+    return {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {"name": name, "namespace": namespace},
+        "spec": {"containers": [{"name": name, "image": "%s:latest" % name}]}
+    }
+
+
+@pytest.fixture
+def server():
+    server = FakeApiServer()
+    thread = Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(server):
+    return KubeApiClient(*server.server_address, timeout=5)
+
+
+@pytest.fixture
+def manager(client, monkeypatch):
+    # get_api_client would start `kubectl proxy` over SSH, hand it the client instead
+    monkeypatch.setitem(kube_api._clients, (FakeEnv.hostname, FakeEnv.port), client)
+    return KubeApiManager(None, FakeEnv())
+
+
+def test_get_object_path():
+    assert get_object_path("Pod", "bench") == "/api/v1/namespaces/bench/pods"
+    assert get_object_path("Pod", "bench", "web") == "/api/v1/namespaces/bench/pods/web"
+    assert get_object_path("Namespace", None, "bench") == "/api/v1/namespaces/bench"
+
+
+def test_get(server, client):
+    server.store("/api/v1/namespaces/bench/pods/web", pod("web"))
+    assert client.get("/api/v1/namespaces/bench/pods/web")["metadata"]["name"] == "web"
+    assert [x["metadata"]["name"] for x in client.get("/api/v1/namespaces/bench/pods")["items"]] == ["web"]
+    assert server.requests[-1][2] == {}
+    client.get("/api/v1/namespaces/bench/pods", labelSelector="name=web", fieldSelector=None)
+    assert server.requests[-1][2] == {"labelSelector": "name=web"}
+
+
+def test_get_missing(client):
+    with pytest.raises(KubeApiError) as e:
+        client.get("/api/v1/namespaces/bench/pods/web")
+    assert e.value.status == 404
+    assert "NotFound" in e.value.body
+
+
+def test_create(server, client):
+    created = client.create("/api/v1/namespaces/bench/pods", pod("web"))
+    assert created["metadata"]["resourceVersion"] == "1"
+    assert server.requests[-1][:2] == ("POST", "/api/v1/namespaces/bench/pods")
+    assert server.requests[-1][3] == "application/json"
+    assert server.requests[-1][4] == pod("web")
+    with pytest.raises(KubeApiError) as e:
+        client.create("/api/v1/namespaces/bench/pods", pod("web"))
+    assert e.value.status == 409
+
+
+def test_connections_are_pooled(server, client):
+    server.store("/api/v1/namespaces/bench/pods/web", pod("web"))
+    for _ in range(5):
+        client.get("/api/v1/namespaces/bench/pods/web")
+    client.patch("/api/v1/namespaces/bench/pods/web", pod("web"))
+    assert len(server.requests) == 6
+    assert server.connections == 1
+
+
+def test_stale_pooled_connection_is_retried(server, client):
+    server.store("/api/v1/namespaces/bench/pods/web", pod("web"))
+    server.drop_connections = True
+    client.get("/api/v1/namespaces/bench/pods/web")
+    # The pooled connection was closed by the server, the request goes out again on a new one
+    assert client.get("/api/v1/namespaces/bench/pods/web")["metadata"]["name"] == "web"
+    assert len(server.requests) == 2
+    assert server.connections == 2
+
+
+def test_stream_reassembles_lines(server, client):
+    server.streams["/api/v1/namespaces/bench/pods/web/log"] = [b"first\nsec", b"ond\n", b"\n", b"third"]
+    lines = list(client.stream("/api/v1/namespaces/bench/pods/web/log", follow="true"))
+    assert lines == ["first", "second", "", "third"]
+
+
+def test_watch(server, client):
+    first, second = event("ADDED", pod("web")), event("DELETED", pod("web"))
+    server.streams["/api/v1/namespaces/bench/pods"] = [first[:10], first[10:] + b"\n", second]
+    assert [(event_type, item["metadata"]["name"]) for event_type, item in client.watch(
+        "/api/v1/namespaces/bench/pods", fieldSelector="metadata.name=web"
+    )] == [("ADDED", "web"), ("DELETED", "web")]
+    assert server.requests[-1][2] == {"fieldSelector": "metadata.name=web", "watch": "true"}
+
+
+def test_watch_outlives_client_timeout(server):
+    client = KubeApiClient(*server.server_address, timeout=0.2)
+    server.streams["/api/v1/namespaces/bench/pods"] = [event("ADDED", pod("web")), 0.5, event("DELETED", pod("web"))]
+    assert [event_type for event_type, _ in client.watch("/api/v1/namespaces/bench/pods")] == ["ADDED", "DELETED"]
+    # Plain requests still give up after the client timeout
+    assert client._connect().timeout == 0.2
+
+
+def test_apply(server, manager):
+    manager.apply([pod("web")])
+    method, path, query, content_type, body = server.requested("PATCH")[0]
+    assert path == "/api/v1/namespaces/bench/pods/web"
+    assert content_type == "application/apply-patch+yaml"
+    assert query == {"fieldManager": "deploy", "force": "true"}
+    assert HASH_LABEL in body["metadata"]["labels"]
+    assert server.objects[path]["metadata"]["labels"] == body["metadata"]["labels"]
+
+
+def test_apply_replace(server, manager):
+    server.store("/api/v1/namespaces/bench/pods/web", pod("web"))
+    manager.apply([pod("web")], replace=[("Pod", "web", "bench")])
+    assert [x[0] for x in server.requests] == ["DELETE", "PATCH"]
+
+
+def test_delete_waits_for_deleted_event(server, manager):
+    path = "/api/v1/namespaces/bench/pods/web"
+    resource_version = server.store(path, pod("web"))["metadata"]["resourceVersion"]
+    server.streams["/api/v1/namespaces/bench/pods"] = [event("MODIFIED", pod("web")), event("DELETED", pod("web"))]
+    manager.delete("Pod", "web", "bench", wait=True)
+    assert [(x[0], x[1]) for x in server.requests] == [("DELETE", path), ("GET", "/api/v1/namespaces/bench/pods")]
+    assert server.requests[-1][2] == {
+        "fieldSelector": "metadata.name=web", "resourceVersion": resource_version, "watch": "true"
+    }
+
+
+def test_delete_status_when_gone(server, manager):
+    server.store("/api/v1/namespaces/bench/pods/web", pod("web"))
+    server.delete_status = True
+    manager.delete("Pod", "web", "bench", wait=True)
+    assert [x[0] for x in server.requests] == ["DELETE", "GET"]
+    assert "watch" not in server.requests[-1][2]
+
+
+def test_delete_status_while_terminating(server, manager):
+    path = "/api/v1/namespaces/bench/pods/web"
+    resource_version = server.store(path, pod("web"))["metadata"]["resourceVersion"]
+    server.delete_status = True
+    server.graceful = True
+    server.streams["/api/v1/namespaces/bench/pods"] = [event("DELETED", pod("web"))]
+    manager.delete("Pod", "web", "bench", wait=True)
+    assert [x[0] for x in server.requests] == ["DELETE", "GET", "GET"]
+    assert server.requests[-1][2]["resourceVersion"] == resource_version
+
+
+def test_delete_missing(server, manager):
+    manager.delete("Pod", "web", "bench", wait=True)
+    assert [x[0] for x in server.requests] == ["DELETE"]
+
+
+def test_follow_logs(server, manager):
+    server.streams["/api/v1/namespaces/bench/pods/web/log"] = [
+        b"2026-01-01T00:00:00.000000001Z first\n2026-01-01T00:00:01",
+        b".000000001Z second\n"
+    ]
+    assert list(manager.follow_logs("web.bench", tail=10)) == [
+        "2026-01-01T00:00:00.000000001Z first", "2026-01-01T00:00:01.000000001Z second"
+    ]
+    assert server.requests[-1][2] == {"follow": "true", "timestamps": "true", "tailLines": "10"}
+    list(manager.follow_logs("web.bench", tail=10, since_time="2026-01-01T00:00:01Z"))
+    assert server.requests[-1][2] == {"follow": "true", "timestamps": "true", "sinceTime": "2026-01-01T00:00:01Z"}
+
+
+def test_stop(server, manager):
+    server.store("/api/v1/namespaces/bench/pods/web", pod("web"))
+    server.streams["/api/v1/namespaces/bench/pods"] = [event("DELETED", pod("web"))]
+    manager.stop("web.bench")
+    assert [x[0] for x in server.requests] == ["DELETE", "GET"]
+    assert "/api/v1/namespaces/bench/pods/web" not in server.objects
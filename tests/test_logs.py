@@ -0,0 +1,173 @@
+import asyncio
+
+import pytest
+
+from deploy.docker_manager import AsyncDockerManager
+from deploy.kube_manager import AsyncKubeManager
+from deploy.logs import LogStream, follow_resumable, follow_resumable_async, since_time, timestamp_key
+
+
+class FakeFollow:
+    # Plays one attempt per call: a list of lines, or an exception raised after the lines before it. Calls past
+    # the last attempt bring nothing.
+    def __init__(self, *attempts):
+        self.attempts = list(attempts)
+        self.calls = []
+
+    def __call__(self, tail, since_time):
+        self.calls.append((tail, since_time))
+        return self._lines(self.attempts.pop(0) if self.attempts else [])
+
+    def _lines(self, attempt):
+        for line in attempt:
+            if isinstance(line, Exception):
+                raise line
+            yield line
+
+
+def follow(attempts, **kwargs):
+    return list(follow_resumable(attempts, 100, retry_delay=0, **kwargs))
+
+
+def test_timestamp_key():
+    assert timestamp_key("2026-01-01T00:00:00.5Z docker") == "2026-01-01T00:00:00.500000000"
+    assert timestamp_key("2026-01-01T00:00:00.500000000Z kubectl") == "2026-01-01T00:00:00.500000000"
+    assert timestamp_key("2026-01-01T00:00:00Z whole") == "2026-01-01T00:00:00.000000000"
+    assert timestamp_key("no timestamp") is None
+    assert since_time("2026-01-01T00:00:00.500000000") == "2026-01-01T00:00:00Z"
+
+
+def test_resume_skips_lines_already_seen():
+    attempts = FakeFollow(
+        ["2026-01-01T00:00:00.1Z a", "2026-01-01T00:00:01.1Z b", "2026-01-01T00:00:01.1Z c"],
+        ["2026-01-01T00:00:00.1Z a", "2026-01-01T00:00:01.1Z b", "2026-01-01T00:00:01.1Z c",
+         "2026-01-01T00:00:01.1Z d", "2026-01-01T00:00:02.1Z e"]
+    )
+    assert [line.split(" ")[1] for line in follow(attempts)] == ["a", "b", "c", "d", "e"]
+    assert attempts.calls == [
+        (100, None), (None, "2026-01-01T00:00:01Z"), (None, "2026-01-01T00:00:02Z")
+    ]
+
+
+def test_resume_after_error():
+    attempts = FakeFollow(
+        ["2026-01-01T00:00:00.1Z a", OSError("dropped")],
+        ["2026-01-01T00:00:00.1Z a", "2026-01-01T00:00:00.2Z b"]
+    )
+    assert [line.split(" ")[1] for line in follow(attempts)] == ["a", "b"]
+
+
+def test_resume_from_cache():
+    attempts = FakeFollow(["2026-01-01T00:00:00.1Z a", "2026-01-01T00:00:00.1Z b"])
+    assert follow(attempts, last_key="2026-01-01T00:00:00.100000000", last_count=1) == ["2026-01-01T00:00:00.1Z b"]
+    assert attempts.calls[0] == (None, "2026-01-01T00:00:00Z")
+
+
+def test_empty_follow_stops():
+    attempts = FakeFollow()
+    assert follow(attempts, retries=3) == []
+    assert len(attempts.calls) == 4
+
+
+def test_empty_follow_waits_for_lines():
+    attempts = FakeFollow([], [], ["2026-01-01T00:00:00.1Z a"])
+    assert follow(attempts, retries=3) == ["2026-01-01T00:00:00.1Z a"]
+
+
+def test_lines_without_timestamps_are_not_repeated():
+    attempts = FakeFollow(["a", "b"], ["a", "b"])
+    assert follow(attempts) == ["a", "b"]
+    assert len(attempts.calls) == 1
+
+
+def test_persistent_error_is_raised():
+    attempts = FakeFollow(*[[OSError("no such container")]] * 10)
+    with pytest.raises(OSError):
+        follow(attempts, retries=3)
+    assert len(attempts.calls) == 4
+
+
+def test_errors_after_progress_are_retried():
+    attempts = FakeFollow(
+        [OSError("dropped")], [OSError("dropped")], ["2026-01-01T00:00:00.1Z a", OSError("dropped")],
+        [OSError("dropped")], [OSError("dropped")], ["2026-01-01T00:00:00.2Z b"]
+    )
+    assert [line.split(" ")[1] for line in follow(attempts, retries=2)] == ["a", "b"]
+
+
+def test_log_stream_reports_failure():
+    def fail():
+        return follow_resumable(FakeFollow(*[[OSError("no such container")]] * 3), 100, retry_delay=0, retries=2)
+    stream = LogStream("web.bench", fail).start()
+    stream.thread.join(5)
+    _, line = stream.queue.get_nowait()
+    assert "Logs of web.bench failed: no such container" in line
+    assert stream.queue.get_nowait() is None
+
+
+class FakeAsyncEnv:
+    # Streams one attempt of lines per command, recording the commands
+    def __init__(self, *attempts):
+        self.attempts = list(attempts)
+        self.commands = []
+
+    async def stream(self, cmd):
+        self.commands.append(cmd)
+        for line in self.attempts.pop(0) if self.attempts else []:
+            if isinstance(line, Exception):
+                raise line
+            yield line
+
+
+async def collect(lines):
+    return [line async for line in lines]
+
+
+def test_follow_resumable_async():
+    attempts = FakeFollow(
+        ["2026-01-01T00:00:00.1Z a", OSError("dropped")],
+        ["2026-01-01T00:00:00.1Z a", "2026-01-01T00:00:01.1Z b"]
+    )
+
+    async def follow(tail, since_time):
+        for line in attempts(tail, since_time):
+            yield line
+
+    lines = asyncio.run(collect(follow_resumable_async(follow, 100, retry_delay=0)))
+    assert [line.split(" ")[1] for line in lines] == ["a", "b"]
+    assert attempts.calls == [(100, None), (None, "2026-01-01T00:00:00Z"), (None, "2026-01-01T00:00:01Z")]
+
+
+def test_follow_resumable_async_persistent_error():
+    async def follow(tail, since_time):
+        raise OSError("no such container")
+        yield
+
+    with pytest.raises(OSError):
+        asyncio.run(collect(follow_resumable_async(follow, 100, retry_delay=0, retries=2)))
+
+
+def test_async_kube_manager_logs_resume(capsys):
+    env = FakeAsyncEnv(
+        ["2026-01-01T00:00:00.100000000Z a", OSError("dropped")],
+        ["2026-01-01T00:00:00.100000000Z a", "2026-01-01T00:00:01.100000000Z b"]
+    )
+    asyncio.run(AsyncKubeManager(None, env).logs("web.bench", tail=10))
+    assert env.commands == [
+        "kubectl logs web -f --tail=10 --namespace=bench --timestamps=true",
+        "kubectl logs web -f --since-time=2026-01-01T00:00:00Z --namespace=bench --timestamps=true",
+        "kubectl logs web -f --since-time=2026-01-01T00:00:01Z --namespace=bench --timestamps=true"
+    ]
+    assert [line.split(" ")[-1] for line in capsys.readouterr().out.strip().split("\n")] == ["a\033[0m", "b\033[0m"]
+
+
+def test_async_docker_manager_logs_resume(capsys):
+    env = FakeAsyncEnv(
+        ["2026-01-01T00:00:00.1Z a", "2026-01-01T00:00:00.1Z b"],
+        ["2026-01-01T00:00:00.1Z a", "2026-01-01T00:00:00.1Z b", "2026-01-01T00:00:00.1Z c"]
+    )
+    asyncio.run(AsyncDockerManager(None, env).logs("web"))
+    assert env.commands[1] == "docker logs --since 2026-01-01T00:00:00Z -t -f web"
+    assert [line.split(" ")[-1] for line in capsys.readouterr().out.strip().split("\n")] == [
+        "a\033[0m", "b\033[0m", "c\033[0m"
+    ]
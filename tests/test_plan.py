@@ -0,0 +1,42 @@
+import io
+import os
+from contextlib import redirect_stdout
+
+import pytest
+
+from benchmarks.simulation import simulated
+from benchmarks.stacks import make_project, make_stack
+from deploy.facts import FACTS_FILE
+from deploy.tasks.deploy import deploy_prod
+from deploy.tasks.plan import plan
+
+
+@pytest.fixture
+def stack(tmp_path, monkeypatch):
+    make_project(str(tmp_path))
+    # Host facts are cached relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return make_stack(10, "prod", str(tmp_path))
+
+
+def targets(stack):
+    return [str(domain) for domain in stack.get_domains()]
+
+
+def test_plan_without_cached_facts(stack):
+    with simulated(stack), redirect_stdout(io.StringIO()):
+        deploy_prod(stack, targets(stack))
+        os.remove(FACTS_FILE)
+        actions = plan("prod", stack, targets(stack))
+    # The deployed objects are found on the hosts, nothing is planned from scratch
+    assert actions == []
+    assert os.path.exists(FACTS_FILE)
+
+
+def test_plan_empty_cluster(stack):
+    # The simulated hosts are bootstrapped but run nothing yet
+    with simulated(stack), redirect_stdout(io.StringIO()):
+        actions = plan("prod", stack, targets(stack))
+    kinds = {action["kind"] for action in actions}
+    assert {"namespace", "pod"} <= kinds and not {"bootstrap", "kube"} & kinds
+    assert os.path.exists(FACTS_FILE)
@@ -0,0 +1,58 @@
+from deploy.stream import LineSplitter, OutputBuffer, iter_lines
+
+
+def fill(buffer, count):
+    for i in range(count):
+        buffer.append("line%s" % i)
+    return buffer
+
+
+def test_unlimited():
+    buffer = fill(OutputBuffer(), 5)
+    assert list(buffer) == ["line0", "line1", "line2", "line3", "line4"]
+    assert buffer.dropped == 0
+    assert buffer.size == 30
+
+
+def test_max_lines():
+    buffer = fill(OutputBuffer(max_lines=2), 5)
+    assert buffer.text() == "line3\nline4"
+    assert buffer.dropped == 3
+    assert buffer.size == 12
+
+
+def test_max_lines_zero_keeps_nothing():
+    buffer = fill(OutputBuffer(max_lines=0), 3)
+    assert len(buffer) == 0
+    assert buffer.text() == ""
+    assert buffer.dropped == 3
+    assert buffer.size == 0
+
+
+def test_max_lines_one():
+    buffer = fill(OutputBuffer(max_lines=1), 3)
+    assert buffer.text() == "line2"
+    assert buffer.pop() == "line2"
+    assert len(buffer) == 0 and buffer.size == 0
+
+
+def test_max_bytes_keeps_the_last_line():
+    buffer = fill(OutputBuffer(max_bytes=12), 5)
+    assert buffer.text() == "line3\nline4"
+    buffer = fill(OutputBuffer(max_bytes=0), 3)
+    assert buffer.text() == "line2"
+    assert buffer.dropped == 2
+
+
+def test_line_splitter():
+    splitter = LineSplitter()
+    assert splitter.feed(b"a\nb") == ["a"]
+    assert splitter.feed(b"c") == []
+    assert splitter.feed(b"\n\xc3") == ["bc"]
+    assert splitter.feed(b"\xa9\n") == ["\xe9"]
+    assert splitter.flush() == []
+
+
+def test_iter_lines():
+    chunks = [b"first\nsec", b"ond", b"\nlast", b""]
+    assert list(iter_lines(lambda size: chunks.pop(0))) == ["first", "second", "last"]